@@ -0,0 +1,171 @@
+"""Samples per hour of a kraken2 worker, each task loading its own copy of the
+database (the default) or with the database staged once in shared memory and
+memory mapped by every task (--shared-db), which allows a higher concurrency.
+
+Tasks are run locally with the commands of scitq_kraken2.py, several at a
+time like on a worker (the CPU being shared between them as $CPU). Without
+--db, a small synthetic database (random genomes with a flat taxonomy) is
+built with kraken2-build. kraken2 (and kraken2-build) must be in the PATH."""
+import concurrent.futures
+import subprocess
+import threading
+import tempfile
+import argparse
+import shutil
+import random
+import gzip
+import time
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from kraken2.scitq_kraken2 import kraken2_command, stage_db_command, SHARED_DB_DIR, SHARED_CONCURRENCY
+
+READ_LENGTH = 150
+MB = 1024**2
+
+
+def random_sequence(rng, length):
+    return ''.join(rng.choices('ACGT', k=length))
+
+def make_synthetic_db(folder, genomes, genome_size, seed, threads):
+    """Build a kraken2 database of random genomes (one species per genome, all
+    in the same genus), return the genome sequences"""
+    rng = random.Random(seed)
+    db = os.path.join(folder, 'db')
+    os.makedirs(os.path.join(db, 'taxonomy'))
+    sequences = [random_sequence(rng, genome_size) for _ in range(genomes)]
+    with open(os.path.join(db, 'taxonomy', 'nodes.dmp'), 'w') as nodes, \
+            open(os.path.join(db, 'taxonomy', 'names.dmp'), 'w') as names:
+        for taxid,parent,rank,name in [(1, 1, 'no rank', 'root'), (2, 1, 'genus', 'Synthetic')]+[
+                (10+i, 2, 'species', f'Synthetic species {i}') for i in range(genomes)]:
+            nodes.write(f'{taxid}\t|\t{parent}\t|\t{rank}\t|\n')
+            names.write(f'{taxid}\t|\t{name}\t|\t\t|\tscientific name\t|\n')
+    library = os.path.join(folder, 'genomes.fa')
+    with open(library, 'w') as f:
+        for i,sequence in enumerate(sequences):
+            f.write(f'>genome{i}|kraken:taxid|{10+i}\n{sequence}\n')
+    subprocess.run(['kraken2-build', '--add-to-library', library, '--db', db, '--no-masking'],
+        check=True, capture_output=True)
+    subprocess.run(['kraken2-build', '--build', '--db', db, '--threads', str(threads)],
+        check=True, capture_output=True)
+    return db, sequences
+
+def make_samples(folder, samples, pairs, sequences, seed):
+    """Paired FASTQs of reads drawn from sequences (or random), return their
+    kraken2 input arguments"""
+    rng = random.Random(seed)
+    quality = 'I'*READ_LENGTH
+    inputs = []
+    for i in range(samples):
+        files = [os.path.join(folder, f'sample{i}.{mate}.fastq.gz') for mate in (1,2)]
+        with gzip.open(files[0], 'wt', compresslevel=1) as r1, gzip.open(files[1], 'wt', compresslevel=1) as r2:
+            for j in range(pairs):
+                sequence = rng.choice(sequences) if sequences else random_sequence(rng, 1000)
+                start = rng.randrange(len(sequence)-2*READ_LENGTH)
+                r1.write(f'@read{j}/1\n{sequence[start:start+READ_LENGTH]}\n+\n{quality}\n')
+                r2.write(f'@read{j}/2\n{sequence[start+READ_LENGTH:start+2*READ_LENGTH]}\n+\n{quality}\n')
+        inputs.append(f'--paired --gzip-compressed {" ".join(files)}')
+    return inputs
+
+
+class MemoryMonitor:
+    """Peak of used memory (including shared memory) during a run"""
+
+    def __init__(self, period=0.2):
+        self.period = period
+        self.stopped = threading.Event()
+        self.baseline = self.used()
+        self.peak = self.baseline
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    @staticmethod
+    def used():
+        with open('/proc/meminfo', 'r') as f:
+            info = {line.split(':')[0]: int(line.split()[1]) for line in f}
+        return (info['MemTotal']-info['MemAvailable'])*1024
+
+    def _run(self):
+        while not self.stopped.wait(self.period):
+            self.peak = max(self.peak, self.used())
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stopped.set()
+        self.thread.join()
+
+
+def run_tasks(commands, concurrency, output):
+    """Run commands like a worker with that concurrency, return the elapsed
+    time and the peak memory increase"""
+    env = dict(os.environ, CPU=str(max(1, os.cpu_count()//concurrency)))
+    def run(command):
+        subprocess.run(['sh', '-c', command], check=True, cwd=output, env=env,
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    with MemoryMonitor() as monitor:
+        start = time.time()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for _ in executor.map(run, commands):
+                pass
+        elapsed = time.time()-start
+    return elapsed, monitor.peak-monitor.baseline
+
+def bench(db, inputs, output, private_concurrency, shared_concurrency, shared_dir):
+    resource, database = os.path.split(db.rstrip('/'))
+    staged = os.path.join(shared_dir, 'kraken2_bench')
+    private = [kraken2_command(f'sample{i}', input, database=database, output=output, resource=resource)
+                    for i,input in enumerate(inputs)]
+    stage = stage_db_command(database, 'bench', resource=resource, shared_dir=shared_dir)
+    shared = [f'{stage} && {kraken2_command(f"sample{i}", input, output=output, shared=True)}'
+                    for i,input in enumerate(inputs)]
+    for mode,commands,concurrency in [('private', private, private_concurrency),
+                                       ('shared', shared, shared_concurrency)]:
+        shutil.rmtree(staged, ignore_errors=True)
+        try:
+            elapsed, memory = run_tasks(commands, concurrency, output)
+        finally:
+            shutil.rmtree(staged, ignore_errors=True)
+        print(f'{mode:<8} concurrency {concurrency}: {len(commands)} samples in {elapsed:.1f}s, '
+              f'{len(commands)/elapsed*3600:.0f} samples/hour, peak memory +{memory/MB:.0f}MB')
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(
+                    prog = 'Kraken2 shared database benchmark',
+                    description = 'Compare samples per hour of a worker with a private and a shared kraken2 database')
+    parser.add_argument('--db', type=str, default=None,
+        help='A local kraken2 database folder, default to a synthetic one')
+    parser.add_argument('--genomes', type=int, default=50,
+        help='Synthetic database: number of genomes, default to 50')
+    parser.add_argument('--genome-size', type=int, default=1000000,
+        help='Synthetic database: size of each genome, default to 1000000')
+    parser.add_argument('--samples', type=int, default=24,
+        help='Number of samples, default to 24')
+    parser.add_argument('--pairs', type=int, default=100000,
+        help='Read pairs per sample, default to 100000')
+    parser.add_argument('--private-concurrency', type=int, default=1,
+        help='Concurrency with a private database, default to 1')
+    parser.add_argument('--shared-concurrency', type=int, default=SHARED_CONCURRENCY,
+        help=f'Concurrency with the shared database, default to {SHARED_CONCURRENCY}')
+    parser.add_argument('--shared-dir', type=str, default=SHARED_DB_DIR,
+        help=f'Where the shared database is staged, default to {SHARED_DB_DIR}')
+    parser.add_argument('--seed', type=int, default=42,
+        help='Seed of the synthetic data, default to 42')
+    args = parser.parse_args()
+
+    for tool in ['kraken2']+(['kraken2-build'] if args.db is None else []):
+        if shutil.which(tool) is None:
+            sys.exit(f'{tool} is needed')
+    with tempfile.TemporaryDirectory() as folder:
+        if args.db:
+            db, sequences = os.path.abspath(args.db), None
+        else:
+            print('Building a synthetic database')
+            db, sequences = make_synthetic_db(folder, args.genomes, args.genome_size, args.seed,
+                os.cpu_count())
+        inputs = make_samples(folder, args.samples, args.pairs, sequences, args.seed)
+        output = os.path.join(folder, 'output')
+        os.makedirs(output)
+        bench(db, inputs, output, args.private_concurrency, args.shared_concurrency, args.shared_dir)
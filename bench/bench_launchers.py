@@ -0,0 +1,257 @@
+"""Run the launchers end to end offline, against common.fake.SimulatedServer and
+common.fake.FakeStore, on synthetic sources, and report what they cost on the
+launcher side (CPU time, memory) and the simulated makespan.
+
+Each launch runs in its own process (this script with --run), in a temporary
+folder used as working directory and as local cache (SCITQ_EXAMPLES_CACHE):
+
+- the source has one folder per sample with a pair of gzipped FASTQs which
+    sizes follow a log-normal distribution (CAMISIM gets a long format
+    abundance TSV instead),
+- workers are deployed by the launcher as usual (--waves sets how many, so
+    that each worker slot runs about that many tasks), boot in --boot-time,
+- a task downloads its input at --bandwidth then runs for the duration of the
+    tool throughput model (common.autoscale.DEFAULT_MODELS) with log-normal
+    noise, and fails with probability --failure-rate,
+- join polls as usual but its sleeps are instant (common.fake.SimulatedClock).
+
+CPU time is the launcher process CPU time (and its children) minus the time
+spent in the simulated server and store (fake); memory is the peak resident
+size of the launcher process (setup being the peak before the launch, with the
+synthetic source in memory)."""
+import argparse
+import resource
+import tempfile
+import random
+import json
+import math
+import time
+import sys
+import os
+import subprocess
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+from common.fake import SimulatedClock, SimulatedServer, FakeStore
+from common.autoscale import DEFAULT_MODELS, GB
+
+SAMPLES = [10, 1000, 50000]
+SOURCE = 's3://bench/input'
+OUTPUT = 's3://bench/output'
+DEFAULT_MEDIAN_SIZE = 2*GB
+DEFAULT_SIZE_SIGMA = 0.6
+DEFAULT_NOISE = 0.2
+DEFAULT_BANDWIDTH = 100*1024**2
+DEFAULT_BOOT_TIME = 300
+DEFAULT_WAVES = 8
+DEFAULT_SEED = 42
+# a CAMISIM sample: how many species, and how long its simulation lasts (in seconds)
+CAMISIM_SPECIES = 50
+CAMISIM_DURATION = 3*3600
+
+# script: (launcher folder, throughput model, worker concurrency)
+SCRIPTS = {
+    'kraken2': ('kraken2', 'kraken2', 1),
+    'motus3': ('motus3', 'motus3', 8),
+    'metaphlan4': ('metaphlan4', 'metaphlan4', 4),
+    'metaphlan4_filter': ('metaphlan4', 'metaphlan4_filter', 4),
+    'profilers': ('profilers', 'profilers', 1),
+    'camisim': ('camisim', None, 9),
+}
+
+
+def populate(store, samples, median_size, sigma, seed):
+    """Create the synthetic source: a pair of FASTQs per sample"""
+    rng = random.Random(seed)
+    for i in range(samples):
+        sample = f'sample{i:06d}'
+        size = int(rng.lognormvariate(math.log(median_size), sigma))
+        for mate in (1,2):
+            store.add(f'{SOURCE}/{sample}/{sample}.{mate}.fastq.gz', size//2)
+    for archive in ['kraken2.tgz', 'motus.tgz', 'metaphlan.tgz', 'chm13v2.0.tgz', 'genomes.tar.gz']:
+        store.add(f's3://bench/resource/{archive}', 50*GB)
+
+def write_abundances(filename, samples, seed):
+    """A long format CAMISIM abundance file"""
+    rng = random.Random(seed)
+    with open(filename, 'w') as f:
+        f.write('specie\tsample\tabundance\n')
+        for i in range(samples):
+            for specie in rng.sample(range(CAMISIM_SPECIES*20), CAMISIM_SPECIES):
+                f.write(f'specie{specie:05d}\tsample{i:06d}\t{rng.random():.6f}\n')
+
+def duration_model(store, tool, bandwidth, noise, seed):
+    """Return a SimulatedServer duration function for tasks of a tool"""
+    rng = random.Random(seed)
+    overhead, seconds_per_gb = DEFAULT_MODELS[tool] if tool else (CAMISIM_DURATION, 0)
+    def duration(task):
+        size = sum(store.size(uri) for uri in (task['input'] or '').split())
+        return size/bandwidth, (overhead+size/GB*seconds_per_gb)*rng.lognormvariate(0, noise)
+    return duration
+
+
+class Metered:
+    """Proxy an object, counting the CPU time spent in its methods"""
+
+    def __init__(self, target):
+        self.target = target
+        self.cpu_time = 0
+
+    def __getattr__(self, name):
+        attribute = getattr(self.target, name)
+        if not callable(attribute):
+            return attribute
+        def metered(*args, **kwargs):
+            start = time.thread_time()
+            try:
+                return attribute(*args, **kwargs)
+            finally:
+                self.cpu_time += time.thread_time()-start
+        return metered
+
+
+MODULES = {'kraken2': 'scitq_kraken2', 'motus3': 'scitq_motus3', 'metaphlan4': 'scitq_metaphlan4',
+    'metaphlan4_filter': 'scitq_metaphlan4_filter', 'profilers': 'scitq_profilers',
+    'camisim': 'scitq_camisim'}
+
+def prepare(script, samples, workers, server, store):
+    """Import script, make it use server and store, return a function
+    launching it through its python API"""
+    folder, _, _ = SCRIPTS[script]
+    sys.path.insert(0, os.path.join(ROOT, folder))
+    module = __import__(MODULES[script])
+    # the launchers imported scitq.fetch functions, they are replaced everywhere
+    FakeStore.install(store)
+    def fake_server(ip, style='dict', **args):
+        # on the simulated server itself, not on its Metered proxy
+        server.target.style = style
+        return server
+    module.Server = fake_server
+
+    if script=='kraken2':
+        return lambda: module.kraken2('fake', SOURCE, OUTPUT, 's3://bench/resource/kraken2.tgz',
+            fastq=True, batch='bench', workers=workers)
+    elif script=='motus3':
+        return lambda: module.motus('fake', 'bench', SOURCE, OUTPUT, 's3://bench/resource/motus.tgz',
+            workers=workers)
+    elif script=='metaphlan4':
+        return lambda: module.metaphlan4('fake', 'bench', SOURCE, OUTPUT, f'{OUTPUT}_final',
+            's3://bench/resource/metaphlan.tgz', workers=workers)
+    elif script=='metaphlan4_filter':
+        return lambda: module.metaphlan4('fake', 'bench', SOURCE, OUTPUT, f'{OUTPUT}_final',
+            's3://bench/resource/metaphlan.tgz', 's3://bench/resource/chm13v2.0.tgz',
+            workers=workers)
+    elif script=='profilers':
+        return lambda: module.profilers('fake', 'bench', SOURCE, OUTPUT, ['kraken2', 'motus3', 'metaphlan4'],
+            'profilers:latest', kraken_s3='s3://bench/resource/kraken2.tgz',
+            motus_s3='s3://bench/resource/motus.tgz', metaphlan_s3='s3://bench/resource/metaphlan.tgz',
+            workers=workers)
+    elif script=='camisim':
+        return lambda: module.CamisimHelper(name='bench', samples='abundances.tsv',
+            genome_source='s3://bench/resource/genomes.tar.gz', seed=DEFAULT_SEED,
+            s3_camisim_config_folder='s3://bench/config', scitq_server='fake',
+            region='WAW1', flavor='i1-180', provider='ovh', s3_camisim_output=OUTPUT,
+            workers=workers, depth=20, sparse=True, direct_upload=True)
+
+def cpu_time():
+    """CPU time of this process and its (finished) children"""
+    return sum(usage.ru_utime+usage.ru_stime for usage in
+        (resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN)))
+
+def run(script, samples, options):
+    """Launch script in this process and print its metrics as JSON"""
+    _, tool, concurrency = SCRIPTS[script]
+    workers = max(1, math.ceil(samples/(concurrency*options.waves)))
+    import common.join
+    clock = SimulatedClock()
+    common.join.time = clock
+    store = FakeStore(latency=options.store_latency, failure_rate=options.store_failure_rate,
+        seed=options.seed)
+    if script=='camisim':
+        populate(store, 0, 0, 0, options.seed)
+        write_abundances('abundances.tsv', samples, options.seed)
+    else:
+        populate(store, samples, options.median_size*GB, options.size_sigma, options.seed)
+    server = SimulatedServer(latency=options.latency, clock=clock,
+        duration=duration_model(store, tool, options.bandwidth*1024**2, options.noise, options.seed),
+        failure_rate=options.failure_rate, boot_time=options.boot_time, seed=options.seed)
+    metered_server = Metered(server)
+    metered_store = Metered(store)
+    launcher = prepare(script, samples, workers, metered_server, metered_store)
+
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    cpu_start = cpu_time()
+    start = clock.time()
+    # the output of the launchers is not part of the benchmark
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        launcher()
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+    makespan = clock.time()-start
+    fake_cpu = metered_server.cpu_time+metered_store.cpu_time
+    print(json.dumps({'script': script, 'samples': samples, 'workers': workers,
+        'tasks': len(server.tasks_by_id), 'executions': len(server.executions_list),
+        'failures': server.failures, 'requests': store.calls,
+        'cpu': cpu_time()-cpu_start-fake_cpu, 'fake_cpu': fake_cpu,
+        'peak_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024,
+        'setup_rss': baseline/1024, 'makespan': makespan}))
+
+def bench(scripts, sample_counts, options, argv):
+    print(f'{"script":<18} {"samples":>7} {"workers":>7} {"tasks":>7} {"execs":>7} '
+          f'{"cpu (s)":>8} {"fake (s)":>8} {"rss (MB)":>8} {"setup":>8} {"makespan":>9}')
+    for samples in sample_counts:
+        for script in scripts:
+            with tempfile.TemporaryDirectory() as work_dir:
+                env = dict(os.environ, SCITQ_EXAMPLES_CACHE=os.path.join(work_dir, 'cache'))
+                process = subprocess.run([sys.executable, os.path.abspath(__file__),
+                        '--run', script, str(samples)]+argv,
+                    cwd=work_dir, env=env, capture_output=True, text=True)
+            if process.returncode!=0:
+                print(f'{script:<18} {samples:>7} failed:\n{process.stderr}')
+                continue
+            r = json.loads(process.stdout.splitlines()[-1])
+            print(f'{script:<18} {samples:>7} {r["workers"]:>7} {r["tasks"]:>7} {r["executions"]:>7} '
+                  f'{r["cpu"]:>8.2f} {r["fake_cpu"]:>8.2f} {r["peak_rss"]:>8.0f} {r["setup_rss"]:>8.0f} {r["makespan"]/3600:>8.1f}h')
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(
+                    prog = 'Launchers benchmark',
+                    description = 'Run the launchers end to end against a simulated scitq server and object store')
+    parser.add_argument('--scripts', type=str, nargs='+', choices=list(SCRIPTS), default=list(SCRIPTS),
+        help='Which launchers to run, default to all of them')
+    parser.add_argument('--samples', type=int, nargs='+', default=SAMPLES,
+        help=f'Source sizes (number of samples), default to {" ".join(map(str, SAMPLES))}')
+    parser.add_argument('--waves', type=int, default=DEFAULT_WAVES,
+        help=f'Workers are deployed so that each slot runs about that many tasks, default to {DEFAULT_WAVES}')
+    parser.add_argument('--latency', type=float, default=0,
+        help='Simulated scitq server round trip (in seconds), default to 0')
+    parser.add_argument('--store-latency', type=float, default=0,
+        help='Simulated object store round trip (in seconds), default to 0')
+    parser.add_argument('--store-failure-rate', type=float, default=0,
+        help='Probability that an object store request is retried, default to 0')
+    parser.add_argument('--failure-rate', type=float, default=0.02,
+        help='Probability that a task execution fails, default to 0.02')
+    parser.add_argument('--boot-time', type=float, default=DEFAULT_BOOT_TIME,
+        help=f'Worker boot time (in seconds), default to {DEFAULT_BOOT_TIME}')
+    parser.add_argument('--bandwidth', type=float, default=DEFAULT_BANDWIDTH/1024**2,
+        help=f'Task download speed in MB/s, default to {DEFAULT_BANDWIDTH/1024**2:g}')
+    parser.add_argument('--median-size', type=float, default=DEFAULT_MEDIAN_SIZE/GB,
+        help=f'Median sample size in GB, default to {DEFAULT_MEDIAN_SIZE/GB:g}')
+    parser.add_argument('--size-sigma', type=float, default=DEFAULT_SIZE_SIGMA,
+        help=f'Log-normal sigma of sample sizes, default to {DEFAULT_SIZE_SIGMA}')
+    parser.add_argument('--noise', type=float, default=DEFAULT_NOISE,
+        help=f'Log-normal sigma of task durations around the throughput model, default to {DEFAULT_NOISE}')
+    parser.add_argument('--seed', type=int, default=DEFAULT_SEED,
+        help=f'Seed of the synthetic source and of the simulation, default to {DEFAULT_SEED}')
+    parser.add_argument('--run', type=str, nargs=2, default=None, metavar=('SCRIPT', 'SAMPLES'),
+        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        run(args.run[0], int(args.run[1]), args)
+    else:
+        # options are passed as is to each launch
+        bench(args.scripts, args.samples, args, sys.argv[1:])
@@ -0,0 +1,86 @@
+"""Time for a new worker to have its resource ready (and thus start its first
+task), with the archive (download then single-stream extraction, what
+`|untar` does) and with the prepared folder (common.resources), files being
+copied in parallel without decompression.
+
+Without archive URI, a synthetic database (several compressible files) is
+created and prepared in a local folder."""
+from scitq.fetch import get, list_content
+import concurrent.futures
+import tempfile
+import argparse
+import shutil
+import time
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.resources import prepare, extract
+
+# what rclone uses by default
+PARALLEL_TRANSFERS = 4
+MB = 1024**2
+
+
+def make_synthetic(folder, size, files):
+    """A synthetic tgz database of size MB in that many files"""
+    content = os.path.join(folder, 'synthetic')
+    os.makedirs(os.path.join(content, 'db'))
+    block = os.urandom(MB//4)
+    for i in range(files):
+        with open(os.path.join(content, 'db', f'part{i}.bin'), 'wb') as f:
+            for _ in range(size//files):
+                # half random, half repeated: compresses like a real index
+                f.write(block)
+                f.write(os.urandom(MB//4))
+                f.write(bytes(MB//2))
+    archive = os.path.join(folder, 'synthetic.tgz')
+    shutil.make_archive(archive[:-4], 'gztar', content)
+    os.rename(archive[:-4]+'.tar.gz', archive)
+    shutil.rmtree(content)
+    return 'file://'+archive
+
+def with_archive(archive, destination):
+    local_archive = os.path.join(destination, os.path.basename(archive))
+    get(archive, local_archive)
+    extract(local_archive, destination)
+    os.remove(local_archive)
+
+def with_folder(folder, destination):
+    if folder.startswith('file://'):
+        # scitq.fetch does not copy file:// folders, do what rclone does
+        with concurrent.futures.ThreadPoolExecutor(max_workers=PARALLEL_TRANSFERS) as executor:
+            for item in list_content(folder):
+                target = os.path.join(destination, item.rel_name)
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                executor.submit(get, item.name, target)
+    else:
+        get(folder, destination+'/')
+
+def timed(function, uri):
+    with tempfile.TemporaryDirectory() as destination:
+        start = time.time()
+        function(uri, destination)
+        return time.time()-start
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(
+                    prog = 'Resource benchmark',
+                    description = 'Compare the time to get a resource ready with the archive and with its prepared folder')
+    parser.add_argument('archive', type=str, nargs='?', default=None,
+        help='Archive URI (it is prepared if needed), a synthetic one is used if not provided')
+    parser.add_argument('--size', type=int, default=512,
+        help='Size of the synthetic database in MB, default to 512')
+    parser.add_argument('--files', type=int, default=8,
+        help='Number of files of the synthetic database, default to 8')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        archive = args.archive or make_synthetic(temp_dir, args.size, args.files)
+        folder = prepare(archive)
+        before = timed(with_archive, archive)
+        after = timed(with_folder, folder)
+        print(f'archive (download + untar):     {before:.1f}s')
+        print(f'prepared folder (parallel copy): {after:.1f}s')
+        print(f'speedup:                         {before/max(after,1e-6):.1f}x')
@@ -0,0 +1,48 @@
+"""Compare one task_create round trip per sample with TaskSubmitter, offline,
+against common.fake.FakeServer."""
+import argparse
+import time
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.fake import FakeServer, DEFAULT_LATENCY
+from common.submission import TaskSubmitter, DEFAULT_PARALLEL, DEFAULT_CHUNK_SIZE
+
+def task_spec(i):
+    return dict(command=f"sh -c 'echo {i}'", name=f'sample{i}', batch='bench',
+        input=f's3://bucket/input/sample{i}/', output=f's3://bucket/output/sample{i}',
+        container='alpine')
+
+def bench(tasks, latency, parallel, chunk_size):
+    s = FakeServer(latency=latency)
+    start = time.time()
+    sequential = [s.task_create(**task_spec(i)) for i in range(tasks)]
+    sequential_time = time.time()-start
+
+    s = FakeServer(latency=latency)
+    submitter = TaskSubmitter(s, parallel=parallel, chunk_size=chunk_size)
+    start = time.time()
+    for i in range(tasks):
+        submitter.submit(**task_spec(i))
+    batched = submitter.wait()
+    batched_time = time.time()-start
+
+    assert [task['name'] for task in batched]==[task['name'] for task in sequential]
+    print(f'{tasks} tasks, {latency*1000:.0f}ms latency: sequential {sequential_time:.2f}s ({tasks/sequential_time:.0f} tasks/s), '
+          f'batched {batched_time:.2f}s ({tasks/batched_time:.0f} tasks/s), x{sequential_time/batched_time:.1f}')
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(
+                    prog = 'Submission benchmark',
+                    description = 'Benchmark task submission against a fake scitq server')
+    parser.add_argument('--tasks', type=int, default=1000,
+        help='How many tasks to submit, default to 1000')
+    parser.add_argument('--latency', type=float, default=DEFAULT_LATENCY,
+        help=f'Simulated round trip time in seconds, default to {DEFAULT_LATENCY}')
+    parser.add_argument('--parallel', type=int, default=DEFAULT_PARALLEL,
+        help=f'TaskSubmitter parallel option, default to {DEFAULT_PARALLEL}')
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE,
+        help=f'TaskSubmitter chunk_size option, default to {DEFAULT_CHUNK_SIZE}')
+    args = parser.parse_args()
+    bench(args.tasks, args.latency, args.parallel, args.chunk_size)
@@ -0,0 +1,53 @@
+"""Replay recorded task durations to compare task orderings, without cloud access.
+
+The input is the timings file of a run written by common.join
+(~/.cache/scitq-examples/timings/<batch>.tsv): its succeeded tasks are replayed
+in the order they were created (by task_id), with their input size and the
+duration of their last execution. Any TSV file with a header and at least
+name, size (bytes of input) and duration (seconds) columns, in creation order,
+can also be used."""
+import argparse
+import csv
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.scheduling import simulate, lower_bound
+
+def read_durations(filename):
+    with open(filename, 'r') as f:
+        lines = list(csv.DictReader(f, dialect=csv.excel_tab))
+    if lines and 'task_id' in lines[0]:
+        # a timings file, written as tasks end: failed tasks (and tasks with
+        # no known size) have nothing to replay
+        lines = sorted((line for line in lines if line['status']=='succeeded'
+                            and line['size'] and line['duration']),
+                        key=lambda line: int(line['task_id']))
+    return [(line['name'], float(line['size']), float(line['duration'])) for line in lines]
+
+def hours(seconds):
+    return f'{seconds/3600:.2f}h'
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(
+                    prog = 'Makespan simulator',
+                    description = 'Compare the makespan of different task orderings on recorded durations')
+    parser.add_argument('durations', type=str,
+        help='The timings file of a run (timings/<batch>.tsv in the local cache), or a TSV file with name, size and duration columns')
+    parser.add_argument('--workers', type=int, default=5,
+        help='Number of workers, default to 5')
+    parser.add_argument('--concurrency', type=int, default=1,
+        help='Concurrency of each worker, default to 1')
+    args = parser.parse_args()
+
+    tasks = read_durations(args.durations)
+    slots = args.workers*args.concurrency
+    as_listed = [duration for _,_,duration in tasks]
+    by_size = [duration for _,_,duration in sorted(tasks, key=lambda task: task[1], reverse=True)]
+    by_duration = sorted(as_listed, reverse=True)
+
+    print(f'{len(tasks)} tasks on {args.workers} worker(s) x {args.concurrency}')
+    print(f'listing order:            {hours(simulate(as_listed, slots))}')
+    print(f'largest input first:      {hours(simulate(by_size, slots))}')
+    print(f'longest duration first:   {hours(simulate(by_duration, slots))}')
+    print(f'lower bound:              {hours(lower_bound(as_listed, slots))}')
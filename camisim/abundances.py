@@ -0,0 +1,129 @@
+"""On-disk sparse abundance matrices for CAMISIM designs.
+
+The abundance TSV file is converted once, in two streaming passes (the first
+one counts the non-null abundances of each sample, the second one fills them
+in), into a compressed sparse column store: for each sample, the indexes of
+its species and their abundances. Memory during the conversion only depends on
+the number of samples and species, not on the size of the matrix. The store is
+memory mapped so that a sample composition is read without reading the others,
+and it is kept in the local cache, keyed by the TSV file identity, so that a
+relaunch (like with --resume) does not convert it again."""
+import hashlib
+import shutil
+import csv
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common import CACHE_DIR
+
+STORE_DIR = os.path.join(CACHE_DIR, 'camisim')
+
+
+def _dense_entries(filename, samples):
+    """Yield (specie, sample indexes, abundances) for each line of a TSV
+    abundance matrix (a column per sample, a line per specie), only with the
+    non-null abundances, samples being filled with sample -> index"""
+    with open(filename, 'r') as f:
+        reader = csv.reader(f, dialect=csv.excel_tab)
+        for sample in next(reader)[1:]:
+            samples.setdefault(sample, len(samples))
+        for fields in reader:
+            values = np.array([field or 0.0 for field in fields[1:]], dtype=np.float64)
+            values[np.isnan(values)] = 0.0
+            indexes = np.flatnonzero(values)
+            yield fields[0], indexes, values[indexes]
+
+def _sparse_entries(filename, samples):
+    """Same as _dense_entries for a long format TSV with a header and specie,
+    sample and abundance columns"""
+    with open(filename, 'r') as f:
+        for line in csv.DictReader(f, dialect=csv.excel_tab):
+            abundance = float(line['abundance'] or 0.0)
+            if abundance!=0.0 and abundance==abundance:
+                sample = samples.setdefault(line['sample'], len(samples))
+                yield line['specie'], np.array([sample]), np.array([abundance])
+
+
+def _convert(filename, sparse, store):
+    entries = _sparse_entries if sparse else _dense_entries
+    samples = {}
+    species = {}
+    counts = np.zeros(0, dtype=np.int64)
+    for specie,indexes,_ in entries(filename, samples):
+        species.setdefault(specie, len(species))
+        if len(samples)>len(counts):
+            counts = np.concatenate((counts, np.zeros(len(samples)-len(counts), dtype=np.int64)))
+        np.add.at(counts, indexes, 1)
+    counts = np.concatenate((counts, np.zeros(len(samples)-len(counts), dtype=np.int64)))
+    indptr = np.concatenate(([0], np.cumsum(counts)))
+    nnz = int(indptr[-1])
+    rows = np.lib.format.open_memmap(os.path.join(store, 'rows.npy'), mode='w+',
+        dtype=np.int32, shape=(nnz,))
+    values = np.lib.format.open_memmap(os.path.join(store, 'values.npy'), mode='w+',
+        dtype=np.float64, shape=(nnz,))
+    cursor = indptr[:-1].copy()
+    for specie,indexes,abundances in entries(filename, {}):
+        rows[cursor[indexes]] = species[specie]
+        values[cursor[indexes]] = abundances
+        cursor[indexes] += 1
+    rows.flush()
+    values.flush()
+    np.save(os.path.join(store, 'indptr.npy'), indptr)
+    for name,names in [('samples.txt', samples), ('species.txt', species)]:
+        with open(os.path.join(store, name), 'w') as f:
+            f.writelines(f'{item}\n' for item in names)
+
+
+def convert(filename, sparse=False, refresh=False):
+    """Convert an abundance TSV file (in long format if sparse) to a store,
+    unless it was already done, and return the store path"""
+    info = os.stat(filename)
+    key = hashlib.sha1(f'{os.path.abspath(filename)}|{info.st_size}|{info.st_mtime}|{sparse}'.encode('utf-8')).hexdigest()
+    store = os.path.join(STORE_DIR, key)
+    if os.path.isdir(store) and not refresh:
+        return store
+    print(f'Converting {filename}')
+    temp_store = store+'.tmp'
+    shutil.rmtree(temp_store, ignore_errors=True)
+    os.makedirs(temp_store)
+    _convert(filename, sparse, temp_store)
+    shutil.rmtree(store, ignore_errors=True)
+    os.replace(temp_store, store)
+    return store
+
+
+class AbundanceStore:
+    """Read only access to a store created by convert"""
+
+    def __init__(self, store):
+        self.store = store
+        with open(os.path.join(store, 'samples.txt'), 'r') as f:
+            self.samples = [line.rstrip('\n') for line in f]
+        self.index = {sample:i for i,sample in enumerate(self.samples)}
+        with open(os.path.join(store, 'species.txt'), 'r') as f:
+            self.species = np.array([line.rstrip('\n') for line in f], dtype=object)
+        self.indptr = np.load(os.path.join(store, 'indptr.npy'))
+        self.rows = np.load(os.path.join(store, 'rows.npy'), mmap_mode='r')
+        self.values = np.load(os.path.join(store, 'values.npy'), mmap_mode='r')
+
+    def __len__(self):
+        return len(self.samples)
+
+    def genome_count(self, sample):
+        i = self.index[sample]
+        return int(self.indptr[i+1]-self.indptr[i])
+
+    def composition(self, sample):
+        """Return (species, abundances) of a sample, only with non-null
+        abundances, normalized so that they sum to 1"""
+        i = self.index[sample]
+        start, end = self.indptr[i], self.indptr[i+1]
+        abundances = np.array(self.values[start:end])
+        return self.species[self.rows[start:end]], abundances/abundances.sum()
+
+    def genomes(self):
+        """Species present in at least one sample"""
+        return set(self.species[np.bincount(self.rows, minlength=len(self.species))>0])
@@ -2,13 +2,22 @@
 # https://wiki.gmt.bio/doku.php?id=dataset:camisim
 
 import csv
-import pandas as pd
+import concurrent.futures
+import tempfile
 import os
 from subprocess import run
 from scitq.lib import Server
 import scitq.fetch
 import argparse
 import math
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.submission import TaskSubmitter
+from common.resume import ResumeIndex
+from common.join import join
+from common.resources import resource_uri
+from abundances import convert, AbundanceStore
 
 DEFAULT_BATCH = "my_camisim"
 DEFAULT_REGION = {"ovh":"WAW1", "azure":"swedencentral"}
@@ -17,6 +26,11 @@ DEFAULT_WORKERS = 5
 DEFAULT_SEED = 42
 DEFAULT_CONCURRENCY = 9
 DEFAULT_DEPTH = 20
+MAX_PARALLEL_UPLOAD = 16
+# shard i of a sample uses seed*SHARD_SEED_FACTOR+i
+SHARD_SEED_FACTOR = 1000
+# where the reads of a sharded sample are concatenated (in {output}/{sample}/)
+SHARDED_READS = 'sharded_sample_0/reads/anonymous_reads.fq.gz'
 
 SAMPLE_SUBDIR = 'samples'
 CONFIG_INI = """[Main]
@@ -69,22 +83,72 @@ def read_tsv(filename):
         for line in csv_file:
             yield line
 
+# the stores opened by the current process
+_stores = {}
+
+def sample_size(depth):
+    """CAMISIM sample size (in GB) for a depth"""
+    # size in GB equal depth * 10^3 * 150 (read size) / 10^9, i.e. detph * 0.15
+    return math.ceil( depth * 0.15 )
+
+def write_store_sample_files(store, sample_dir, sample, seed, job_threads, size):
+    """Write CAMISIM input files for a sample of an abundances.AbundanceStore"""
+    if store not in _stores:
+        _stores[store] = AbundanceStore(store)
+    species, abundances = _stores[store].composition(sample)
+    return write_sample_files(sample_dir, sample, species, abundances, seed, job_threads, size)
+
+def sample_files(sample, species, abundances, seed, job_threads, size):
+    """Return CAMISIM input files for a sample, as a dict file name -> content,
+    size being the sample size in GB (see sample_size)"""
+    return {
+        'composition.tsv': ''.join(f'{specie}\t{abundance!r}\n'
+                                for specie,abundance in zip(species, abundances.tolist())),
+        'id_to_genome.tsv': ''.join(f'{specie}\t{os.path.join("/resource/genomes", str(specie))}.fa\n'
+                                for specie in species),
+        'metadata.tsv': 'genome_ID\tOTU\tNCBI_ID\tnovelty_category\n'+''.join(
+                                f'{specie}\tOTU_{i+1}\t22\tknown strain\n' for i,specie in enumerate(species)),
+        'config.ini': CONFIG_INI.format(
+            seed=seed,
+            concurrency=job_threads,
+            name=sample,
+            composition_file='composition.tsv',
+            metadata_file='metadata.tsv',
+            id_to_genome_file='id_to_genome.tsv',
+            genomes=len(species),
+            size=size
+        )
+    }
+
+def write_sample_files(sample_dir, sample, species, abundances, seed, job_threads, size):
+    """Write CAMISIM input files for a sample"""
+    os.makedirs(sample_dir, exist_ok=True)
+    for file_name,content in sample_files(sample, species, abundances, seed, job_threads, size).items():
+        with open(os.path.join(sample_dir, file_name),'w') as f:
+            f.write(content)
+    return sample
+
 class CamisimHelper:
     """A small helper to prepare for CAMISIM simulation
     """
 
     def __init__(self, name, samples, genome_source, seed, s3_camisim_config_folder, 
-            scitq_server, region, flavor, provider, s3_camisim_output, workers, depth, job_threads=4):
+            scitq_server, region, flavor, provider, s3_camisim_output, workers, depth, job_threads=4,
+            resume=False, sparse=False, direct_upload=False, shards=1):
         print('Initializing')
         self.name = name
-        with open(samples,'r') as sample_file:
-            self.samples = pd.read_csv(sample_file, sep='\t', index_col=0).fillna(0.0)
+        self.store = convert(samples, sparse=sparse)
+        self.abundances = AbundanceStore(self.store)
         self.genome_source = genome_source
+        self.genome_resource = resource_uri(genome_source)
         self.seed = seed
         self.job_threads = job_threads
         self.workers = workers
         self.depth = depth
-        self.genomes = []
+        self.resume = resume
+        self.direct_upload = direct_upload
+        self.shards = shards
+        self.genomes = set()
         if s3_camisim_config_folder.endswith('/'):
             s3_camisim_config_folder = s3_camisim_config_folder[:-1]
         self.s3_camisim_config_folder = s3_camisim_config_folder
@@ -99,72 +163,150 @@ class CamisimHelper:
         self.run()
 
 
+    def simulations(self, sample):
+        """Return the (subfolder, seed, size) of each CAMISIM simulation of a
+        sample: a single one unless it is sharded, in which case each shard
+        simulates an equal part of the sample size with its own seed (shard
+        sizes are not rounded, so that the sample size does not depend on the
+        number of shards)"""
+        size = sample_size(self.depth)
+        if self.shards<=1:
+            return [('', self.seed, size)]
+        return [(f'shard{i}', self.seed*SHARD_SEED_FACTOR+i, size/self.shards)
+                    for i in range(self.shards)]
+
     def make_files(self):
         print('Building files')
-        os.mkdir(SAMPLE_SUBDIR)
-        for sample in self.samples.columns:
-            sample_dir = os.path.join(SAMPLE_SUBDIR, sample)
-            if not os.path.isdir(sample_dir):
-                os.mkdir(sample_dir)
-            composition = self.samples[sample]
-            composition = composition[composition!=0.0]
-            composition = composition/composition.sum()
-            composition.to_csv(f'{sample_dir}/composition.tsv', header=False, sep='\t')
-            with open(f'{sample_dir}/id_to_genome.tsv','w') as f:
-                for specie in composition.index:
-                    if not pd.isna(specie) and specie not in self.genomes:
-                        self.genomes.append(specie)
-                    f.write(f'{specie}\t{os.path.join("/resource/genomes", specie)}.fa\n')
-            with open(f'{sample_dir}/metadata.tsv','w') as f:
-                f.write('genome_ID\tOTU\tNCBI_ID\tnovelty_category\n')
-                for i,specie in enumerate(composition.index):
-                    f.write(f'{specie}\tOTU_{i+1}\t22\tknown strain\n')
-            with open(f'{sample_dir}/config.ini','w') as f:
-                f.write(CONFIG_INI.format(
-                    seed=self.seed,
-                    concurrency=self.job_threads,
-                    name=sample,
-                    composition_file='composition.tsv',
-                    metadata_file='metadata.tsv',
-                    id_to_genome_file='id_to_genome.tsv',
-                    genomes=len(composition),
-                    # size in GB equal depth * 10^3 * 150 (read size) / 10^9, i.e. detph * 0.15
-                    size = math.ceil( self.depth * 0.15 )
-                ))
+        os.makedirs(SAMPLE_SUBDIR, exist_ok=True)
+        self.genomes = self.abundances.genomes()-{''}
+        with concurrent.futures.ProcessPoolExecutor() as executor:
+            futures = [executor.submit(write_store_sample_files, self.store,
+                            os.path.join(SAMPLE_SUBDIR, sample, subfolder), sample,
+                            seed, self.job_threads, size)
+                        for sample in self.abundances.samples
+                        for subfolder,seed,size in self.simulations(sample)]
+            for future in futures:
+                future.result()
             
     def push_to_s3(self):
         print('Pushing to s3')
         scitq.fetch.sync(SAMPLE_SUBDIR, self.s3_camisim_config_folder)
     
+    def upload_sample(self, sample):
+        """Generate a sample files and upload them directly to its config folder"""
+        species, abundances = self.abundances.composition(sample)
+        with tempfile.TemporaryDirectory() as temp_dir:
+            for subfolder,seed,size in self.simulations(sample):
+                folder = '/'.join(filter(None, [self.s3_camisim_config_folder, sample, subfolder]))
+                for file_name,content in sample_files(sample, species, abundances, seed,
+                                            self.job_threads, size).items():
+                    local_file = os.path.join(temp_dir, file_name)
+                    with open(local_file, 'w') as f:
+                        f.write(content)
+                    scitq.fetch.put(local_file, f'{folder}/{file_name}')
+        return sample
+
+    def upload(self, samples):
+        """Upload samples files in parallel, yield each sample as soon as its
+        files are uploaded"""
+        print('Uploading files')
+        self.genomes = self.abundances.genomes()-{''}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_PARALLEL_UPLOAD) as executor:
+            futures = [executor.submit(self.upload_sample, sample) for sample in samples]
+            for future in concurrent.futures.as_completed(futures):
+                yield future.result()
+
     def create_tasks(self):
         print('Launching tasks')
-        self.tasks = []
-        for sample in self.samples.columns:
-            self.tasks.append(
-                self.s.task_create(
+        # CAMISIM writes its reads in {output}/{sample}/<date>_sample_0/reads/
+        resume_index = ResumeIndex(self.s3_camisim_output,
+            ['{sample}/*/reads/anonymous_reads.fq.gz'], resume=self.resume)
+        submitter = TaskSubmitter(self.s)
+        # CAMISIM duration grows with the number of genomes in the sample,
+        # the most complex samples are launched first
+        samples = [sample for sample in sorted(self.abundances.samples,
+                            key=self.abundances.genome_count, reverse=True)
+                        if not resume_index.skip(sample)]
+        if self.direct_upload:
+            if samples:
+                # tasks are created as soon as their files are uploaded
+                self.deploy()
+            samples = self.upload(samples)
+        sharded = []
+        for sample in samples:
+            if self.shards<=1:
+                submitter.submit(
                     command=f"-c 'python3 metagenomesimulation.py /input/config.ini > /dev/null'",
                     container_options="--entrypoint sh",
                     name=sample,
                     batch=self.name,
                     input=f"{self.s3_camisim_config_folder}/{sample}/",
-                    resource=f"{self.genome_source}|untar",
+                    resource=self.genome_resource,
                     output=f'{self.s3_camisim_output}/{sample}/',
                     container=DOCKER_IMAGE
                 )
+                continue
+            # each shard keeps only its reads, under a name of its own
+            ranks = [submitter.submit(
+                    command=f"-c 'python3 metagenomesimulation.py /input/config.ini > /dev/null && mv /output/*/reads/anonymous_reads.fq.gz /output/{subfolder}_anonymous_reads.fq.gz'",
+                    container_options="--entrypoint sh",
+                    name=f'{sample}_{subfolder}',
+                    batch=self.name,
+                    input=f"{self.s3_camisim_config_folder}/{sample}/{subfolder}/",
+                    resource=self.genome_resource,
+                    output=f'{self.s3_camisim_output}/{sample}/{subfolder}/',
+                    container=DOCKER_IMAGE
+                ) for subfolder,_,_ in self.simulations(sample)]
+            sharded.append((sample, ranks))
+        self.tasks = submitter.wait()
+        resume_index.save()
+        # shard task_id -> its concatenation task_id
+        self.dependents = {}
+        if sharded:
+            self.tasks += self.create_concat_tasks(sharded)
+
+    def create_concat_tasks(self, sharded):
+        """Create the tasks concatenating the reads of each sharded sample,
+        prefixing read names with the shard so that they stay unique (a
+        concatenation task is failed by join if one of its shards failed)"""
+        submitter = TaskSubmitter(self.s)
+        for sample,ranks in sharded:
+            subfolders = [subfolder for subfolder,_,_ in self.simulations(sample)]
+            submitter.submit(
+                command=f"""-c 'mkdir -p /output/{os.path.dirname(SHARDED_READS)} && for shard in {' '.join(subfolders)}; do zcat /input/${{shard}}_anonymous_reads.fq.gz | sed "1~4s/^@/@${{shard}}_/"; done | gzip > /output/{SHARDED_READS}'""",
+                container_options="--entrypoint sh",
+                name=f'{sample}_concat',
+                batch=self.name,
+                input=' '.join(f'{self.s3_camisim_output}/{sample}/{subfolder}/{subfolder}_anonymous_reads.fq.gz'
+                                for subfolder in subfolders),
+                output=f'{self.s3_camisim_output}/{sample}/',
+                required_task_ids=[self.tasks[rank]['task_id'] for rank in ranks],
+                container=DOCKER_IMAGE
             )
+        tasks = submitter.wait()
+        for (_,ranks),task in zip(sharded, tasks):
+            for rank in ranks:
+                self.dependents[self.tasks[rank]['task_id']] = [task['task_id']]
+        return tasks
     
-    def launch(self):
+    def deploy(self):
         if self.workers>0:
             self.s.worker_deploy(region=self.region, 
                 flavor=self.flavor,
                 provider=self.provider, 
                 number=self.workers, batch=self.name,
                 concurrency=DEFAULT_CONCURRENCY)
-        self.s.join(self.tasks, retry=2)
+
+    def launch(self):
+        if self.tasks and not self.direct_upload:
+            self.deploy()
+        if self.tasks:
+            join(self.s, self.tasks, retry=2, batch=self.name, dependents=self.dependents)
 
     def run(self):
-        self.make_files()
-        self.push_to_s3()
+        if not self.direct_upload:
+            self.make_files()
+            self.push_to_s3()
         self.create_tasks()
         self.launch()
 
@@ -205,6 +347,14 @@ if __name__=='__main__':
         help=f'Provider flavor (instance type) - default to {DEFAULT_FLAVOR}', default=None)
     parser.add_argument('--workers', type=int, 
         help=f'Number of instances to use, default to {DEFAULT_WORKERS} (each worker will take up to 72h)', default=DEFAULT_WORKERS)
+    parser.add_argument('--sparse', action='store_true',
+        help=f'tsv_abundance is in long format: a header and specie, sample and abundance columns, one line per non-null abundance')
+    parser.add_argument('--direct-upload', action='store_true',
+        help=f'Upload each sample files as soon as they are generated (without a local samples folder) and create its task right after')
+    parser.add_argument('--shards', type=int, default=1,
+        help=f'Split each sample simulation in that many parallel tasks (each simulating a part of the depth with its own seed), their reads being concatenated at the end, default to 1 (no split)')
+    parser.add_argument('--resume', action='store_true',
+        help=f'Do not relaunch samples which reads are already present in s3_camisim_output')
     args = parser.parse_args()
 
     if not args.scitq:
@@ -228,4 +378,8 @@ if __name__=='__main__':
                 flavor=args.flavor,
                 s3_camisim_output=args.s3_camisim_output,
                 workers=args.workers,
-                depth=args.depth)
+                depth=args.depth,
+                resume=args.resume,
+                sparse=args.sparse,
+                direct_upload=args.direct_upload,
+                shards=args.shards)
@@ -0,0 +1,9 @@
+"""Shared helpers for scitq examples launchers.
+
+Launchers are plain scripts living in their own folder, so they add the parent
+folder of this package to sys.path before importing from it."""
+import os
+
+# where launchers keep their local state (listing index, caches...)
+CACHE_DIR = os.environ.get('SCITQ_EXAMPLES_CACHE',
+    os.path.join(os.path.expanduser('~'), '.cache', 'scitq-examples'))
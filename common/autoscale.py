@@ -0,0 +1,204 @@
+"""Size the worker fleet from the data to process, and adjust it during join.
+
+Each tool has a simple throughput model: a task lasts overhead + size * seconds
+per GB of input. The model is learnt from the executions of the previous runs
+(it is kept in the local cache folder), the defaults come from the performance
+figures in the tools README."""
+import threading
+import math
+import json
+import os
+
+from common import CACHE_DIR
+from common.join import STATUS_CHUNK
+
+MODEL_FILE = os.path.join(CACHE_DIR, 'throughput.json')
+GB = 1024**3
+
+# tool: (overhead in seconds per task, seconds per GB of input), for one task
+# using a worker 'slot' (the worker concurrency is the number of slots)
+DEFAULT_MODELS = {
+    'kraken2': (1800, 600),
+    # the database is loaded once per worker, tasks memory map it
+    'kraken2_shared': (300, 600),
+    'motus3': (60, 900),
+    'metaphlan4': (60, 480),
+    'metaphlan4_filter': (120, 1200),
+    # the three above back to back, on the same download
+    'profilers': (1920, 1980),
+}
+DEFAULT_TARGET_HOURS = 4
+DEFAULT_MAX_WORKERS = 40
+# how often the fleet is reconsidered during join (in seconds)
+DEFAULT_PERIOD = 120
+# weight of a new observation in the learnt seconds per GB
+LEARNING_RATE = 0.1
+
+ACTIVE_STATUS = ['pending', 'assigned', 'accepted', 'running']
+
+
+def _get(obj, key):
+    """scitq.lib.Server answers with dict or objects depending on its style"""
+    return obj[key] if type(obj)==dict else getattr(obj, key)
+
+
+class ThroughputModel:
+    """Predict task duration from input size for a tool, learning from completed tasks"""
+
+    def __init__(self, tool):
+        self.tool = tool
+        self.overhead, self.seconds_per_gb = DEFAULT_MODELS[tool]
+        self.observations = 0
+        if os.path.exists(MODEL_FILE):
+            with open(MODEL_FILE, 'r') as f:
+                learnt = json.load(f).get(tool)
+            if learnt:
+                self.overhead = learnt['overhead']
+                self.seconds_per_gb = learnt['seconds_per_gb']
+                self.observations = learnt['observations']
+
+    def predict(self, size):
+        """Expected duration (in seconds) of a task with size bytes of input"""
+        return self.overhead + size/GB*self.seconds_per_gb
+
+    def learn(self, size, duration):
+        """Update the model with a completed task"""
+        if size<=0 or duration<=self.overhead:
+            return
+        observed = (duration-self.overhead)/(size/GB)
+        rate = max(LEARNING_RATE, 1/(self.observations+1))
+        self.seconds_per_gb += rate*(observed-self.seconds_per_gb)
+        self.observations += 1
+
+    def save(self):
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        models = {}
+        if os.path.exists(MODEL_FILE):
+            with open(MODEL_FILE, 'r') as f:
+                models = json.load(f)
+        models[self.tool] = {'overhead': self.overhead,
+                             'seconds_per_gb': self.seconds_per_gb,
+                             'observations': self.observations}
+        with open(MODEL_FILE, 'w') as f:
+            json.dump(models, f, indent=2)
+
+
+def fleet_size(model, sizes, concurrency, target_hours=DEFAULT_TARGET_HOURS,
+        max_workers=DEFAULT_MAX_WORKERS):
+    """How many workers are needed to process tasks of these sizes (in bytes)
+    in about target_hours (never more than max_workers, and never more than
+    what would leave some worker slots without any task)"""
+    if not sizes:
+        return 0
+    work = sum(model.predict(size) for size in sizes)
+    needed = math.ceil(work/(concurrency*target_hours*3600))
+    return max(1, min(needed, max_workers, math.ceil(len(sizes)/concurrency)))
+
+
+class AutoScaler:
+    """Adjust the number of workers of a batch while its tasks are running,
+    to be used around Server.join:
+
+        with AutoScaler(s, batch, tasks, sizes, model, concurrency, deploy_args):
+            s.join(tasks, retry=2)
+
+    - server: a scitq.lib.Server
+    - batch: the batch name
+    - tasks: the tasks list as returned by task_create
+    - sizes: the input size of each task (in bytes, same order as tasks)
+    - model: a ThroughputModel
+    - concurrency: workers concurrency
+    - deploy_args: other worker_deploy arguments (region, flavor, provider, prefetch)
+    - target_hours, max_workers: see fleet_size
+    - period: how often (in seconds) the fleet is adjusted
+
+    Workers are added while there is more work left than target_hours for the
+    current fleet, and idle workers are removed once there is no more pending
+    task. Durations of succeeded tasks are used to train the model.
+    """
+
+    def __init__(self, server, batch, tasks, sizes, model, concurrency, deploy_args,
+            target_hours=DEFAULT_TARGET_HOURS, max_workers=DEFAULT_MAX_WORKERS,
+            period=DEFAULT_PERIOD):
+        self.server = server
+        self.batch = batch
+        self.task_ids = [_get(task, 'task_id') for task in tasks]
+        self.sizes = dict(zip(self.task_ids, sizes))
+        self.model = model
+        self.concurrency = concurrency
+        self.deploy_args = deploy_args
+        self.target_hours = target_hours
+        self.max_workers = max_workers
+        self.period = period
+        # task_id -> last status seen (succeeded tasks are not polled again)
+        self.statuses = {}
+        # tasks seen succeeded since the model last learnt
+        self.succeeded = []
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stopped.set()
+        self.thread.join()
+        self._poll()
+        self._learn()
+        self.model.save()
+
+    def _run(self):
+        while not self.stopped.wait(self.period):
+            try:
+                self.adjust()
+                self._learn()
+            except Exception as e:
+                # never let scaling errors interrupt the run
+                print(f'Autoscaling error: {e}')
+
+    def _learn(self):
+        """Train the model with the last execution of the tasks which just
+        succeeded (only those are queried)"""
+        succeeded, self.succeeded = self.succeeded, []
+        for task_id in succeeded:
+            for execution in self.server.executions(task_id=task_id, latest=True, trunc=1):
+                duration = (_get(execution, 'modification_date')-_get(execution, 'creation_date')).total_seconds()
+                self.model.learn(self.sizes[task_id], duration)
+
+    def _poll(self):
+        """Update the statuses of the tasks not succeeded yet, by chunks as
+        task ids are sent in the URL (failed tasks may be retried by join)"""
+        polled = [task_id for task_id in self.task_ids if self.statuses.get(task_id)!='succeeded']
+        for i in range(0, len(polled), STATUS_CHUNK):
+            chunk = polled[i:i+STATUS_CHUNK]
+            for task_id,status in zip(chunk, self.server.task_status(task_id_list=chunk)):
+                if status=='succeeded':
+                    self.succeeded.append(task_id)
+                self.statuses[task_id] = status
+
+    def adjust(self):
+        self._poll()
+        remaining = [self.sizes[task_id] for task_id,status in self.statuses.items()
+                        if status in ACTIVE_STATUS]
+        pending = sum(1 for status in self.statuses.values() if status=='pending')
+        desired = fleet_size(self.model, remaining, self.concurrency,
+                        target_hours=self.target_hours, max_workers=self.max_workers)
+        workers = [worker for worker in self.server.workers()
+                    if _get(worker, 'batch')==self.batch]
+        if desired>len(workers):
+            print(f'Autoscaling: {len(remaining)} tasks left, adding {desired-len(workers)} worker(s)')
+            self.server.worker_deploy(number=desired-len(workers), batch=self.batch,
+                concurrency=self.concurrency, **self.deploy_args)
+        elif pending==0 and desired<len(workers):
+            excess = len(workers)-desired
+            for worker in workers:
+                if excess<=0:
+                    break
+                worker_id = _get(worker, 'worker_id')
+                busy = [execution for execution in self.server.worker_executions(worker_id)
+                            if _get(execution, 'status') in ACTIVE_STATUS]
+                if not busy:
+                    print(f'Autoscaling: releasing idle worker {_get(worker, "name")}')
+                    self.server.worker_delete(worker_id)
+                    excess -= 1
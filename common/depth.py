@@ -0,0 +1,151 @@
+"""Read depth pre-scan: estimate the number of reads of each sample before
+submission.
+
+Two estimators are available:
+
+- size: the compressed size of each FASTQ divided by an average size per read
+    (no request at all, but it depends on read length and compression),
+- head: the first MB of each FASTQ are downloaded (several files at a time)
+    and decompressed, which gives the number of reads per compressed byte of
+    this very file, applied to its full size.
+
+Estimates are kept in a local cache, keyed by file and fingerprint (ETag or
+size and date), so that a relaunch does not download anything again."""
+from scitq.fetch import FetchError
+import concurrent.futures
+import subprocess
+import threading
+import json
+import zlib
+import os
+
+from common import CACHE_DIR
+from common.resume import inputs_fingerprint
+
+DEPTH_DIR = os.path.join(CACHE_DIR, 'depth')
+ESTIMATORS = ['size', 'head']
+# rough size of a 150bp read in a gzipped FASTQ
+GZ_FASTQ_BYTES_PER_READ = 80
+DEFAULT_HEAD_SIZE = 1024**2
+MAX_PARALLEL_SCAN = 16
+
+
+def head(uri, size):
+    """Return the first size bytes of a file"""
+    if '://' not in uri or uri.startswith('file://'):
+        with open(uri[len('file://'):] if uri.startswith('file://') else uri, 'rb') as f:
+            return f.read(size)
+    remote, path = uri.split('://', 1)
+    # scitq.fetch relies on rclone (and sets its configuration) for storages
+    process = subprocess.run(['rclone', 'cat', '--count', str(size), f'{remote}:{path}'],
+        capture_output=True)
+    if process.returncode!=0:
+        raise FetchError(f'Could not read {uri}: {process.stderr.decode("utf-8", "replace")}')
+    return process.stdout
+
+def reads_per_byte(data):
+    """Number of reads per compressed byte in the head of a gzipped FASTQ
+    (possibly made of several gzip members), None if it is too small to say"""
+    reads = 0
+    consumed = 0
+    while data:
+        decompressor = zlib.decompressobj(16+zlib.MAX_WBITS)
+        try:
+            text = decompressor.decompress(data)
+        except zlib.error:
+            break
+        # the last read is probably incomplete
+        reads += text.count(b'\n')//4
+        if not decompressor.eof:
+            consumed += len(data)
+            break
+        consumed += len(data)-len(decompressor.unused_data)
+        data = decompressor.unused_data
+    if reads==0 or consumed==0:
+        return None
+    return reads/consumed
+
+
+class DepthScanner:
+    """Estimate the number of reads of samples (listing items as in
+    common.discovery).
+
+    - estimator: size or head (see module documentation)
+    - head_size: how many bytes are read for the head estimator
+    - parallel: how many files are read at the same time
+    """
+
+    def __init__(self, estimator='size', head_size=DEFAULT_HEAD_SIZE, parallel=MAX_PARALLEL_SCAN):
+        if estimator not in ESTIMATORS:
+            raise RuntimeError(f'Unknown estimator {estimator}, it should be one of {", ".join(ESTIMATORS)}')
+        self.estimator = estimator
+        self.head_size = head_size
+        self.parallel = parallel
+        self.cache_file = os.path.join(DEPTH_DIR, 'estimates.json')
+        self.cache = {}
+        if os.path.exists(self.cache_file):
+            try:
+                with open(self.cache_file, 'r') as f:
+                    self.cache = json.load(f)
+            except (OSError, ValueError):
+                pass
+        self.lock = threading.Lock()
+
+    def file_reads(self, item):
+        """Estimated number of reads of a file"""
+        if self.estimator=='size' or not item.size:
+            return int((item.size or 0)/GZ_FASTQ_BYTES_PER_READ)
+        key = f'{self.head_size}|{item.name}'
+        fingerprint = inputs_fingerprint([item])
+        with self.lock:
+            cached = self.cache.get(key)
+        if cached and cached['fingerprint']==fingerprint:
+            return cached['reads']
+        ratio = reads_per_byte(head(item.name, self.head_size))
+        reads = int(item.size*ratio) if ratio else int(item.size/GZ_FASTQ_BYTES_PER_READ)
+        with self.lock:
+            self.cache[key] = {'fingerprint': fingerprint, 'reads': reads}
+        return reads
+
+    def reads(self, items):
+        """Estimated number of reads of a sample"""
+        return sum(self.file_reads(item) for item in items)
+
+    def scan(self, sample_groups):
+        """Yield (sample, items, reads) as soon as each sample is estimated,
+        sample_groups being (sample, items) tuples"""
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.parallel) as executor:
+            futures = {executor.submit(self.reads, items): (sample, items)
+                for sample,items in sample_groups}
+            try:
+                for future in concurrent.futures.as_completed(futures):
+                    sample, items = futures[future]
+                    yield sample, items, future.result()
+            finally:
+                for future in futures:
+                    future.cancel()
+                self.save()
+
+    def save(self):
+        if self.estimator=='size':
+            return
+        os.makedirs(DEPTH_DIR, exist_ok=True)
+        temp_file = self.cache_file+'.tmp'
+        with self.lock:
+            with open(temp_file, 'w') as f:
+                json.dump(self.cache, f)
+        os.replace(temp_file, self.cache_file)
+
+
+REPORT_COLUMNS = ['sample', 'size', 'estimated_pairs', 'status']
+
+def save_report(batch, rows):
+    """Write the pre-scan of a batch, rows being dicts with REPORT_COLUMNS
+    keys, in DEPTH_DIR/<batch>.tsv, and return its path"""
+    os.makedirs(DEPTH_DIR, exist_ok=True)
+    report = os.path.join(DEPTH_DIR, f'{batch}.tsv')
+    with open(report, 'w') as f:
+        f.write('\t'.join(REPORT_COLUMNS)+'\n')
+        for row in rows:
+            f.write('\t'.join(str(row[column]) for column in REPORT_COLUMNS)+'\n')
+    return report
@@ -0,0 +1,227 @@
+"""Sample discovery: list a source folder and group files per sample.
+
+The listing is streamed folder by folder (each first level folder of the source
+is listed on its own, several at a time), so that sample groups are yielded as
+soon as their folder is listed: a sample is yielded early only if it cannot
+have files elsewhere (its files are directly in its first level folder, or
+directly in source when not grouped by folder), the others once everything is
+listed. The listing is also kept in an on-disk index, keyed by source, so that
+a relaunch only lists again the folders that changed."""
+from scitq.fetch import list_content
+import concurrent.futures
+import argparse
+import datetime
+import hashlib
+import json
+import time
+import os
+
+from common import CACHE_DIR
+
+LISTING_CACHE_DIR = os.path.join(CACHE_DIR, 'listing')
+MAX_PARALLEL_LIST = 10
+# cached folders older than that are listed again whatever their fingerprint
+DEFAULT_MAX_AGE = 7*24*3600
+# same when folder dates are meaningless (bucket storages), so that only a
+# relaunch soon after a listing reuses it
+UNRELIABLE_MAX_AGE = 3600
+
+
+def _to_record(item):
+    """Turn a scitq.fetch listing item into a JSON serializable dict"""
+    date = getattr(item, 'modification_date', None)
+    return {'name': item.name,
+            'rel_name': getattr(item, 'rel_name', None),
+            'size': getattr(item, 'size', None),
+            'md5': getattr(item, 'md5', None),
+            'modification_date': date.isoformat() if date is not None else None}
+
+def _to_item(record):
+    """Reverse of _to_record, return an object similar to scitq.fetch listing items"""
+    date = record['modification_date']
+    return argparse.Namespace(name=record['name'],
+                              rel_name=record['rel_name'],
+                              size=record['size'],
+                              md5=record['md5'],
+                              modification_date=datetime.datetime.fromisoformat(date) if date else None)
+
+def _fingerprint(item):
+    """What should change when a folder (or a file) content changes: for files
+    this is the ETag (md5) and mtime, for folders only the mtime is available"""
+    date = getattr(item, 'modification_date', None)
+    return f"{date.isoformat() if date is not None else ''}|{getattr(item,'size',None)}|{getattr(item,'md5',None) or ''}"
+
+
+class SampleDiscovery:
+    """List source and group files ending with extension per sample.
+
+    - source: a URI of a folder (s3://bucket/path/...)
+    - extension: only files ending with this are kept (like .fastq.gz)
+    - by_folder: if True (default), files are grouped by their parent folder
+        (FASTQs grouped in a folder named after the sample), if False, each
+        file is a sample named after the file without its extension
+    - refresh: if True, ignore the on-disk index and list everything again
+    - max_age: after this time (in seconds), an indexed folder is always listed
+        again (UNRELIABLE_MAX_AGE if shorter, when folders have no real date)
+    - parallel: how many folders are listed at the same time
+    - md5: if True, items have their ETag (md5), which inputs fingerprints
+        rely on (this may be slower with some storages)
+
+    Iterating on the object yields (sample, items) tuples as soon as a sample
+    group is complete, items being scitq.fetch listing objects (with name, size,
+    md5 and modification_date). After iteration, inventory holds all the groups.
+    """
+
+    def __init__(self, source, extension, by_folder=True, refresh=False,
+            max_age=DEFAULT_MAX_AGE, parallel=MAX_PARALLEL_LIST, md5=False):
+        self.source = source.rstrip('/')
+        self.extension = extension
+        self.by_folder = by_folder
+        self.refresh = refresh
+        self.max_age = max_age
+        self.parallel = parallel
+        self.md5 = md5
+        self.inventory = {}
+        self.index_file = os.path.join(LISTING_CACHE_DIR,
+            hashlib.sha1(self.source.encode('utf-8')).hexdigest()+'.json')
+
+    def _load_index(self):
+        """Return the indexed folders for this source (an empty dict if none)"""
+        if self.refresh or not os.path.exists(self.index_file):
+            return {}
+        try:
+            with open(self.index_file, 'r') as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        if index.get('source')!=self.source:
+            return {}
+        return index.get('folders', {})
+
+    def _save_index(self, folders):
+        """Write the index atomically so that an interrupted launch does not corrupt it"""
+        os.makedirs(LISTING_CACHE_DIR, exist_ok=True)
+        temp_file = self.index_file+'.tmp'
+        with open(temp_file, 'w') as f:
+            json.dump({'source': self.source, 'folders': folders}, f)
+        os.replace(temp_file, self.index_file)
+
+    def _sample(self, name):
+        if self.by_folder:
+            return name.split('/')[-2]
+        else:
+            sample,_ = os.path.splitext(os.path.split(name)[-1])
+            return sample
+
+    def _group(self, items, top_level=False):
+        """Group items per sample, keeping only the ones with the proper
+        extension, as a dict sample -> (items, whether the group is complete,
+        i.e. the sample cannot have files elsewhere)"""
+        groups = {}
+        complete = {}
+        for item in items:
+            if item.name.endswith(self.extension):
+                sample = self._sample(item.name)
+                groups.setdefault(sample, []).append(item)
+                # directly in a first level folder (a folder rel_name is
+                # relative to it) when grouped by folder, directly in source
+                # otherwise
+                direct = '/' not in item.rel_name and top_level!=self.by_folder
+                complete[sample] = complete.get(sample, True) and direct
+        return {sample: (items, complete[sample]) for sample,items in groups.items()}
+
+    def _list_folder(self, folder_item):
+        return [item for item in list_content(f'{self.source}/{folder_item.rel_name}', md5=self.md5)
+                    if not item.name.endswith('/')]
+
+    def __iter__(self):
+        yield from self._discover(stream=True)
+
+    def _discover(self, stream):
+        """Yield sample groups, the complete ones as soon as they are listed,
+        the others at the end: in stream mode, yielded groups are launched so
+        a sample yielded twice is an error (they are merged otherwise)"""
+        self.inventory = {}
+        deferred = {}
+        def complete(groups):
+            for sample,(items,done) in groups.items():
+                if done:
+                    yield from self._complete(sample, items, stream)
+                else:
+                    deferred.setdefault(sample, []).extend(items)
+
+        index = self._load_index()
+        now = time.time()
+        top_items = list_content(self.source, no_rec=True, md5=self.md5)
+        folder_items = [item for item in top_items if item.rel_name.endswith('/')]
+        file_items = [item for item in top_items if not item.rel_name.endswith('/')]
+
+        # on bucket storages, folders are pseudo folders and all share the same
+        # fake date: their fingerprint is meaningless and a listing is only
+        # reused for a short time
+        folder_dates = set(getattr(item,'modification_date',None) for item in folder_items)
+        unreliable_dates = None in folder_dates or (len(folder_items)>1 and len(folder_dates)==1)
+        max_age = min(self.max_age, UNRELIABLE_MAX_AGE) if unreliable_dates else self.max_age
+
+        new_index = {}
+        to_list = []
+        for folder_item in folder_items:
+            fingerprint = _fingerprint(folder_item)
+            cached = index.get(folder_item.rel_name)
+            if cached and now-cached['listed_at']<max_age and (cached.get('md5') or not self.md5) and \
+                    (unreliable_dates or cached['fingerprint']==fingerprint):
+                new_index[folder_item.rel_name] = cached
+                yield from complete(self._group(map(_to_item, cached['items'])))
+            else:
+                to_list.append(folder_item)
+        if len(to_list)<len(folder_items):
+            print(f'Reusing the listing of {len(folder_items)-len(to_list)} folder(s) of {self.source} '
+                  f'(of less than {max_age/3600:g}h, refresh the listing to see files added since)')
+        if to_list:
+            print(f'Listing {len(to_list)} folder(s) out of {len(folder_items)} in {self.source}')
+
+        # files directly in source (FASTA mode) are known as soon as the first
+        # level is listed
+        yield from complete(self._group(file_items, top_level=True))
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.parallel) as executor:
+            futures = {executor.submit(self._list_folder, folder_item): folder_item
+                            for folder_item in to_list}
+            try:
+                for future in concurrent.futures.as_completed(futures):
+                    folder_item = futures[future]
+                    items = future.result()
+                    new_index[folder_item.rel_name] = {
+                        'fingerprint': _fingerprint(folder_item),
+                        'listed_at': now,
+                        'md5': self.md5,
+                        'items': list(map(_to_record, items))}
+                    yield from complete(self._group(items))
+            finally:
+                for future in futures:
+                    future.cancel()
+        self._save_index(new_index)
+        for sample,items in deferred.items():
+            yield from self._complete(sample, items, stream)
+
+    def _complete(self, sample, items, stream):
+        """Register a complete sample group (a sample may be split between
+        several folders, like the first level files and a folder with FASTQs
+        directly in source)"""
+        items = sorted(items, key=lambda item: item.name)
+        if sample in self.inventory:
+            if stream:
+                raise RuntimeError(f'Sample {sample} has files in several folders of {self.source} '
+                    f'({os.path.dirname(self.inventory[sample][0].name)}/ and {os.path.dirname(items[0].name)}/) '
+                    'and some were launched already: list the source first (not in stream mode)')
+            self.inventory[sample] = sorted(self.inventory[sample]+items, key=lambda item: item.name)
+            return
+        self.inventory[sample] = items
+        yield sample, items
+
+    def samples(self):
+        """List everything and return a dict sample -> list of file URIs"""
+        for _ in self._discover(stream=False):
+            pass
+        return {sample: [item.name for item in items]
+                    for sample,items in self.inventory.items()}
@@ -0,0 +1,504 @@
+"""In-process stand-ins for scitq.lib.Server and scitq.fetch, to exercise
+launchers offline.
+
+Only the methods used by the examples are implemented. Each call sleeps for
+latency seconds to mimic a server round trip.
+
+- FakeServer keeps tasks in memory and never runs them,
+- SimulatedServer also runs them, on simulated workers, in simulated time (see
+    SimulatedClock): workers boot, tasks are dispatched to their slots in
+    creation order, download then run for a duration given by a model, and
+    some of them fail,
+- FakeStore is an in-memory object storage replacing scitq.fetch functions
+    (objects only have a size, downloaded files are empty)."""
+from scitq.fetch import FetchError, UnsupportedError
+import collections
+import argparse
+import datetime
+import itertools
+import threading
+import hashlib
+import random
+import heapq
+import time
+import sys
+import os
+
+DEFAULT_LATENCY = 0.05
+
+
+class FakeServer:
+    """Mimic scitq.lib.Server: tasks are kept in memory and never run unless
+    a test changes their status.
+
+    - latency: time (in seconds) spent in each call
+    - style: 'dict' or 'object' like the real Server
+    """
+
+    def __init__(self, ip=None, style='dict', latency=DEFAULT_LATENCY, **args):
+        self.ip = ip
+        self.style = style
+        self.latency = latency
+        self.task_ids = itertools.count(1)
+        self.lock = threading.Lock()
+        self.tasks_by_id = {}
+        self.deployed = []
+        self.worker_ids = itertools.count(1)
+        self.workers_by_id = {}
+        # executions are only created by tests or benchmarks (see bench/)
+        self.executions_list = []
+
+    def _wrap(self, d):
+        return argparse.Namespace(**d) if self.style=='object' else dict(d)
+
+    def _call(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def task_create(self, command, name=None, status=None, batch=None,
+            input=None, output=None, container=None, container_options='',
+            resource=None, required_task_ids=None, shell=False, retry=None,
+            download_timeout=None, run_timeout=None, use_cache=None,
+            asynchronous=True):
+        self._call()
+        with self.lock:
+            task_id = next(self.task_ids)
+        task = {'task_id': task_id, 'name': name, 'command': command,
+            'status': status or ('waiting' if required_task_ids else 'pending'),
+            'batch': batch, 'input': input, 'output': output,
+            'container': container, 'container_options': container_options,
+            'resource': resource, 'required_task_ids': required_task_ids,
+            'retry': retry}
+        self.tasks_by_id[task_id] = task
+        return self._wrap(task)
+
+    def task_update(self, id, status=None, asynchronous=True, **args):
+        self._call()
+        task = self.tasks_by_id[id]
+        if status is not None:
+            task['status'] = status
+        task.update({k:v for k,v in args.items() if v is not None})
+        return self._wrap(task)
+
+    def task_status(self, task_id_list):
+        self._call()
+        return [self.tasks_by_id[task_id]['status'] for task_id in task_id_list]
+
+    def tasks(self, **args):
+        self._call()
+        return [self._wrap(task) for task in self.tasks_by_id.values()
+                    if all(task.get(k)==v for k,v in args.items())]
+
+    def worker_deploy(self, number, batch, region, flavor, concurrency, provider=None,
+                      prefetch=0, asynchronous=True):
+        self._call()
+        self.deployed.append({'number': number, 'batch': batch, 'region': region,
+            'flavor': flavor, 'concurrency': concurrency, 'provider': provider,
+            'prefetch': prefetch})
+        with self.lock:
+            for _ in range(number):
+                worker_id = next(self.worker_ids)
+                self.workers_by_id[worker_id] = {'worker_id': worker_id,
+                    'name': f'worker{worker_id}', 'batch': batch, 'status': 'running',
+                    'concurrency': concurrency, 'prefetch': prefetch, 'flavor': flavor}
+
+    def workers(self, **args):
+        self._call()
+        return [self._wrap(worker) for worker in self.workers_by_id.values()]
+
+    def worker_delete(self, id, asynchronous=True):
+        self._call()
+        del self.workers_by_id[id]
+
+    def worker_executions(self, id, status=None):
+        self._call()
+        return [self._wrap(execution) for execution in self.executions_list
+                    if execution['worker_id']==id and (status is None or execution['status']==status)]
+
+    def executions(self, **args):
+        self._call()
+        args.pop('trunc', None)
+        latest = args.pop('latest', False)
+        executions = [execution for execution in self.executions_list
+                        if all(execution.get(k)==v for k,v in args.items())]
+        if latest:
+            # only the last execution of each task
+            executions = list({execution['task_id']: execution for execution in executions}.values())
+        return [self._wrap(execution) for execution in executions]
+
+    def join(self, task_list, retry=1, check=False):
+        """Consider every task has succeeded"""
+        self._call()
+        for task in task_list:
+            task_id = task['task_id'] if type(task)==dict else task.task_id
+            self.tasks_by_id[task_id]['status'] = 'succeeded'
+        return {'succeeded': len(task_list)}
+
+
+class SimulatedClock:
+    """A stand-in for the time module as used by common.join (time() and
+    sleep()): time goes on as usual, but sleeping is instant and only moves
+    the clock forward, so that hours of polling take no time"""
+
+    def __init__(self):
+        self.origin = time.time()
+        self.monotonic_origin = time.monotonic()
+        self.skipped = 0
+        self.lock = threading.Lock()
+
+    def time(self):
+        return self.origin+time.monotonic()-self.monotonic_origin+self.skipped
+
+    def sleep(self, seconds):
+        with self.lock:
+            self.skipped += max(seconds, 0)
+
+
+def constant_duration(task):
+    """Default SimulatedServer duration model: (download, run) in seconds"""
+    return 60, 600
+
+
+class SimulatedServer(FakeServer):
+    """A FakeServer which runs its tasks in simulated time.
+
+    - clock: a SimulatedClock (shared with what waits for the tasks)
+    - duration: a function returning the (download, run) durations in seconds
+        of an execution of a task (given as a dict)
+    - failure_rate: probability that an execution fails (at its end)
+    - boot_time: delay (in seconds) between worker_deploy and the workers
+        accepting tasks
+    - seed: seed of the failures (the duration model has its own)
+
+    Each worker has concurrency slots. Pending tasks of a batch are given to
+    the free slots of this batch workers in creation order (retried tasks go
+    at the end of the queue), waiting tasks become pending once all their
+    required tasks succeeded. The simulation advances up to the clock time at
+    each call.
+    """
+
+    def __init__(self, ip=None, style='dict', latency=0, clock=None, duration=constant_duration,
+            failure_rate=0, boot_time=300, seed=42, **args):
+        super().__init__(ip=ip, style=style, latency=latency, **args)
+        self.clock = clock or SimulatedClock()
+        self.duration = duration
+        self.failure_rate = failure_rate
+        self.boot_time = boot_time
+        self.random = random.Random(seed)
+        self.simulation_lock = threading.RLock()
+        self.event_ids = itertools.count()
+        # (time, event id, kind, task id, slot)
+        self.events = []
+        # batch -> pending task ids and (free since, slot id, slot) of idle slots
+        self.queues = collections.defaultdict(collections.deque)
+        self.idle = collections.defaultdict(list)
+        self.dependents = collections.defaultdict(list)
+        self.execution_ids = itertools.count(1)
+        self.executions_by_task = {}
+        self.failures = 0
+
+    def _call(self):
+        super()._call()
+        with self.simulation_lock:
+            self._advance(self.clock.time())
+
+    def _push(self, when, kind, task_id=None, slot=None):
+        heapq.heappush(self.events, (when, next(self.event_ids), kind, task_id, slot))
+
+    def _advance(self, now):
+        while self.events and self.events[0][0]<=now:
+            when, _, kind, task_id, slot = heapq.heappop(self.events)
+            if kind=='free':
+                self._free(slot, when)
+            elif kind=='running':
+                self.tasks_by_id[task_id]['status'] = 'running'
+                self.executions_by_task[task_id]['status'] = 'running'
+            elif kind=='end':
+                self._end(task_id, slot, when)
+
+    def _enqueue(self, task_id, when):
+        task = self.tasks_by_id[task_id]
+        task['status'] = 'pending'
+        idle = self.idle[task['batch']]
+        while idle:
+            _, _, slot = heapq.heappop(idle)
+            if slot[0] in self.workers_by_id:
+                self._start(task_id, slot, when)
+                return
+        self.queues[task['batch']].append(task_id)
+
+    def _free(self, slot, when):
+        if slot[0] not in self.workers_by_id:
+            # the worker was deleted
+            return
+        batch = self.workers_by_id[slot[0]]['batch']
+        if self.queues[batch]:
+            self._start(self.queues[batch].popleft(), slot, when)
+        else:
+            heapq.heappush(self.idle[batch], (when, next(self.event_ids), slot))
+
+    def _start(self, task_id, slot, when):
+        task = self.tasks_by_id[task_id]
+        download, run = self.duration(task)
+        task['status'] = 'accepted'
+        execution = {'execution_id': next(self.execution_ids), 'task_id': task_id,
+            'worker_id': slot[0], 'status': 'accepted', 'creation_date': when,
+            'modification_date': when}
+        self.executions_list.append(execution)
+        self.executions_by_task[task_id] = execution
+        self._push(when+download, 'running', task_id)
+        self._push(when+download+run, 'end', task_id, slot)
+
+    def _end(self, task_id, slot, when):
+        task = self.tasks_by_id[task_id]
+        status = 'failed' if self.random.random()<self.failure_rate else 'succeeded'
+        if status=='failed':
+            self.failures += 1
+        task['status'] = status
+        execution = self.executions_by_task[task_id]
+        execution['status'] = status
+        execution['modification_date'] = when
+        self._free(slot, when)
+        if status=='succeeded':
+            for dependent in self.dependents.pop(task_id, []):
+                self._release(dependent, when)
+
+    def _release(self, task_id, when):
+        task = self.tasks_by_id[task_id]
+        if task['status']=='waiting' and all(self.tasks_by_id[required]['status']=='succeeded'
+                                            for required in task['required_task_ids']):
+            self._enqueue(task_id, when)
+
+    def task_create(self, command, **args):
+        created = super().task_create(command, **args)
+        task_id = created['task_id'] if type(created)==dict else created.task_id
+        with self.simulation_lock:
+            task = self.tasks_by_id[task_id]
+            if task['status']=='pending':
+                self._enqueue(task_id, self.clock.time())
+            elif task['status']=='waiting':
+                for required in task['required_task_ids']:
+                    if self.tasks_by_id[required]['status']!='succeeded':
+                        self.dependents[required].append(task_id)
+                self._release(task_id, self.clock.time())
+        return created
+
+    def task_update(self, id, status=None, asynchronous=True, **args):
+        with self.simulation_lock:
+            done = self.tasks_by_id[id]['status'] in ('failed', 'succeeded')
+            updated = super().task_update(id, status=status, asynchronous=asynchronous, **args)
+            if status=='pending' and done:
+                # a retry: the task goes at the end of its batch queue
+                self._enqueue(id, self.clock.time())
+        return updated
+
+    def worker_deploy(self, number, batch, region, flavor, concurrency, provider=None,
+                      prefetch=0, asynchronous=True):
+        with self.simulation_lock:
+            known = set(self.workers_by_id)
+            super().worker_deploy(number, batch, region, flavor, concurrency, provider=provider,
+                prefetch=prefetch, asynchronous=asynchronous)
+            ready = self.clock.time()+self.boot_time
+            for worker_id in set(self.workers_by_id)-known:
+                for i in range(concurrency):
+                    self._push(ready, 'free', slot=(worker_id, i))
+
+
+FETCH_FUNCTIONS = ['list_content', 'info', 'get', 'put', 'sync', 'copy', 'delete']
+# schemes that FakeStore does not simulate, and the real scitq.fetch cannot
+# reach offline either
+UNSUPPORTED_SCHEMES = ('http://', 'https://', 'ftp://')
+FOLDER_DATE = datetime.datetime(2000, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+class FakeStore:
+    """An in-memory object storage with scitq.fetch functions (list_content,
+    info, get, put, sync, copy and delete) for URIs like s3://bucket/path (any
+    scheme but file://, http(s):// and ftp://, local paths being handled by
+    the real functions).
+
+    - latency: time (in seconds) spent in each call
+    - failure_rate: probability that a request fails and is retried (as
+        rclone does), which costs another latency
+    - seed: seed of the failures
+
+    Objects only have a size (and an ETag and a date): downloaded files are
+    empty. Like on buckets, folders are pseudo folders which all have the
+    same date. Use install() to replace scitq.fetch functions everywhere.
+    """
+
+    def __init__(self, latency=0, failure_rate=0, seed=42):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed)
+        self.lock = threading.RLock()
+        self.root = {}
+        self.calls = 0
+        self.failures = 0
+        import scitq.fetch
+        self.originals = {name: getattr(scitq.fetch, name) for name in FETCH_FUNCTIONS}
+
+    def install(self):
+        """Replace scitq.fetch functions by this store ones, in scitq.fetch
+        and in every module already loaded which imported them"""
+        for module in list(sys.modules.values()):
+            for name,original in self.originals.items():
+                if getattr(module, name, None) is original:
+                    setattr(module, name, getattr(self, name))
+
+    def _call(self):
+        with self.lock:
+            self.calls += 1
+            attempts = 1
+            while self.random.random()<self.failure_rate:
+                self.failures += 1
+                attempts += 1
+        if self.latency:
+            time.sleep(self.latency*attempts)
+
+    @staticmethod
+    def _local(uri):
+        return '://' not in uri or uri.startswith('file://')
+
+    def _path(self, uri):
+        if uri.startswith(UNSUPPORTED_SCHEMES):
+            raise UnsupportedError(f'{uri} is not simulated by FakeStore')
+        scheme, path = uri.split('://', 1)
+        return [scheme]+[part for part in path.split('/') if part]
+
+    def _node(self, uri):
+        node = self.root
+        for part in self._path(uri):
+            if type(node)!=dict or part not in node:
+                return None
+            node = node[part]
+        return node
+
+    def add(self, uri, size, md5=None, date=None):
+        """Create (or replace) an object"""
+        *parents, name = self._path(uri)
+        with self.lock:
+            node = self.root
+            for part in parents:
+                node = node.setdefault(part, {})
+            node[name] = argparse.Namespace(size=size,
+                md5=md5 or hashlib.md5(f'{uri}|{size}'.encode('utf-8')).hexdigest(),
+                modification_date=date or datetime.datetime.now(datetime.timezone.utc))
+
+    def size(self, uri):
+        """Size of an object (0 for folders and missing objects), without a request"""
+        node = self._node(uri)
+        return 0 if node is None or type(node)==dict else node.size
+
+    def _item(self, name, rel_name, record=None, md5=False):
+        date = record.modification_date if record else FOLDER_DATE
+        return argparse.Namespace(name=name, rel_name=rel_name,
+            size=record.size if record else 0, md5=record.md5 if record and md5 else None,
+            creation_date=date, modification_date=date)
+
+    def _walk(self, node, prefix=''):
+        """Yield (relative name, record or None for folders)"""
+        for name,child in list(node.items()):
+            if type(child)==dict:
+                yield prefix+name+'/', None
+                yield from self._walk(child, prefix+name+'/')
+            else:
+                yield prefix+name, child
+
+    def list_content(self, uri, no_rec=False, md5=False):
+        if self._local(uri):
+            return self.originals['list_content'](uri, no_rec=no_rec, md5=md5)
+        self._call()
+        node = self._node(uri)
+        if node is None:
+            return []
+        if type(node)!=dict:
+            return [self._item(uri, uri.split('/')[-1], node, md5)]
+        if no_rec:
+            entries = [(name+'/', None) if type(child)==dict else (name, child)
+                        for name,child in list(node.items())]
+        else:
+            entries = self._walk(node)
+        return [self._item(os.path.join(uri, rel_name), rel_name, record, md5)
+                    for rel_name,record in entries]
+
+    def info(self, uri, md5=False):
+        if self._local(uri):
+            return self.originals['info'](uri, md5=md5)
+        self._call()
+        node = self._node(uri)
+        if node is None:
+            raise FetchError(f'{uri} does not exist')
+        name = uri.rstrip('/').split('/')[-1]
+        return self._item(uri, name+'/', None) if type(node)==dict else self._item(uri, name, node, md5)
+
+    def get(self, uri, destination, parallel=None, show_progress=False):
+        if self._local(uri):
+            return self.originals['get'](uri, destination)
+        node = self._node(uri)
+        if node is None:
+            self._call()
+            raise FetchError(f'{uri} does not exist')
+        if type(node)!=dict:
+            self._call()
+            if os.path.isdir(destination):
+                destination = os.path.join(destination, uri.split('/')[-1])
+            os.makedirs(os.path.dirname(os.path.abspath(destination)), exist_ok=True)
+            open(destination, 'w').close()
+            return
+        for rel_name,record in self._walk(node):
+            if record is not None:
+                self.get(os.path.join(uri, rel_name), os.path.join(destination, rel_name))
+
+    def put(self, source, uri, parallel=None, show_progress=False):
+        if self._local(uri):
+            return self.originals['put'](source, uri)
+        if uri.endswith('/'):
+            uri += os.path.basename(source)
+        self._call()
+        self.add(uri, os.path.getsize(source))
+
+    def sync(self, uri1, uri2, include=[], process=None, show_progress=False):
+        if self._local(uri1) and self._local(uri2):
+            return self.originals['sync'](uri1, uri2)
+        if self._local(uri1):
+            for folder,_,files in os.walk(uri1):
+                for file in files:
+                    rel_name = os.path.relpath(os.path.join(folder, file), uri1)
+                    self.put(os.path.join(folder, file), f'{uri2.rstrip("/")}/{rel_name}')
+        else:
+            # like on buckets, a missing folder is an empty one
+            os.makedirs(uri2, exist_ok=True)
+            for item in self.list_content(uri1):
+                if not item.rel_name.endswith('/'):
+                    self.get(item.name, os.path.join(uri2, item.rel_name))
+
+    def copy(self, source_uri, destination_uri, show_progress=False, file_list=None):
+        if self._local(source_uri) or self._local(destination_uri):
+            return self.originals['copy'](source_uri, destination_uri, file_list=file_list)
+        if self._path(source_uri)[0]!=self._path(destination_uri)[0]:
+            raise UnsupportedError(f'Cannot copy from {source_uri} to {destination_uri}')
+        # a server side copy: a single request, no transfer
+        self._call()
+        node = self._node(source_uri)
+        if node is None:
+            return
+        if type(node)!=dict:
+            destination = destination_uri+source_uri.split('/')[-1] if destination_uri.endswith('/') else destination_uri
+            self.add(destination, node.size, node.md5, node.modification_date)
+            return
+        for rel_name,record in self._walk(node):
+            if record is not None and (file_list is None or rel_name in file_list):
+                self.add(f'{destination_uri.rstrip("/")}/{rel_name}', record.size, record.md5,
+                    record.modification_date)
+
+    def delete(self, uri):
+        if self._local(uri):
+            return self.originals['delete'](uri)
+        self._call()
+        *parents, name = self._path(uri)
+        with self.lock:
+            parent = self._node('://'.join([parents[0], '/'.join(parents[1:])]))
+            if type(parent)!=dict or name not in parent:
+                raise FetchError(f'{uri} does not exist')
+            del parent[name]
@@ -0,0 +1,189 @@
+"""A replacement for Server.join with progress, callbacks and per-task timings.
+
+Statuses are polled with bulk Server.task_status calls (by chunks, and only for
+tasks that are not done yet), so a cycle costs a few requests whatever the
+number of tasks. Each status change is an event: succeeded and failed tasks are
+passed to callbacks as soon as they are seen, and the time spent in each state
+is written to a local TSV file (one line per task, as soon as it is done):
+
+- queue: from join start to the task being accepted by a worker,
+- download: from accepted to running (inputs and resources download),
+- run: from running to done, which includes the upload of outputs as scitq
+  only reports the end of an execution once its outputs are uploaded.
+
+With the input size of each task, the file is also what
+bench/simulate_makespan.py replays (its size and duration columns).
+
+Timings are as precise as the polling period."""
+import time
+import os
+
+from common import CACHE_DIR
+
+TIMINGS_DIR = os.path.join(CACHE_DIR, 'timings')
+DEFAULT_PERIOD = 20
+STATUS_CHUNK = 500
+DONE_STATUS = ['succeeded', 'failed']
+TIMINGS_COLUMNS = ['task_id', 'name', 'status', 'retries', 'queue', 'download', 'run', 'total',
+    'size', 'duration']
+
+
+def _get(obj, key):
+    return obj[key] if type(obj)==dict else getattr(obj, key)
+
+def _duration(start, end):
+    return f'{end-start:.0f}' if start is not None and end is not None else ''
+
+def _hms(seconds):
+    seconds = int(seconds)
+    return f'{seconds//3600}:{seconds//60%60:02d}:{seconds%60:02d}'
+
+
+class TaskWatcher:
+    """Wait for tasks like Server.join, with more to see.
+
+    - server: a scitq.lib.Server (or a common.fake.FakeServer)
+    - tasks: the tasks to wait for
+    - retry: a failed task is set back to pending up to retry times
+    - on_success, on_failure: optional callbacks called with the task as soon
+        as it succeeded or definitively failed (in the watching thread)
+    - timings: the TSV file where per-task timings are written (appended)
+    - check: raise as soon as a task definitively failed
+    - period: polling period (in seconds)
+    - dependents: task_id -> ids of the tasks requiring it, which would wait
+        forever if it definitively failed, so they are failed with it (and
+        not retried)
+    - sizes: the input size of each task (in bytes, same order as tasks),
+        written in the timings with the duration of its last execution
+    """
+
+    def __init__(self, server, tasks, retry=1, on_success=None, on_failure=None,
+            timings=None, check=False, period=DEFAULT_PERIOD, dependents=None, sizes=None):
+        self.server = server
+        self.tasks = {_get(task,'task_id'): task for task in tasks}
+        self.retry = retry
+        self.on_success = on_success
+        self.on_failure = on_failure
+        self.timings = timings
+        self.check = check
+        self.period = period
+        self.dependents = dependents or {}
+        self.sizes = dict(zip(self.tasks, sizes or []))
+        self.status = {task_id: None for task_id in self.tasks}
+        self.retries = {task_id: 0 for task_id in self.tasks}
+        # task_id -> {status: time it was first seen}
+        self.seen = {task_id: {} for task_id in self.tasks}
+        self.pending = list(self.tasks)
+        self.start = None
+        self.progress = None
+
+    def _poll(self):
+        statuses = []
+        for i in range(0, len(self.pending), STATUS_CHUNK):
+            statuses.extend(self.server.task_status(task_id_list=self.pending[i:i+STATUS_CHUNK]))
+        return zip(self.pending, statuses)
+
+    def _write_timings(self, task_id, status):
+        if not self.timings:
+            return
+        seen = self.seen[task_id]
+        end = seen.get(status)
+        accepted = seen.get('accepted', seen.get('running'))
+        run = _duration(seen.get('running'), end)
+        size = self.sizes.get(task_id)
+        line = [str(task_id), str(_get(self.tasks[task_id], 'name') or ''), status,
+            str(self.retries[task_id]), _duration(self.start, accepted),
+            _duration(accepted, seen.get('running')), run,
+            _duration(self.start, end), str(size) if size is not None else '', run]
+        new_file = not os.path.exists(self.timings)
+        with open(self.timings, 'a') as f:
+            if new_file:
+                f.write('\t'.join(TIMINGS_COLUMNS)+'\n')
+            f.write('\t'.join(line)+'\n')
+
+    def _done(self, task_id, status):
+        self._write_timings(task_id, status)
+        callback = self.on_success if status=='succeeded' else self.on_failure
+        if callback:
+            callback(self.tasks[task_id])
+        if status=='failed':
+            print(f"Task {_get(self.tasks[task_id],'name') or task_id} failed too many times giving up")
+            if self.check:
+                raise RuntimeError(f"Task {_get(self.tasks[task_id],'name') or task_id} failed")
+            for dependent in self.dependents.get(task_id, []):
+                self.give_up(dependent)
+
+    def give_up(self, task_id):
+        """Fail a task which cannot succeed, with no retry"""
+        if task_id not in self.tasks or self.status[task_id] in DONE_STATUS:
+            return
+        print(f"Task {_get(self.tasks[task_id],'name') or task_id} cannot run as a task it requires failed")
+        self.server.task_update(task_id, status='failed')
+        self.retries[task_id] = self.retry
+
+    def cycle(self):
+        """Poll statuses once and dispatch the events, return True when all
+        tasks are done"""
+        now = time.time()
+        still_pending = []
+        for task_id,status in self._poll():
+            seen = self.seen[task_id]
+            if status=='failed' and self.retries[task_id]<self.retry:
+                print(f"Retrying task {_get(self.tasks[task_id],'name') or task_id} [{self.retries[task_id]+1}/{self.retry}]...")
+                self.server.task_update(task_id, status='pending')
+                self.retries[task_id] += 1
+                seen.clear()
+                status = 'pending'
+            seen.setdefault(status, now)
+            self.status[task_id] = status
+            if status in DONE_STATUS:
+                self._done(task_id, status)
+            else:
+                still_pending.append(task_id)
+        self.pending = still_pending
+        self.print_progress(now)
+        return not self.pending
+
+    def counts(self):
+        counts = {}
+        for status in self.status.values():
+            counts[status] = counts.get(status, 0)+1
+        return counts
+
+    def print_progress(self, now):
+        if not self.tasks:
+            return
+        counts = self.counts()
+        done = counts.get('succeeded', 0)+counts.get('failed', 0)
+        progress = (done, counts.get('running', 0), counts.get('failed', 0))
+        if progress==self.progress and self.pending:
+            return
+        self.progress = progress
+        elapsed = now-self.start
+        eta = f', ETA {_hms(elapsed/done*len(self.pending))}' if done and self.pending else ''
+        print(f"Done {done}/{len(self.tasks)} ({done/len(self.tasks):.0%}) in {_hms(elapsed)}{eta} - "
+              f"pending: {counts.get('pending',0)+counts.get('assigned',0)}, "
+              f"downloading: {counts.get('accepted',0)}, running: {counts.get('running',0)}, "
+              f"failed: {counts.get('failed',0)}")
+
+    def join(self):
+        """Wait for all tasks, return a dictionary of the number of tasks per
+        status, like Server.join"""
+        self.start = time.time()
+        if self.timings:
+            os.makedirs(os.path.dirname(os.path.abspath(self.timings)), exist_ok=True)
+        while not self.cycle():
+            time.sleep(self.period)
+        if self.timings:
+            print(f'Task timings are in {self.timings}')
+        return self.counts()
+
+
+def join(server, tasks, retry=1, on_success=None, on_failure=None, batch=None,
+        check=False, period=DEFAULT_PERIOD, dependents=None, sizes=None):
+    """Same as Server.join(tasks, retry=retry) using a TaskWatcher, timings
+    being written in the cache folder (timings/<batch>.tsv) if batch is given"""
+    timings = os.path.join(TIMINGS_DIR, f'{batch}.tsv') if batch else None
+    return TaskWatcher(server, tasks, retry=retry, on_success=on_success,
+        on_failure=on_failure, timings=timings, check=check, period=period,
+        dependents=dependents, sizes=sizes).join()
@@ -0,0 +1,360 @@
+"""Taxon x sample abundance matrices aggregated from per-sample outputs.
+
+A matrix store is a folder, updated incrementally as samples are added:
+
+- taxa.tsv: the taxon index (taxon key, name and rank), a taxon row never
+    changes once it is there, new taxa being appended,
+- segments/<n>/: a batch of samples in compressed sparse columns (like the
+    CAMISIM abundance store): indptr.npy (where each sample column starts),
+    rows.npy (taxon rows of its non-null values) and values.npy,
+- samples.tsv: the segment and column of each sample.
+
+Samples are buffered and written as a new segment (nothing is rewritten), a
+sample added again pointing to its new column (compact() rewrites a store
+in a single segment). Segments are memory mapped: loading some samples only
+reads their columns, and loading some taxa only reads the rows arrays and the
+matching values.
+
+Readers turn a tool output (kraken2 report, bracken output, mOTUs profile)
+into (taxon keys, names, ranks, values), and MatrixCollector downloads and
+adds the outputs of samples as soon as their task succeeded (see
+common.join on_success), like metaphlan4 ProfileCollector."""
+from scitq.fetch import get
+import concurrent.futures
+import threading
+import tempfile
+import argparse
+import shutil
+import csv
+import os
+
+import numpy as np
+
+MAX_PARALLEL_DOWNLOAD = 8
+SEGMENT_SIZE = 1000
+
+
+def read_kraken2_report(filename):
+    """kraken2 report: clade reads of each taxon (the rank is the report rank code)"""
+    taxa, names, ranks, values = [], [], [], []
+    with open(filename, 'r') as f:
+        for line in f:
+            fields = line.rstrip('\n').split('\t')
+            if len(fields)<6:
+                continue
+            clade_reads = float(fields[1])
+            if clade_reads:
+                taxa.append(fields[4].strip())
+                names.append(fields[5].strip())
+                ranks.append(fields[3].strip())
+                values.append(clade_reads)
+    return taxa, names, ranks, values
+
+def read_bracken(filename):
+    """bracken output: re-estimated reads of each taxon"""
+    taxa, names, ranks, values = [], [], [], []
+    with open(filename, 'r') as f:
+        for line in csv.DictReader(f, dialect=csv.excel_tab):
+            reads = float(line['new_est_reads'])
+            if reads:
+                taxa.append(line['taxonomy_id'])
+                names.append(line['name'])
+                ranks.append(line['taxonomy_lvl'])
+                values.append(reads)
+    return taxa, names, ranks, values
+
+def read_motus(filename):
+    """mOTUs profile: the value of each mOTU (the last column), keyed by its
+    name (and NCBI taxid when the profile has one)"""
+    taxa, names, ranks, values = [], [], [], []
+    with open(filename, 'r') as f:
+        for line in f:
+            if line.startswith('#') or not line.strip():
+                continue
+            fields = line.rstrip('\n').split('\t')
+            value = float(fields[-1])
+            if value:
+                taxa.append('|'.join(fields[:-1]))
+                names.append(fields[0])
+                ranks.append('')
+                values.append(value)
+    return taxa, names, ranks, values
+
+READERS = {'kraken2': read_kraken2_report, 'bracken': read_bracken, 'motus': read_motus}
+
+
+class MatrixStore:
+    """A taxon x sample matrix stored in folder (see module documentation),
+    created if it does not exist.
+
+    - segment_size: how many added samples are buffered before being written
+        as a new segment (close() writes what remains)
+    """
+
+    def __init__(self, folder, segment_size=SEGMENT_SIZE):
+        self.folder = folder
+        self.segment_size = segment_size
+        self.lock = threading.Lock()
+        os.makedirs(os.path.join(folder, 'segments'), exist_ok=True)
+        self.taxa, self.names, self.ranks = [], [], []
+        taxa_file = os.path.join(folder, 'taxa.tsv')
+        if os.path.exists(taxa_file):
+            with open(taxa_file, 'r') as f:
+                for line in f:
+                    taxon, name, rank = line.rstrip('\n').split('\t')
+                    self.taxa.append(taxon)
+                    self.names.append(name)
+                    self.ranks.append(rank)
+        self.taxon_index = {taxon: i for i,taxon in enumerate(self.taxa)}
+        self.written_taxa = len(self.taxa)
+        # sample -> (segment, column)
+        self.locations = {}
+        samples_file = os.path.join(folder, 'samples.tsv')
+        if os.path.exists(samples_file):
+            with open(samples_file, 'r') as f:
+                for line in f:
+                    sample, segment, column = line.rstrip('\n').split('\t')
+                    self.locations[sample] = (segment, int(column))
+        self.segments = {}
+        self.buffer = []
+
+    def __contains__(self, sample):
+        with self.lock:
+            return sample in self.locations or any(sample==s for s,_,_ in self.buffer)
+
+    @property
+    def samples(self):
+        """Samples in the store (in the order they were first added)"""
+        with self.lock:
+            samples = dict.fromkeys(self.locations)
+            samples.update(dict.fromkeys(sample for sample,_,_ in self.buffer))
+        return list(samples)
+
+    def add(self, sample, taxa, names, ranks, values):
+        """Add (or replace) a sample column, as returned by a reader"""
+        with self.lock:
+            rows = np.empty(len(taxa), dtype=np.int32)
+            for i,(taxon,name,rank) in enumerate(zip(taxa, names, ranks)):
+                row = self.taxon_index.get(taxon)
+                if row is None:
+                    row = self.taxon_index[taxon] = len(self.taxa)
+                    self.taxa.append(taxon)
+                    self.names.append(name)
+                    self.ranks.append(rank)
+                rows[i] = row
+            order = np.argsort(rows, kind='stable')
+            self.buffer = [entry for entry in self.buffer if entry[0]!=sample]
+            self.buffer.append((sample, rows[order], np.asarray(values, dtype=np.float64)[order]))
+            if len(self.buffer)>=self.segment_size:
+                self._flush()
+
+    def _segment(self, segment):
+        if segment not in self.segments:
+            folder = os.path.join(self.folder, 'segments', segment)
+            self.segments[segment] = tuple(np.load(os.path.join(folder, f'{name}.npy'), mmap_mode='r')
+                                            for name in ('indptr', 'rows', 'values'))
+        return self.segments[segment]
+
+    def _write_segment(self, columns):
+        """Write columns ((sample, rows, values) tuples) as a new segment, return its name"""
+        existing = [int(name) for name in os.listdir(os.path.join(self.folder, 'segments'))
+                        if name.isdigit()]
+        segment = f'{max(existing, default=0)+1:05d}'
+        temp_folder = os.path.join(self.folder, 'segments', segment+'.tmp')
+        shutil.rmtree(temp_folder, ignore_errors=True)
+        os.makedirs(temp_folder)
+        np.save(os.path.join(temp_folder, 'indptr.npy'),
+            np.concatenate(([0], np.cumsum([len(rows) for _,rows,_ in columns]))).astype(np.int64))
+        np.save(os.path.join(temp_folder, 'rows.npy'),
+            np.concatenate([rows for _,rows,_ in columns]+[np.zeros(0, dtype=np.int32)]))
+        np.save(os.path.join(temp_folder, 'values.npy'),
+            np.concatenate([values for _,_,values in columns]+[np.zeros(0)]))
+        os.replace(temp_folder, os.path.join(self.folder, 'segments', segment))
+        return segment
+
+    def _write_index(self):
+        """Append the new taxa and rewrite the sample index atomically"""
+        with open(os.path.join(self.folder, 'taxa.tsv'), 'a') as f:
+            for i in range(self.written_taxa, len(self.taxa)):
+                f.write(f'{self.taxa[i]}\t{self.names[i]}\t{self.ranks[i]}\n')
+        self.written_taxa = len(self.taxa)
+        samples_file = os.path.join(self.folder, 'samples.tsv')
+        with open(samples_file+'.tmp', 'w') as f:
+            for sample,(segment,column) in self.locations.items():
+                f.write(f'{sample}\t{segment}\t{column}\n')
+        os.replace(samples_file+'.tmp', samples_file)
+
+    def _flush(self):
+        if not self.buffer:
+            return
+        segment = self._write_segment(self.buffer)
+        for column,(sample,_,_) in enumerate(self.buffer):
+            self.locations.pop(sample, None)
+            self.locations[sample] = (segment, column)
+        self.buffer = []
+        self._write_index()
+
+    def close(self):
+        """Write the buffered samples"""
+        with self.lock:
+            self._flush()
+
+    def column(self, sample):
+        """Return (taxon rows, values) of a sample"""
+        with self.lock:
+            for buffered,rows,values in self.buffer:
+                if buffered==sample:
+                    return rows, values
+            segment, column = self.locations[sample]
+        indptr, rows, values = self._segment(segment)
+        start, end = indptr[column], indptr[column+1]
+        return np.array(rows[start:end]), np.array(values[start:end])
+
+    def taxon_rows(self, taxa=None, rank=None):
+        """Rows of these taxa (keys), or of all the taxa of that rank, or all rows"""
+        if taxa is not None:
+            return np.array([self.taxon_index[taxon] for taxon in taxa], dtype=np.int64)
+        if rank is not None:
+            return np.flatnonzero(np.array(self.ranks, dtype=object)==rank)
+        return np.arange(len(self.taxa))
+
+    def load(self, samples=None, taxa=None, rank=None):
+        """Return (taxon rows, samples, dense matrix) for some samples (all by
+        default) and some taxa (keys) or the taxa of a rank (all by default)"""
+        self.close()
+        samples = self.samples if samples is None else list(samples)
+        taxon_rows = self.taxon_rows(taxa, rank)
+        # matrix row of each taxon row, -1 for unwanted taxa
+        wanted = np.full(len(self.taxa), -1, dtype=np.int64)
+        wanted[taxon_rows] = np.arange(len(taxon_rows))
+        matrix = np.zeros((len(taxon_rows), len(samples)))
+        by_segment = {}
+        for i,sample in enumerate(samples):
+            segment, column = self.locations[sample]
+            by_segment.setdefault(segment, []).append((i, column))
+        for segment,columns in by_segment.items():
+            indptr, rows, values = self._segment(segment)
+            if len(columns)*4<len(indptr):
+                # a few samples: only read their columns
+                for i,column in columns:
+                    start, end = indptr[column], indptr[column+1]
+                    matrix_rows = wanted[rows[start:end]]
+                    kept = matrix_rows>=0
+                    matrix[matrix_rows[kept], i] = values[start:end][kept]
+            else:
+                # read the rows of the whole segment, and only the wanted values
+                positions = np.flatnonzero(wanted[rows]>=0)
+                segment_columns = np.searchsorted(indptr, positions, side='right')-1
+                destination = np.full(len(indptr)-1, -1, dtype=np.int64)
+                for i,column in columns:
+                    destination[column] = i
+                kept = destination[segment_columns]>=0
+                positions = positions[kept]
+                matrix[wanted[rows[positions]], destination[segment_columns[kept]]] = values[positions]
+        return taxon_rows, samples, matrix
+
+    def write_tsv(self, filename, samples=None, taxa=None, rank=None):
+        """Write a (subset of the) matrix as a TSV file, a line per taxon"""
+        taxon_rows, samples, matrix = self.load(samples, taxa, rank)
+        with open(filename, 'w') as f:
+            f.write('\t'.join(['taxon', 'name', 'rank']+samples)+'\n')
+            for row,values in zip(taxon_rows, matrix):
+                f.write('\t'.join([self.taxa[row], self.names[row], self.ranks[row]]
+                    +[f'{value:g}' for value in values])+'\n')
+
+    def compact(self):
+        """Rewrite the store in a single segment, without the replaced columns"""
+        with self.lock:
+            self._flush()
+            columns = []
+            for sample,(segment,column) in self.locations.items():
+                indptr, rows, values = self._segment(segment)
+                start, end = indptr[column], indptr[column+1]
+                columns.append((sample, np.array(rows[start:end]), np.array(values[start:end])))
+            self.buffer = columns
+            self._flush()
+            self.segments = {}
+            kept = set(segment for segment,_ in self.locations.values())
+            for segment in os.listdir(os.path.join(self.folder, 'segments')):
+                if segment not in kept:
+                    shutil.rmtree(os.path.join(self.folder, 'segments', segment))
+
+
+class MatrixCollector:
+    """Add outputs to matrix stores as soon as their task is done.
+
+    - output_s3: where sample outputs are
+    - aggregations: (MatrixStore, reader, pattern) tuples, pattern being the
+        output path relative to output_s3 with {sample}, like
+        {sample}/{sample}.report
+    """
+
+    def __init__(self, output_s3, aggregations):
+        self.output_s3 = output_s3.rstrip('/')
+        self.aggregations = aggregations
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=MAX_PARALLEL_DOWNLOAD)
+        self.futures = {}
+
+    def _fetch(self, sample, replace):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            for store,reader,pattern in self.aggregations:
+                if not replace and sample in store:
+                    continue
+                local = os.path.join(temp_dir, os.path.basename(pattern.format(sample=sample)))
+                get(f'{self.output_s3}/{pattern.format(sample=sample)}', local)
+                store.add(sample, *reader(local))
+
+    def fetch(self, sample, replace=True):
+        """Start adding a sample outputs in the background (once), replacing
+        the sample if it is already in the stores unless replace is False"""
+        if sample not in self.futures:
+            self.futures[sample] = self.executor.submit(self._fetch, sample, replace)
+
+    def collect(self, samples):
+        """Add the samples that were not already fetched if they are not in
+        the stores yet (like resumed samples), wait for all the downloads and
+        write the stores"""
+        for sample in samples:
+            self.fetch(sample, replace=False)
+        for sample,future in self.futures.items():
+            try:
+                future.result()
+            except Exception as e:
+                print(f'No output for {sample}: {e}')
+        self.executor.shutdown()
+        for store,_,_ in self.aggregations:
+            store.close()
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(
+                    prog = 'Abundance matrix',
+                    description = 'Add local per-sample outputs to a matrix store, or export (a subset of) it as a TSV file.')
+    parser.add_argument('store', type=str,
+        help='The matrix store folder')
+    parser.add_argument('--add', type=str, nargs='+', default=[],
+        help='Output files to add, the sample being the file name without extension')
+    parser.add_argument('--reader', type=str, choices=list(READERS), default='kraken2',
+        help='The kind of files given with --add, default to kraken2 (a kraken2 report)')
+    parser.add_argument('--export', type=str, default=None,
+        help='Write the matrix in this TSV file')
+    parser.add_argument('--samples', type=str, nargs='+', default=None,
+        help='Only export these samples')
+    parser.add_argument('--taxa', type=str, nargs='+', default=None,
+        help='Only export these taxa (keys as in taxa.tsv)')
+    parser.add_argument('--rank', type=str, default=None,
+        help='Only export the taxa of this rank (like S for species in kraken2 reports)')
+    parser.add_argument('--compact', action='store_true',
+        help='Rewrite the store in a single segment')
+    args = parser.parse_args()
+
+    store = MatrixStore(args.store)
+    for filename in args.add:
+        sample = os.path.basename(filename).split('.')[0]
+        store.add(sample, *READERS[args.reader](filename))
+    store.close()
+    if args.compact:
+        store.compact()
+    if args.export:
+        store.write_tsv(args.export, samples=args.samples, taxa=args.taxa, rank=args.rank)
+    print(f'{len(store.samples)} samples, {len(store.taxa)} taxa in {args.store}')
@@ -0,0 +1,37 @@
+"""Sample packing: group several small samples in a single task.
+
+Each task pays for a container start and for its resources (databases) to be
+attached, which may be much longer than the analysis of a small sample. Packs
+are built on the fly, so that packing works with streaming discovery.
+
+The inputs of a task are all downloaded in /input, whatever their folder, so
+samples with files of the same name (like R1.fastq.gz in each sample folder)
+are never packed together: they would overwrite each other."""
+from common.scheduling import sample_size
+import os
+
+DEFAULT_PACK_SIZE = 1024**3
+
+
+def pack(sample_groups, max_samples, max_size=DEFAULT_PACK_SIZE):
+    """Group (sample, items) tuples in packs (lists of such tuples) of at most
+    max_samples samples and about max_size bytes of input (a sample bigger than
+    max_size is alone in its pack), samples in a pack having no input file
+    name in common. Yield each pack as soon as it is complete."""
+    current = []
+    current_size = 0
+    current_names = set()
+    for sample,items in sample_groups:
+        size = sample_size(items)
+        names = set(os.path.basename(item.name) for item in items)
+        if current and (len(current)>=max_samples or current_size+size>max_size
+                            or names & current_names):
+            yield current
+            current = []
+            current_size = 0
+            current_names = set()
+        current.append((sample, items))
+        current_size += size
+        current_names |= names
+    if current:
+        yield current
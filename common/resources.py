@@ -0,0 +1,132 @@
+"""Pre-extracted resources: avoid each worker gunzipping huge archives.
+
+A resource given as an archive (`s3://.../db.tgz|untar`) is downloaded as a
+single object and decompressed in a single thread by every new worker before
+its first task. prepare() extracts the archive once and publishes its content
+next to it, in a folder named after the archive identity (size and date, so
+that a new version of the archive gets a new folder):
+
+    s3://bucket/resource/db.tgz
+    s3://bucket/resource/db.tgz.<key>/...   the extracted files
+    s3://bucket/resource/db.tgz.<key>.done  written last, when the folder is complete
+
+A folder resource is copied file by file in parallel by the workers, with no
+decompression, into the same place as the archive would have been extracted.
+resource_uri() returns the folder when it is published, the archive otherwise,
+so launchers use it transparently."""
+from scitq.fetch import list_content, get, put, sync, FetchError, UnsupportedError
+import subprocess
+import tempfile
+import hashlib
+import shutil
+import argparse
+import os
+
+
+def _split(uri):
+    parent, name = uri.rstrip('/').rsplit('/', 1)
+    return parent, name
+
+def _archive_key(item):
+    return hashlib.sha1(f"{item.size}|{item.modification_date}".encode('utf-8')).hexdigest()[:16]
+
+def _archive_item(archive, items):
+    _, name = _split(archive)
+    for item in items:
+        if item.rel_name==name or item.name.endswith('/'+name):
+            return item
+    raise FetchError(f'{archive} does not exist')
+
+def archive_identity(archive):
+    """A key identifying the version of an archive (from its size and date)"""
+    parent, _ = _split(archive)
+    return _archive_key(_archive_item(archive, list_content(parent+'/', no_rec=True)))
+
+def prepared_folder(archive):
+    """Return the prepared folder of an archive if it is published, else None"""
+    parent, name = _split(archive)
+    try:
+        items = list_content(parent+'/', no_rec=True)
+        key = _archive_key(_archive_item(archive, items))
+    except (FetchError, UnsupportedError):
+        return None
+    if any(item.rel_name==f'{name}.{key}.done' for item in items):
+        return f'{parent}/{name}.{key}/'
+    return None
+
+def resource_uri(archive, action='untar'):
+    """The resource to use for an archive: its prepared folder if published,
+    the archive with its extraction action otherwise"""
+    if action=='untar':
+        folder = prepared_folder(archive)
+        if folder:
+            print(f'Using prepared resource {folder}')
+            return folder
+    return f'{archive}|{action}'
+
+def tool_resource(script, folder):
+    """Upload a local script (like common/subsample.py) in folder, named after
+    its content so that a modified script never replaces the one of a running
+    batch, unless it is already there, and return its URI. It is available
+    to tasks as /resource/<basename of the URI>."""
+    with open(script, 'rb') as f:
+        key = hashlib.sha1(f.read()).hexdigest()[:12]
+    stem, extension = os.path.splitext(os.path.basename(script))
+    folder = folder.rstrip('/')
+    name = f'{stem}.{key}{extension}'
+    try:
+        present = any(item.rel_name==name for item in list_content(folder+'/', no_rec=True))
+    except (FetchError, UnsupportedError, OSError):
+        # no such folder yet
+        present = False
+    if not present:
+        put(script, f'{folder}/{name}')
+    return f'{folder}/{name}'
+
+def extract(archive_file, destination):
+    """Extract a local tar archive, with pigz when available"""
+    if shutil.which('pigz') and archive_file.endswith('gz'):
+        subprocess.run(['tar', '--use-compress-program=pigz', '-xf', archive_file, '-C', destination],
+            check=True)
+    else:
+        subprocess.run(['tar', '-xf', archive_file, '-C', destination], check=True)
+
+def prepare(archive, work_dir=None):
+    """Extract an archive once and publish its content next to it, return the
+    prepared folder URI"""
+    folder = prepared_folder(archive)
+    if folder:
+        print(f'{archive} is already prepared in {folder}')
+        return folder
+    parent, name = _split(archive)
+    key = archive_identity(archive)
+    folder = f'{parent}/{name}.{key}/'
+    with tempfile.TemporaryDirectory(dir=work_dir) as temp_dir:
+        local_archive = os.path.join(temp_dir, name)
+        print(f'Downloading {archive}')
+        get(archive, local_archive)
+        content = os.path.join(temp_dir, 'content')
+        os.mkdir(content)
+        print(f'Extracting {name}')
+        extract(local_archive, content)
+        os.remove(local_archive)
+        print(f'Publishing to {folder}')
+        sync(content, folder)
+        done = os.path.join(temp_dir, f'{name}.{key}.done')
+        with open(done, 'w') as f:
+            f.write(archive+'\n')
+        put(done, f'{parent}/{name}.{key}.done')
+    return folder
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(
+                    prog = 'Resource preparation',
+                    description = 'Extract archive resources once and publish their content next to them, so that launchers use it instead of the archive.')
+    parser.add_argument('archives', type=str, nargs='+',
+        help='Archive URIs (like s3://bucket/resource/db.tgz)')
+    parser.add_argument('--work-dir', type=str, default=None,
+        help='Local folder where archives are extracted (it needs the space of the extracted archive), default to the system temporary folder')
+    args = parser.parse_args()
+    for archive in args.archives:
+        prepare(archive, work_dir=args.work_dir)
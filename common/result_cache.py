@@ -0,0 +1,352 @@
+"""Cross-run result cache: do not recompute a task which result already exists.
+
+A task result is identified by a key, a digest of what determines it:
+
+- its inputs content: the name (as seen by the task in /input), size and
+    ETag (md5) of each input object, so that the same files in another folder
+    give the same key (launchers list their inputs with ETags when the cache
+    is used), or, if the storage gives no ETag, its URI, size and date (only
+    the same files at the same place then give the same key),
+- its container (image and tag) and container options,
+- its resources identity: an archive is identified by its name and version
+    (see common.resources.archive_identity), which is also the name of its
+    prepared folder, and tools sent as resources are named after their content,
+- its command.
+
+When a task succeeded, its outputs (the files in its output folder, or only
+in some sample folders of it for packed tasks) are listed and recorded in a
+local index (an sqlite database in the cache folder) with its key. A later
+task with the same key, in any batch and for any output folder, is not
+created: the recorded outputs are checked (still there, with the same sizes)
+and copied into its output folder, server side when both are on the same
+remote, through a local temporary folder otherwise.
+
+Entries expire after ttl days (outputs of old batches may have been deleted)
+and the least recently used are evicted above max_entries, only the index
+being changed (outputs belong to their batch). A result copied to a new
+output is recorded at its new place, the newest copy being the most likely to
+be kept. The index can be queried and pruned with python -m common.result_cache.
+
+Launchers submit their tasks through a CachedSubmitter, which looks keys up
+by chunks (a single query per chunk) and restores the results found in
+parallel:
+
+    cache = ResultCache()
+    submitter = CachedSubmitter(TaskSubmitter(s), cache)
+    for unit in units:
+        submitter.submit(unit, items, **spec)
+    tasks, task_units, restored_units = submitter.wait()
+    join(s, tasks, on_success=cache.on_success(on_success))
+    cache.close()
+"""
+from scitq.fetch import list_content, copy, get, put, FetchError, UnsupportedError
+import concurrent.futures
+import threading
+import tempfile
+import argparse
+import datetime
+import hashlib
+import sqlite3
+import json
+import time
+import os
+
+from common import CACHE_DIR
+from common.resources import archive_identity
+from common.submission import DEFAULT_MAX_DELAY
+
+INDEX_FILE = os.path.join(CACHE_DIR, 'results.sqlite')
+DEFAULT_TTL_DAYS = 90
+DEFAULT_MAX_ENTRIES = 100000
+MAX_PARALLEL_LISTING = 8
+# keys per query of lookup
+QUERY_CHUNK = 500
+# tasks looked up at once by CachedSubmitter
+LOOKUP_CHUNK = 100
+DAY = 86400
+
+
+def _get(obj, key):
+    return obj[key] if type(obj)==dict else getattr(obj, key)
+
+def _connect(index):
+    os.makedirs(os.path.dirname(os.path.abspath(index)), exist_ok=True)
+    db = sqlite3.connect(index, timeout=60, check_same_thread=False)
+    with db:
+        db.execute('CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, output TEXT, '
+            'paths TEXT, files TEXT, created REAL, used REAL, hits INTEGER)')
+        db.execute('CREATE INDEX IF NOT EXISTS results_used ON results (used)')
+    return db
+
+
+class ResultCache:
+    """Look up task results of previous runs, and record the new ones.
+
+    - ttl: entries older than that (in days) are ignored, and evicted by close()
+    - max_entries: close() evicts the least recently used entries above that
+    - index: the sqlite index file
+    """
+
+    def __init__(self, ttl=DEFAULT_TTL_DAYS, max_entries=DEFAULT_MAX_ENTRIES, index=INDEX_FILE):
+        self.ttl = ttl*DAY
+        self.max_entries = max_entries
+        self.db = _connect(index)
+        self.identities = {}
+        self.pending = {}
+        self.records = []
+        self.hits = []
+        self.forgotten = []
+        self.lock = threading.Lock()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=MAX_PARALLEL_LISTING)
+        self.futures = []
+
+    def lookup(self, keys):
+        """Return the live entries of these keys (the others being absent),
+        as a dict key -> (output, paths, files)"""
+        keys = list(keys)
+        entries = {}
+        for start in range(0, len(keys), QUERY_CHUNK):
+            chunk = keys[start:start+QUERY_CHUNK]
+            for key,output,paths,files in self.db.execute(
+                    f'SELECT key, output, paths, files FROM results WHERE created>? '
+                    f'AND key IN ({",".join("?"*len(chunk))})', [time.time()-self.ttl]+chunk):
+                entries[key] = (output, json.loads(paths), json.loads(files))
+        return entries
+
+    def _resource_identity(self, resource):
+        if resource not in self.identities:
+            uri, _, action = resource.partition('|')
+            name = uri.rstrip('/').rsplit('/', 1)[-1]
+            if action:
+                try:
+                    # the name of the archive prepared folder
+                    name = f'{name}.{archive_identity(uri)}'
+                except (FetchError, UnsupportedError):
+                    name = uri
+                if action!='untar':
+                    name += f'|{action}'
+            self.identities[resource] = name
+        return self.identities[resource]
+
+    def key(self, spec, items):
+        """The key of a task, spec being Server.task_create arguments and
+        items the listing items of its inputs (from common.discovery)"""
+        lines = []
+        for item in items:
+            md5 = getattr(item, 'md5', None)
+            if md5:
+                lines.append(f"{item.name.rstrip('/').rsplit('/', 1)[-1]}|{item.size}|{md5}")
+            else:
+                date = getattr(item, 'modification_date', None)
+                lines.append(f"{item.name}|{item.size}|{date.isoformat() if date else ''}")
+        digest = hashlib.sha256()
+        for line in sorted(lines):
+            digest.update(f'input\t{line}\n'.encode('utf-8'))
+        for field in ['container', 'container_options', 'command']:
+            digest.update(f"{field}\t{spec.get(field) or ''}\n".encode('utf-8'))
+        for resource in sorted((spec.get('resource') or '').split()):
+            digest.update(f'resource\t{self._resource_identity(resource)}\n'.encode('utf-8'))
+        return digest.hexdigest()
+
+    def _copy(self, source, output, names):
+        try:
+            copy(f'{source}/', f'{output}/', file_list=names)
+        except UnsupportedError:
+            # not on the same remote
+            with tempfile.TemporaryDirectory() as temp_dir:
+                for name in names:
+                    get(f'{source}/{name}', os.path.join(temp_dir, name))
+                    put(os.path.join(temp_dir, name), f'{output}/{name}')
+
+    def restore(self, key, output, entry=None):
+        """If there is a result for key (entry being its lookup result if
+        already known), copy it into output (unless it is already there) and
+        return True, else return False"""
+        if entry is None:
+            entry = self.lookup([key]).get(key)
+        if entry is None:
+            return False
+        source, paths, files = entry
+        output = output.rstrip('/')
+        try:
+            listed = {}
+            for path in paths:
+                for item in list_content(f'{source}/{path}'):
+                    listed[path+item.rel_name] = item.size
+            missing = [name for name,size in files if listed.get(name)!=size]
+            if missing:
+                raise FetchError(f'{len(missing)} file(s) are missing or changed, like {missing[0]}')
+            if source!=output:
+                self._copy(source, output, [name for name,_ in files])
+        except (FetchError, UnsupportedError, OSError) as e:
+            print(f'Cached result {key[:12]} in {source} cannot be used ({e}), it is computed again')
+            with self.lock:
+                self.forgotten.append(key)
+            return False
+        with self.lock:
+            self.hits.append((key, output, paths, files))
+        return True
+
+    def watch(self, tasks, entries):
+        """Remember (key, output, paths) of each task (entries being in the
+        same order as tasks), paths being the folders of output holding the
+        task results ('' for all of output), to record them once succeeded"""
+        for task,entry in zip(tasks, entries):
+            self.pending[_get(task, 'task_id')] = entry
+
+    def _record(self, key, output, paths):
+        files = []
+        for path in paths:
+            for item in list_content(f'{output.rstrip("/")}/{path}'):
+                if not item.rel_name.endswith('/'):
+                    files.append((path+item.rel_name, item.size))
+        if files:
+            with self.lock:
+                self.records.append((key, output.rstrip('/'), paths, files))
+
+    def on_success(self, callback=None):
+        """A common.join on_success callback recording the results of a
+        watched task in the background, then calling callback if any"""
+        def on_success(task):
+            entry = self.pending.pop(_get(task, 'task_id'), None)
+            if entry is not None:
+                self.futures.append(self.executor.submit(self._record, *entry))
+            if callback:
+                callback(task)
+        return on_success
+
+    def evict(self):
+        """Remove expired entries and the least recently used ones above
+        max_entries, return how many entries were removed"""
+        with self.db:
+            removed = self.db.execute('DELETE FROM results WHERE created<=?',
+                [time.time()-self.ttl]).rowcount
+            removed += self.db.execute('DELETE FROM results WHERE key IN (SELECT key FROM results '
+                'ORDER BY used DESC LIMIT -1 OFFSET ?)', [self.max_entries]).rowcount
+        return removed
+
+    def close(self):
+        """Wait for the results being recorded, write the index and evict"""
+        for future in self.futures:
+            try:
+                future.result()
+            except Exception as e:
+                print(f'A result could not be recorded: {e}')
+        self.executor.shutdown()
+        now = time.time()
+        with self.db:
+            self.db.executemany('DELETE FROM results WHERE key=?', [[key] for key in self.forgotten])
+            self.db.executemany('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, '
+                'COALESCE((SELECT hits FROM results WHERE key=?), 0))',
+                [[key, output, json.dumps(paths), json.dumps(files), now, now, key]
+                    for key,output,paths,files in self.records])
+            self.db.executemany('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, '
+                'COALESCE((SELECT hits FROM results WHERE key=?), 0)+1)',
+                [[key, output, json.dumps(paths), json.dumps(files), now, now, key]
+                    for key,output,paths,files in self.hits])
+        self.evict()
+        self.db.close()
+        if self.hits or self.records:
+            print(f'Result cache: {len(self.hits)} task(s) restored, {len(self.records)} result(s) recorded')
+
+
+class CachedSubmitter:
+    """Submit tasks through a TaskSubmitter unless their result is in a
+    ResultCache, in which case it is restored instead.
+
+    - submitter: a common.submission.TaskSubmitter
+    - cache: a ResultCache, or None to submit every task
+    - chunk_size, max_delay: tasks are looked up by chunks of chunk_size, an
+        incomplete chunk being looked up when its first task was queued more
+        than max_delay seconds ago (like TaskSubmitter chunks)
+    """
+
+    def __init__(self, submitter, cache=None, chunk_size=LOOKUP_CHUNK, max_delay=DEFAULT_MAX_DELAY):
+        self.submitter = submitter
+        self.cache = cache
+        self.chunk_size = chunk_size
+        self.max_delay = max_delay
+        self.chunk = []
+        self.chunk_start = None
+        # units of the submitted tasks, in submission order, and of the restored ones
+        self.units = []
+        self.restored = []
+        self.entries = []
+
+    def submit(self, unit, items, paths=('',), **task_spec):
+        """Queue a task (same arguments as Server.task_create), unit being
+        what the caller wants back with it, items the listing items of its
+        inputs and paths the folders of its output holding its results"""
+        if self.cache is None:
+            self.submitter.submit(**task_spec)
+            self.units.append(unit)
+            return
+        if not self.chunk:
+            self.chunk_start = time.time()
+        self.chunk.append((unit, self.cache.key(task_spec, items), list(paths), task_spec))
+        if len(self.chunk)>=self.chunk_size or time.time()-self.chunk_start>self.max_delay:
+            self.flush()
+
+    def flush(self):
+        """Look up the current chunk, restore what is found and submit the rest"""
+        if not self.chunk:
+            return
+        chunk, self.chunk = self.chunk, []
+        found = self.cache.lookup(key for _,key,_,_ in chunk)
+        restores = {i: self.cache.executor.submit(self.cache.restore, key,
+                            task_spec['output'], found[key])
+                        for i,(_,key,_,task_spec) in enumerate(chunk) if key in found}
+        for i,(unit,key,paths,task_spec) in enumerate(chunk):
+            if i in restores and restores[i].result():
+                self.restored.append(unit)
+                continue
+            self.submitter.submit(**task_spec)
+            self.units.append(unit)
+            self.entries.append((key, task_spec['output'], paths))
+
+    def wait(self):
+        """Submit what remains and wait for the tasks to be created, return
+        the tasks, their units (in the same order) and the restored units"""
+        self.flush()
+        tasks = self.submitter.wait()
+        if self.cache is not None:
+            self.cache.watch(tasks, self.entries)
+            if self.restored:
+                print(f'Results of {len(self.restored)} task(s) copied from previous runs')
+        return tasks, self.units, self.restored
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(
+                    prog = 'Result cache',
+                    description = 'Show or prune the index of task results reused across runs by launchers with --result-cache.')
+    parser.add_argument('--list', action='store_true',
+        help='List entries (key, output, number of files, date, hits)')
+    parser.add_argument('--output', type=str, default=None,
+        help='Only the entries which output starts with this prefix')
+    parser.add_argument('--forget', action='store_true',
+        help='Remove the entries (of --output if given, all otherwise), for instance when their outputs were deleted')
+    parser.add_argument('--ttl', type=float, default=DEFAULT_TTL_DAYS,
+        help=f'Evict entries older than that (in days), default to {DEFAULT_TTL_DAYS}')
+    parser.add_argument('--max-entries', type=int, default=DEFAULT_MAX_ENTRIES,
+        help=f'Evict the least recently used entries above that, default to {DEFAULT_MAX_ENTRIES}')
+    parser.add_argument('--index', type=str, default=INDEX_FILE,
+        help=f'The index file, default to {INDEX_FILE}')
+    args = parser.parse_args()
+
+    cache = ResultCache(ttl=args.ttl, max_entries=args.max_entries, index=args.index)
+    prefix = (args.output or '').rstrip('/')
+    where, parameters = ('WHERE substr(output, 1, ?)=?', [len(prefix), prefix]) if prefix else ('', [])
+    if args.forget:
+        with cache.db:
+            print(f'{cache.db.execute(f"DELETE FROM results {where}", parameters).rowcount} entries removed')
+    if args.list:
+        for key,output,files,created,hits in cache.db.execute(
+                f'SELECT key, output, files, created, hits FROM results {where} ORDER BY created', parameters):
+            print(f'{key[:16]}\t{output}\t{len(json.loads(files))} files\t'
+                f'{datetime.datetime.fromtimestamp(created):%Y-%m-%d %H:%M}\t{hits} hits')
+    print(f'{cache.evict()} expired or least recently used entries evicted')
+    count, = cache.db.execute('SELECT COUNT(*) FROM results').fetchone()
+    print(f'{count} entries in {args.index}')
+    cache.executor.shutdown()
+    cache.db.close()
@@ -0,0 +1,127 @@
+"""Resume support: skip the samples whose outputs are already there.
+
+The output folder is listed once and each sample is checked against a list of
+expected files (patterns relative to the output folder, where {sample} is
+replaced by the sample name and shell wildcards are allowed). A local manifest
+also records the fingerprint of each sample inputs when its task succeeded
+(not when it is created, so that outputs of previous inputs left by a failed
+task are not taken for the new ones), so that samples whose inputs changed
+since can be recomputed."""
+from scitq.fetch import list_content, FetchError
+from fnmatch import fnmatch
+import hashlib
+import json
+import os
+
+from common import CACHE_DIR
+
+MANIFEST_DIR = os.path.join(CACHE_DIR, 'manifest')
+
+
+def _get(obj, key):
+    return obj[key] if type(obj)==dict else getattr(obj, key)
+
+def inputs_fingerprint(items):
+    """A digest of sample inputs (listing items from common.discovery): ETag
+    (md5) when the storage provides it, size and modification date otherwise"""
+    digest = hashlib.sha1()
+    for item in sorted(items, key=lambda item: item.name):
+        date = getattr(item, 'modification_date', None)
+        digest.update(f"{item.name}|{item.size}|{getattr(item,'md5',None) or (date.isoformat() if date else '')}\n".encode('utf-8'))
+    return digest.hexdigest()
+
+
+class ResumeIndex:
+    """Tell which samples need a task.
+
+    - output: the output folder URI, samples outputs are in {output}/{sample}/...
+    - patterns: expected files for a sample, like ['{sample}/{sample}.motus']
+    - resume: if False, every sample needs a task (the manifest is still updated)
+    - check_inputs: if True, a sample is only considered done if its inputs
+        are the same as when its task last succeeded (samples done before the
+        manifest existed are thus recomputed)
+    """
+
+    def __init__(self, output, patterns, resume=False, check_inputs=False):
+        self.output = output.rstrip('/')
+        self.patterns = patterns
+        self.resume = resume
+        self.check_inputs = check_inputs
+        self.manifest_file = os.path.join(MANIFEST_DIR,
+            hashlib.sha1(self.output.encode('utf-8')).hexdigest()+'.json')
+        self.manifest = {}
+        if os.path.exists(self.manifest_file):
+            with open(self.manifest_file, 'r') as f:
+                self.manifest = json.load(f)
+        self.skipped = 0
+        self.skipped_samples = []
+        self.outputs = {}
+        # task_id -> (sample, items) of its samples
+        self.pending = {}
+        if resume:
+            self._list_output()
+
+    def _list_output(self):
+        """List output once, grouping files per sample folder"""
+        try:
+            items = list_content(self.output)
+        except FetchError:
+            # output does not exist yet
+            items = []
+        for item in items:
+            rel_name = item.name[len(self.output)+1:] if item.name.startswith(self.output+'/') else item.rel_name
+            sample = rel_name.split('/')[0]
+            self.outputs.setdefault(sample, {})[rel_name] = item.size
+        print(f'Found {len(self.outputs)} sample folder(s) in {self.output}')
+
+    def is_done(self, sample, items=None):
+        """Return True if all expected outputs are there and not empty (and if
+        check_inputs is set, if inputs are unchanged)"""
+        if not self.resume:
+            return False
+        files = self.outputs.get(sample, {})
+        for pattern in self.patterns:
+            pattern = pattern.format(sample=sample)
+            if not any(size and fnmatch(rel_name, pattern) for rel_name,size in files.items()):
+                return False
+        if self.check_inputs and items is not None:
+            if self.manifest.get(sample)!=inputs_fingerprint(items):
+                return False
+        return True
+
+    def skip(self, sample, items=None):
+        """Same as is_done but count skipped samples"""
+        if self.is_done(sample, items):
+            self.skipped += 1
+            self.skipped_samples.append(sample)
+            return True
+        return False
+
+    def record(self, sample, items):
+        """Record sample inputs fingerprint once its outputs are done"""
+        self.manifest[sample] = inputs_fingerprint(items)
+
+    def watch(self, tasks, units):
+        """Remember the (sample, items) list of each task (units being in the
+        same order as tasks), to record them once the task succeeded"""
+        for task,unit in zip(tasks, units):
+            self.pending[_get(task, 'task_id')] = unit
+
+    def on_success(self, callback=None):
+        """A common.join on_success callback recording the samples of a
+        watched task, then calling callback if any"""
+        def on_success(task):
+            for sample,items in self.pending.pop(_get(task, 'task_id'), []):
+                self.record(sample, items)
+            if callback:
+                callback(task)
+        return on_success
+
+    def save(self):
+        if self.resume:
+            print(f'Resuming: {self.skipped} sample(s) already done were skipped')
+        os.makedirs(MANIFEST_DIR, exist_ok=True)
+        temp_file = self.manifest_file+'.tmp'
+        with open(temp_file, 'w') as f:
+            json.dump(self.manifest, f)
+        os.replace(temp_file, self.manifest_file)
@@ -0,0 +1,31 @@
+"""Task ordering: create the most expensive tasks first.
+
+scitq distributes pending tasks in creation order, so creating the longest
+tasks first (Longest Processing Time first) avoids ending a run with one huge
+sample running alone on a single worker."""
+import heapq
+
+
+def sample_size(items):
+    """Default cost of a sample: its total input size"""
+    return sum(item.size or 0 for item in items)
+
+def largest_first(inventory, cost=sample_size):
+    """Return inventory (a dict sample -> listing items as in
+    common.discovery.SampleDiscovery.inventory) items sorted by decreasing cost"""
+    return sorted(inventory.items(), key=lambda sample_items: cost(sample_items[1]),
+                  reverse=True)
+
+def simulate(durations, slots):
+    """Replay tasks durations, in this order, on slots parallel slots (workers x
+    concurrency), each task going to the first free slot. Return the makespan."""
+    if not durations:
+        return 0
+    free_at = [0]*min(slots, len(durations))
+    for duration in durations:
+        heapq.heappush(free_at, heapq.heappop(free_at)+duration)
+    return max(free_at)
+
+def lower_bound(durations, slots):
+    """No ordering can do better than that"""
+    return max(sum(durations)/slots, max(durations)) if durations else 0
@@ -0,0 +1,90 @@
+"""Batched task submission.
+
+scitq server has no bulk task creation endpoint, so task specs are queued and
+sent in chunks, several chunks at a time through a bounded thread pool, each
+chunk being a series of Server.task_create calls. Tasks are returned in the
+order they were submitted so that the list can be passed as is to Server.join."""
+import concurrent.futures
+import threading
+import time
+
+DEFAULT_PARALLEL = 8
+DEFAULT_CHUNK_SIZE = 20
+# an incomplete chunk is not kept longer than that (in seconds), so that when
+# tasks are submitted while the source is listed, the first ones start quickly
+DEFAULT_MAX_DELAY = 1
+
+
+class TaskSubmitter:
+    """Queue task specs (Server.task_create arguments) and create them in the
+    background.
+
+    - server: a scitq.lib.Server (or a common.fake.FakeServer)
+    - parallel: how many chunks are sent at the same time
+    - chunk_size: how many tasks are sent in a row by the same thread
+    - max_delay: a chunk is sent when full or when its first task was queued
+        more than max_delay seconds ago
+
+    Typical use:
+        submitter = TaskSubmitter(s)
+        for sample in samples:
+            submitter.submit(command=..., batch=batch, ...)
+        tasks = submitter.wait()
+        s.join(tasks, retry=2)
+    """
+
+    def __init__(self, server, parallel=DEFAULT_PARALLEL, chunk_size=DEFAULT_CHUNK_SIZE,
+            max_delay=DEFAULT_MAX_DELAY):
+        self.server = server
+        self.chunk_size = chunk_size
+        self.max_delay = max_delay
+        self.chunk_start = None
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=parallel)
+        # do not queue more chunks than can be sent soon, so that a streaming
+        # producer is slowed down rather than piling up specs in memory
+        self.slots = threading.BoundedSemaphore(parallel*2)
+        self.chunk = []
+        self.futures = []
+        self.submitted = 0
+        self.start = None
+
+    def __len__(self):
+        return self.submitted
+
+    def submit(self, **task_spec):
+        """Queue a task (same arguments as Server.task_create), return its rank"""
+        if self.start is None:
+            self.start = time.time()
+        if not self.chunk:
+            self.chunk_start = time.time()
+        self.chunk.append(task_spec)
+        self.submitted += 1
+        if len(self.chunk)>=self.chunk_size or time.time()-self.chunk_start>self.max_delay:
+            self.flush()
+        return self.submitted-1
+
+    def _send(self, chunk):
+        try:
+            return [self.server.task_create(**task_spec) for task_spec in chunk]
+        finally:
+            self.slots.release()
+
+    def flush(self):
+        """Send the current (possibly incomplete) chunk"""
+        if self.chunk:
+            self.slots.acquire()
+            self.futures.append(self.executor.submit(self._send, self.chunk))
+            self.chunk = []
+
+    def wait(self):
+        """Send what remains, wait for all tasks to be created and return them
+        in submission order"""
+        self.flush()
+        tasks = []
+        for future in self.futures:
+            tasks.extend(future.result())
+        self.executor.shutdown()
+        if tasks:
+            elapsed = time.time()-self.start
+            print(f'Submitted {len(tasks)} tasks in {elapsed:.1f}s ({len(tasks)/max(elapsed,1e-6):.1f} tasks/s)')
+        return tasks
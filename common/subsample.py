@@ -0,0 +1,124 @@
+"""Single pass, paired reservoir subsampling of an interleaved FASTQ stream.
+
+This is a standalone tool (it only needs numpy), sent to workers as a resource
+and used as a pipeline stage, replacing `seqtk sample` on each mate:
+
+    samtools fastq ... | python3 subsample.py -s 42 -n 20000000 | metaphlan ...
+
+Read pairs (8 lines: read 1 then read 2, as written by `samtools fastq` without
+-1/-2) are sampled together, so mates stay in sync, with a fixed seed, in one
+pass over the input, keeping only the sampled pairs in memory. Records are
+found by looking for newlines in large blocks with numpy, and the sampled
+positions are drawn in advance with Li's algorithm L, so that the time spent in
+python only depends on the number of sampled pairs. When the input has no more
+pairs than the requested depth, it is written unchanged, in input order.
+Without depth, the input is only copied (as it goes) and its pairs counted.
+
+The input depth (number of pairs) is written in the --report file, with the
+number of pairs written and whether the sample was subsampled."""
+import argparse
+import math
+import sys
+
+import numpy as np
+
+BLOCK_SIZE = 64*1024**2
+LINES_PER_PAIR = 8
+NEWLINE = ord('\n')
+AT = ord('@')
+
+
+def replacements(depth, rng):
+    """Yield (pair index, reservoir slot) for the pairs past the first depth
+    ones which enter the reservoir (algorithm L)"""
+    w = math.exp(math.log(rng.random())/depth)
+    index = depth-1
+    while True:
+        index += int(math.log(rng.random())/math.log1p(-w))+1
+        yield index, int(rng.integers(depth))
+        w *= math.exp(math.log(rng.random())/depth)
+
+
+def pairs(stream, block_size=BLOCK_SIZE):
+    """Yield blocks of complete pairs as (buffer, pair start offsets, pair end
+    offsets)"""
+    rest = b''
+    while True:
+        block = stream.read(block_size)
+        buffer = rest+block if rest else block
+        newlines = np.flatnonzero(np.frombuffer(buffer, dtype=np.uint8)==NEWLINE)
+        complete = len(newlines)//LINES_PER_PAIR*LINES_PER_PAIR
+        if complete:
+            ends = newlines[LINES_PER_PAIR-1:complete:LINES_PER_PAIR]+1
+            starts = np.concatenate(([0], ends[:-1]))
+            data = np.frombuffer(buffer, dtype=np.uint8)
+            if (data[starts]!=AT).any() or (data[newlines[3:complete:LINES_PER_PAIR]+1]!=AT).any():
+                raise RuntimeError('Input is not an interleaved FASTQ (4 lines per read, read 1 then read 2)')
+            yield buffer, starts, ends
+            rest = buffer[ends[-1]:]
+        else:
+            rest = buffer
+        if not block:
+            if rest.strip():
+                raise RuntimeError('Input ends with an incomplete read pair')
+            return
+
+
+def copy_pairs(input, output, block_size=BLOCK_SIZE):
+    """Copy input to output, return the number of input pairs"""
+    pair_count = 0
+    for buffer,starts,ends in pairs(input, block_size):
+        output.write(buffer[:ends[-1]])
+        pair_count += len(starts)
+    output.flush()
+    return pair_count
+
+def subsample(input, output, depth, seed, block_size=BLOCK_SIZE):
+    """Write at most depth pairs from input to output, return the number of
+    input pairs"""
+    rng = np.random.default_rng(seed)
+    reservoir = []
+    next_replacement = replacements(depth, rng)
+    index, slot = next(next_replacement)
+    count = 0
+    for buffer,starts,ends in pairs(input, block_size):
+        block_end = count+len(starts)
+        filled = min(max(depth-count, 0), len(starts))
+        for i in range(filled):
+            reservoir.append(buffer[starts[i]:ends[i]])
+        while index<block_end:
+            i = index-count
+            reservoir[slot] = buffer[starts[i]:ends[i]]
+            index, slot = next(next_replacement)
+        count = block_end
+    for pair in reservoir:
+        output.write(pair)
+    output.flush()
+    return count
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(
+                    prog = 'Paired subsampling',
+                    description = 'Sample read pairs of an interleaved FASTQ (from stdin to stdout) in a single pass.')
+    parser.add_argument('-n', '--depth', type=int, default=None,
+        help='Number of pairs to keep, if not set all pairs are kept and only counted')
+    parser.add_argument('-s', '--seed', type=int, default=None,
+        help='Seed of the sampling')
+    parser.add_argument('--report', type=str, default=None,
+        help='A TSV file where to write the input depth')
+    parser.add_argument('--name', type=str, default='',
+        help='Sample name for the report')
+    args = parser.parse_args()
+
+    if args.depth is None:
+        pair_count = copy_pairs(sys.stdin.buffer, sys.stdout.buffer)
+        kept = pair_count
+    else:
+        pair_count = subsample(sys.stdin.buffer, sys.stdout.buffer, args.depth, args.seed)
+        kept = min(pair_count, args.depth)
+    if args.report:
+        with open(args.report, 'w') as f:
+            f.write('sample\tinput_pairs\toutput_pairs\tsubsampled\n')
+            f.write(f'{args.name}\t{pair_count}\t{kept}\t{int(kept<pair_count)}\n')
+    print(f'{pair_count} pairs, {kept} kept', file=sys.stderr)
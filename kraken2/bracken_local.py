@@ -0,0 +1,460 @@
+"""Local bracken re-estimation, replacing --only-bracken tasks.
+
+Bracken only needs the k-mer distribution of the database for a read length
+(databaseXmers.kmer_distrib, next to the kraken2 database): for each taxon
+to which kraken2 assigns reads (mapped taxon), the fraction of the k-mers of
+each genome of the database that are mapped to it. It is read once into a
+sparse matrix (mapped taxa x genomes, compressed sparse rows) which is cached
+in numpy format in the local cache, per database version and read length.
+
+Reports are then re-estimated by batches, like bracken does: the reads that
+kraken2 assigned above the level (to a genus for the species level) are
+distributed between the taxa of that level present in the report (with at
+least threshold clade reads), in proportion of their clade reads times the
+probability that a read of one of their genomes is assigned to that node.
+For a batch, this is a few sparse products of the distribution rows of the
+nodes with reads by the (report x genome) weights, instead of a python loop
+per report and node. Several levels and read lengths are done in the same
+pass, each distribution being loaded once.
+
+Outputs are the same as bracken: sample.bracken (the estimated reads of each
+taxon of the level) and sample-bracken.report (the kraken2 report with the
+new estimates, without the nodes below the level).
+
+A kraken2 database given as an archive URI is not downloaded when it is
+prepared (see common/resources.py), only the kmer_distrib file is."""
+from scitq.fetch import get, put
+import concurrent.futures
+import subprocess
+import tempfile
+import argparse
+import hashlib
+import shutil
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common import CACHE_DIR
+from common.resources import archive_identity, prepared_folder
+
+BRACKEN_DIR = os.path.join(CACHE_DIR, 'bracken')
+DEFAULT_READ_LENGTH = 100
+DEFAULT_LEVEL = 'S'
+DEFAULT_THRESHOLD = 10
+LEVELS = ['D', 'P', 'C', 'O', 'F', 'G', 'S', 'S1']
+# the largest (reports x distribution entries) arrays of a batch
+MAX_CELLS = 20000000
+# reports parsed at once by reestimate
+REPORTS_PER_PASS = 500
+MAX_PARALLEL_TRANSFER = 8
+BRACKEN_HEADER = ['name', 'taxonomy_id', 'taxonomy_lvl', 'kraken_assigned_reads',
+    'added_reads', 'new_est_reads', 'fraction_total_reads']
+
+
+def kmer_distrib_name(read_length):
+    return f'database{read_length}mers.kmer_distrib'
+
+def output_names(sample, level, read_length, suffixed=False):
+    """(bracken output, bracken report) file names of a sample, suffixed with
+    the level and read length when several are estimated at once"""
+    suffix = f'.{level}{read_length}' if suffixed else ''
+    return f'{sample}{suffix}.bracken', f'{sample}{suffix}-bracken.report'
+
+
+class KmerDistribution:
+    """A bracken k-mer distribution: mapped taxa x genomes fractions, in
+    compressed sparse rows (mapped and genomes are sorted taxids)"""
+
+    def __init__(self, mapped, indptr, columns, fractions, genomes):
+        self.mapped = mapped
+        self.indptr = indptr
+        self.columns = columns
+        self.fractions = fractions
+        self.genomes = genomes
+
+    @classmethod
+    def read(cls, filename):
+        """Read a databaseXmers.kmer_distrib file, which lines are a mapped
+        taxid and genome_taxid:mapped_kmers:genome_kmers triplets"""
+        rows = {}
+        with open(filename, 'r') as f:
+            for line in f:
+                fields = line.rstrip('\n').split('\t')
+                if len(fields)<2 or not fields[0].isdigit():
+                    # header
+                    continue
+                genomes, fractions = [], []
+                for triplet in fields[1].split():
+                    genome, mapped_kmers, genome_kmers = triplet.split(':')
+                    if float(genome_kmers)>0:
+                        genomes.append(int(genome))
+                        fractions.append(float(mapped_kmers)/float(genome_kmers))
+                rows[int(fields[0])] = (genomes, fractions)
+        mapped = np.array(sorted(rows), dtype=np.int64)
+        lengths = np.array([len(rows[taxid][0]) for taxid in mapped.tolist()], dtype=np.int64)
+        indptr = np.concatenate(([0], np.cumsum(lengths)))
+        genome_taxids = np.fromiter((genome for taxid in mapped.tolist() for genome in rows[taxid][0]),
+            dtype=np.int64, count=int(indptr[-1]))
+        fractions = np.fromiter((fraction for taxid in mapped.tolist() for fraction in rows[taxid][1]),
+            dtype=np.float64, count=int(indptr[-1]))
+        genomes, columns = np.unique(genome_taxids, return_inverse=True)
+        return cls(mapped, indptr, columns.astype(np.int64), fractions, genomes)
+
+    def save(self, filename):
+        temp_file = filename+'.tmp.npz'
+        np.savez(temp_file, mapped=self.mapped, indptr=self.indptr, columns=self.columns,
+            fractions=self.fractions, genomes=self.genomes)
+        os.replace(temp_file, filename)
+
+    @classmethod
+    def load(cls, filename):
+        with np.load(filename) as data:
+            return cls(data['mapped'], data['indptr'], data['columns'], data['fractions'],
+                data['genomes'])
+
+
+def cache_kmer_distrib(database, read_length=DEFAULT_READ_LENGTH, subfolder=''):
+    """Return the cached numpy version of the k-mer distribution of a kraken2
+    database for a read length, database being a local database folder, or
+    the URI of a database archive (subfolder being the database folder in
+    the archive, like --database of scitq_kraken2.py)"""
+    member = '/'.join(part for part in [subfolder.strip('/'), kmer_distrib_name(read_length)] if part)
+    if '://' in database:
+        name = database.rstrip('/').rsplit('/', 1)[-1]
+        key = f'{name}.{archive_identity(database)}'
+    else:
+        source = os.path.join(database, member)
+        if not os.path.exists(source):
+            raise RuntimeError(f'There is no {member} in {database}, build it with bracken-build -l {read_length}')
+        status = os.stat(source)
+        key = hashlib.sha1(f'{os.path.abspath(source)}|{status.st_size}|{status.st_mtime}'.encode('utf-8')).hexdigest()[:16]
+    cache_file = os.path.join(BRACKEN_DIR, key, member.replace('/', '_')+'.npz')
+    if os.path.exists(cache_file):
+        return cache_file
+    with tempfile.TemporaryDirectory() as temp_dir:
+        if '://' not in database:
+            distribution = KmerDistribution.read(source)
+        else:
+            local = os.path.join(temp_dir, kmer_distrib_name(read_length))
+            folder = prepared_folder(database)
+            if folder:
+                get(folder+member, local)
+            else:
+                print(f'{database} is not prepared (see common/resources.py), downloading it to extract {member}')
+                archive = os.path.join(temp_dir, name)
+                get(database, archive)
+                content = os.path.join(temp_dir, 'content')
+                os.mkdir(content)
+                subprocess.run(['tar', '-xf', archive, '-C', content, '--wildcards',
+                    '--no-anchored', member], check=False)
+                os.remove(archive)
+                found = [os.path.join(path, kmer_distrib_name(read_length))
+                            for path,_,files in os.walk(content) if kmer_distrib_name(read_length) in files]
+                if not found:
+                    raise RuntimeError(f'There is no {member} in {database}, build it with bracken-build -l {read_length}')
+                local = found[0]
+            distribution = KmerDistribution.read(local)
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    distribution.save(cache_file)
+    return cache_file
+
+
+class Report:
+    """A kraken2 report: its nodes in report order (taxids, rank codes, raw
+    name fields with their indentation, clade and direct reads, depth and
+    parent node index or -1) and its unclassified reads"""
+
+    def __init__(self, filename):
+        with open(filename, 'r') as f:
+            rows = [fields for fields in (line.rstrip('\n').split('\t') for line in f) if len(fields)>=6]
+        # with --report-minimizer-data, two columns are inserted before the rank
+        taxids = np.fromiter(map(int, (fields[-2] for fields in rows)), dtype=np.int64, count=len(rows))
+        clade = np.fromiter(map(int, (fields[1] for fields in rows)), dtype=np.int64, count=len(rows))
+        self.unclassified = int(clade[taxids==0].sum())
+        classified = taxids!=0
+        nodes = [fields for fields,node in zip(rows, classified.tolist()) if node]
+        self.taxids = taxids[classified]
+        self.clade = clade[classified].astype(np.float64)
+        self.direct = np.fromiter(map(float, (fields[2] for fields in nodes)), dtype=np.float64, count=len(nodes))
+        self.ranks = [fields[-3].strip() for fields in nodes]
+        self.names = [fields[-1] for fields in nodes]
+        # names are indented by 2 spaces per depth
+        self.depths = np.array([(len(name)-len(name.lstrip(' ')))//2 for name in self.names], dtype=np.int64)
+        # the parent of a node is the last node before it that is one level up
+        self.parents = np.full(len(self.names), -1, dtype=np.int64)
+        indexes = np.arange(len(self.names))
+        for depth in range(1, int(self.depths.max(initial=0))+1):
+            above = indexes[self.depths==depth-1]
+            children = indexes[self.depths==depth]
+            positions = np.searchsorted(above, children)-1
+            self.parents[children[positions>=0]] = above[positions[positions>=0]]
+        self.ancestors = {}
+
+    def level_nodes(self, level):
+        """For each node, the index of its ancestor (or itself) at that level, or -1"""
+        if level not in self.ancestors:
+            indexes = np.arange(len(self.taxids))
+            ancestors = np.where(np.array(self.ranks)==level, indexes, -1)
+            # parents being above their children, ancestors are set one depth at a time
+            for depth in range(1, int(self.depths.max(initial=0))+1):
+                nodes = indexes[(self.depths==depth) & (ancestors<0)]
+                ancestors[nodes] = ancestors[self.parents[nodes]]
+            self.ancestors[level] = ancestors
+        return self.ancestors[level]
+
+
+def _lookup(sorted_values, values):
+    """Positions of values in sorted_values, -1 when absent"""
+    if len(sorted_values)==0:
+        return np.full(len(values), -1, dtype=np.int64)
+    positions = np.searchsorted(sorted_values, values)
+    positions[positions>=len(sorted_values)] = 0
+    return np.where(sorted_values[positions]==values, positions, -1)
+
+def _estimate_batch(reports, distribution, level, threshold):
+    """Re-estimate a batch of reports, return for each report (indexes of the
+    level nodes kept, added reads)"""
+    kept, weights_of, reads_of = [], [], []
+    for report in reports:
+        ancestors = report.level_nodes(level)
+        is_kept = (ancestors==np.arange(len(ancestors))) & (report.clade>=threshold)
+        kept.append(np.flatnonzero(is_kept))
+        # genomes present in the report, weighted by the clade reads of their level taxon
+        genomes = _lookup(distribution.genomes, report.taxids)
+        present = (genomes>=0) & (ancestors>=0)
+        present[present] = is_kept[ancestors[present]]
+        weights_of.append((genomes[present], report.taxids[ancestors[present]],
+            report.clade[ancestors[present]]))
+        # reads assigned above the level are distributed
+        above = (ancestors<0) & (report.direct>0)
+        rows = _lookup(distribution.mapped, report.taxids[above])
+        reads_of.append((rows[rows>=0], report.direct[above][rows>=0]))
+
+    # the distribution entries of the rows with reads, restricted to the genomes present
+    rows = np.unique(np.concatenate([rows for rows,_ in reads_of]))
+    genomes = np.unique(np.concatenate([genomes for genomes,_,_ in weights_of]))
+    starts, lengths = distribution.indptr[rows], distribution.indptr[rows+1]-distribution.indptr[rows]
+    entries = np.repeat(starts-np.cumsum(lengths)+lengths, lengths)+np.arange(lengths.sum())
+    entry_rows = np.repeat(np.arange(len(rows)), lengths)
+    entry_genomes = _lookup(genomes, distribution.columns[entries])
+    selected = entry_genomes>=0
+    entry_rows, entry_genomes = entry_rows[selected], entry_genomes[selected]
+    fractions = distribution.fractions[entries[selected]]
+
+    weights = np.zeros((len(reports), len(genomes)))
+    reads = np.zeros((len(reports), len(rows)))
+    genome_levels = np.zeros(len(genomes), dtype=np.int64)
+    for i,((present_genomes, level_taxids, clade),(read_rows, direct)) in enumerate(zip(weights_of, reads_of)):
+        columns = np.searchsorted(genomes, present_genomes)
+        weights[i, columns] = clade
+        genome_levels[columns] = level_taxids
+        reads[i, np.searchsorted(rows, read_rows)] = direct
+    levels, entry_levels = np.unique(genome_levels[entry_genomes], return_inverse=True)
+
+    added = np.zeros((len(reports), len(levels)))
+    if len(fractions):
+        # reads of a row go to its entries in proportion of fraction x weight
+        entry_weights = weights[:, entry_genomes]*fractions
+        present_rows, firsts = np.unique(entry_rows, return_index=True)
+        totals = np.zeros_like(reads)
+        totals[:, present_rows] = np.add.reduceat(entry_weights, firsts, axis=1)
+        shares = np.divide(reads, totals, out=np.zeros_like(reads), where=totals>0)
+        entry_weights *= shares[:, entry_rows]
+        order = np.argsort(entry_levels, kind='stable')
+        present_levels, firsts = np.unique(entry_levels[order], return_index=True)
+        added[:, present_levels] = np.add.reduceat(entry_weights[:, order], firsts, axis=1)
+
+    results = []
+    for i,(report,nodes) in enumerate(zip(reports, kept)):
+        columns = _lookup(levels, report.taxids[nodes])
+        node_added = np.zeros(len(nodes))
+        node_added[columns>=0] = added[i, columns[columns>=0]]
+        results.append((nodes, node_added))
+    return results
+
+def estimate(reports, distribution, level=DEFAULT_LEVEL, threshold=DEFAULT_THRESHOLD,
+        max_cells=MAX_CELLS):
+    """Re-estimate reports at a level, return for each report (indexes of the
+    level nodes kept, added reads), reports being done by batches which
+    arrays are at most max_cells"""
+    results = []
+    batch, batch_rows, batch_entries = [], set(), 0
+    for report in reports:
+        ancestors = report.level_nodes(level)
+        rows = _lookup(distribution.mapped, report.taxids[(ancestors<0) & (report.direct>0)])
+        new_rows = set(rows[rows>=0].tolist())-batch_rows
+        entries = batch_entries+sum(int(distribution.indptr[row+1]-distribution.indptr[row]) for row in new_rows)
+        if batch and (len(batch)+1)*entries>max_cells:
+            results.extend(_estimate_batch(batch, distribution, level, threshold))
+            batch, batch_rows, batch_entries = [], set(), 0
+            new_rows = set(rows[rows>=0].tolist())
+            entries = sum(int(distribution.indptr[row+1]-distribution.indptr[row]) for row in new_rows)
+        batch.append(report)
+        batch_rows |= new_rows
+        batch_entries = entries
+    if batch:
+        results.extend(_estimate_batch(batch, distribution, level, threshold))
+    return results
+
+
+def write_bracken(report, nodes, added, level, filename):
+    """Write bracken output (taxa sorted by decreasing estimated reads)"""
+    assigned = report.clade[nodes].astype(np.int64)
+    added = np.round(added).astype(np.int64)
+    estimated = assigned+added
+    total = estimated.sum()
+    fractions = estimated/total if total else np.zeros(len(estimated))
+    order = np.argsort(-estimated, kind='stable')
+    lines = ['\t'.join(BRACKEN_HEADER)]
+    for node,taxid,assigned_reads,added_reads,estimated_reads,fraction in zip(nodes[order].tolist(),
+            report.taxids[nodes[order]].tolist(), assigned[order].tolist(), added[order].tolist(),
+            estimated[order].tolist(), fractions[order].tolist()):
+        lines.append(f'{report.names[node].strip()}\t{taxid}\t{level}\t{assigned_reads}\t'
+            f'{added_reads}\t{estimated_reads}\t{fraction:.5f}')
+    with open(filename, 'w') as f:
+        f.write('\n'.join(lines)+'\n')
+
+def write_bracken_report(report, nodes, added, filename):
+    """Write the kraken2 report with the new estimates: level nodes have their
+    estimated reads, their ancestors the sum of them, other nodes are removed"""
+    estimated = np.zeros(len(report.taxids), dtype=np.int64)
+    estimated[nodes] = report.clade[nodes].astype(np.int64)+np.round(added).astype(np.int64)
+    # clade reads, summed one depth at a time from the deepest
+    clade = estimated.copy()
+    for depth in range(int(report.depths.max(initial=0)), 0, -1):
+        at_depth = np.flatnonzero(report.depths==depth)
+        np.add.at(clade, report.parents[at_depth], clade[at_depth])
+    # nodes below the level
+    is_level = np.zeros(len(report.taxids), dtype=bool)
+    is_level[nodes] = True
+    below = np.zeros(len(report.taxids), dtype=bool)
+    for depth in range(1, int(report.depths.max(initial=0))+1):
+        at_depth = np.flatnonzero(report.depths==depth)
+        parents = report.parents[at_depth]
+        below[at_depth] = is_level[parents] | below[parents]
+    total = report.unclassified+int(estimated.sum())
+    lines = []
+    if report.unclassified:
+        lines.append(f'{report.unclassified/total*100:6.2f}\t{report.unclassified}\t'
+            f'{report.unclassified}\tU\t0\tunclassified')
+    shown = np.flatnonzero((clade>0) & ~below)
+    for node,clade_reads,reads,taxid in zip(shown.tolist(), clade[shown].tolist(),
+            estimated[shown].tolist(), report.taxids[shown].tolist()):
+        lines.append(f'{clade_reads/total*100:6.2f}\t{clade_reads}\t{reads}\t{report.ranks[node]}\t'
+            f'{taxid}\t{report.names[node]}')
+    with open(filename, 'w') as f:
+        f.write('\n'.join(lines)+'\n')
+
+
+# the distributions of the current process (set once per process of the pool)
+_distributions = None
+
+def _init_process(distributions):
+    global _distributions
+    _distributions = {read_length: KmerDistribution.load(cache_file)
+                        for read_length,cache_file in distributions.items()}
+
+def _reestimate_chunk(reports, levels, threshold, output, max_cells):
+    """Write bracken outputs of some reports (a list of (sample, file)) with
+    the distributions of this process, return the samples"""
+    parsed = [Report(filename) for _,filename in reports]
+    suffixed = len(levels)*len(_distributions)>1
+    for read_length,distribution in _distributions.items():
+        for level in levels:
+            results = estimate(parsed, distribution, level, threshold, max_cells)
+            for (sample,_),report,(nodes,added) in zip(reports, parsed, results):
+                bracken, bracken_report = output_names(sample, level, read_length, suffixed)
+                os.makedirs(os.path.join(output, sample), exist_ok=True)
+                write_bracken(report, nodes, added, level, os.path.join(output, sample, bracken))
+                write_bracken_report(report, nodes, added, os.path.join(output, sample, bracken_report))
+    return [sample for sample,_ in reports]
+
+def reestimate(reports, distributions, levels=[DEFAULT_LEVEL], threshold=DEFAULT_THRESHOLD,
+        output='.', processes=1, on_done=None, max_cells=MAX_CELLS):
+    """Write bracken outputs of reports (a dict sample -> local report file)
+    into output/<sample>/ for each level and each read length of
+    distributions (a dict read length -> cache_kmer_distrib file).
+
+    Reports are done by chunks of at most REPORTS_PER_PASS in a pool of that
+    many processes (in the calling process if 1), on_done being called with
+    the samples of each chunk once their outputs are written."""
+    reports = list(reports.items())
+    size = max(1, min(REPORTS_PER_PASS, -(-len(reports)//processes)))
+    chunks = [reports[start:start+size] for start in range(0, len(reports), size)]
+    if processes>1 and len(chunks)>1:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=processes,
+                initializer=_init_process, initargs=(distributions,)) as pool:
+            futures = [pool.submit(_reestimate_chunk, chunk, levels, threshold, output, max_cells)
+                        for chunk in chunks]
+            for future in concurrent.futures.as_completed(futures):
+                samples = future.result()
+                if on_done:
+                    on_done(samples)
+    else:
+        _init_process(distributions)
+        for chunk in chunks:
+            samples = _reestimate_chunk(chunk, levels, threshold, output, max_cells)
+            if on_done:
+                on_done(samples)
+
+def reestimate_s3(reports, output_s3, distributions, levels=[DEFAULT_LEVEL],
+        threshold=DEFAULT_THRESHOLD, processes=1, max_cells=MAX_CELLS):
+    """Same as reestimate for reports given as URIs (a dict sample -> URI),
+    outputs being uploaded into output_s3/<sample>/ as soon as they are
+    written, return the samples done"""
+    output_s3 = output_s3.rstrip('/')
+    done = []
+    with tempfile.TemporaryDirectory() as temp_dir, \
+            concurrent.futures.ThreadPoolExecutor(max_workers=MAX_PARALLEL_TRANSFER) as executor:
+        local_reports = {sample: os.path.join(temp_dir, 'reports', f'{sample}.report') for sample in reports}
+        os.makedirs(os.path.join(temp_dir, 'reports'))
+        print(f'Downloading {len(reports)} reports')
+        for _ in executor.map(lambda sample: get(reports[sample], local_reports[sample]), reports):
+            pass
+        output = os.path.join(temp_dir, 'output')
+        def upload(sample):
+            folder = os.path.join(output, sample)
+            for name in os.listdir(folder):
+                put(os.path.join(folder, name), f'{output_s3}/{sample}/{name}')
+            shutil.rmtree(folder)
+            os.remove(local_reports[sample])
+            return sample
+        uploads = []
+        def chunk_done(samples):
+            uploads.extend(executor.submit(upload, sample) for sample in samples)
+            print(f'Re-estimated {len(uploads)}/{len(reports)} reports')
+        reestimate(local_reports, distributions, levels, threshold, output, processes=processes,
+            on_done=chunk_done, max_cells=max_cells)
+        for future in concurrent.futures.as_completed(uploads):
+            done.append(future.result())
+    return done
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(
+                    prog = 'Local bracken',
+                    description = 'Re-estimate kraken2 reports like bracken does, all reports at once.')
+    parser.add_argument('reports', type=str, nargs='+',
+        help='kraken2 reports (local files, the sample being the file name without .report)')
+    parser.add_argument('-d', '--db', type=str, required=True,
+        help='The kraken2 database folder with its kmer_distrib files, or its archive URI')
+    parser.add_argument('--database', type=str, default='',
+        help='With an archive, the database subfolder in it')
+    parser.add_argument('-r', '--read-length', type=int, nargs='+', default=[DEFAULT_READ_LENGTH],
+        help=f'Read lengths (there must be a kmer_distrib file for each), default to {DEFAULT_READ_LENGTH}')
+    parser.add_argument('-l', '--level', type=str, nargs='+', choices=LEVELS, default=[DEFAULT_LEVEL],
+        help=f'Levels, default to {DEFAULT_LEVEL}')
+    parser.add_argument('-t', '--threshold', type=int, default=DEFAULT_THRESHOLD,
+        help=f'Minimal clade reads of a taxon to be kept, default to {DEFAULT_THRESHOLD}')
+    parser.add_argument('-o', '--output', type=str, default='.',
+        help='Folder where each sample outputs are written (in a sample subfolder)')
+    parser.add_argument('--processes', type=int, default=os.cpu_count(),
+        help='How many processes re-estimate reports, default to CPU count')
+    args = parser.parse_args()
+
+    distributions = {read_length: cache_kmer_distrib(args.db, read_length, args.database)
+                        for read_length in args.read_length}
+    reports = {os.path.basename(report).rsplit('.report', 1)[0]: report for report in args.reports}
+    reestimate(reports, distributions, args.level, args.threshold, args.output, processes=args.processes)
@@ -0,0 +1,243 @@
+"""Compact, compressed, columnar storage of kraken2 per-read output.
+
+kraken2 writes a line per read (or pair): classified flag, read id, taxon,
+length and the taxa of its k-mers. Stored as text, this is often bigger than
+the gzipped input. This is a standalone tool (the conversion only needs the
+python standard library, so that it runs in the kraken2 container), sent to
+workers as a resource and used as a pipeline stage:
+
+    kraken2 ... --output - | python3 kraken_columns.py -o /output/sample.kraken.k2c
+
+Reads are stored by blocks, each block holding one zlib compressed column
+per field:
+
+- read_id: read names,
+- taxid: assigned taxid (0 for unclassified reads), the taxa names given by
+    kraken2 --use-names being kept once per block (names column),
+- length1, length2: read lengths (length2 is 0 for single reads),
+- k-mer LCA, depending on --lca: summary (the default) keeps, for each read,
+    the number of k-mers (kmers), of k-mers mapped to the assigned taxon
+    (taxon_kmers), of ambiguous ones (ambiguous_kmers) and of k-mers not in
+    the database (unclassified_kmers); full keeps the LCA mapping as is (so
+    that to_text gives back kraken2 output); none keeps nothing.
+
+A column can be read without decompressing the others. The reader API
+(read_blocks, read_columns, to_text) needs numpy."""
+import argparse
+import struct
+import array
+import zlib
+import sys
+
+MAGIC = b'K2COLS1\n'
+BLOCK_READS = 256*1024
+LCA_MODES = ['summary', 'full', 'none']
+COMPRESSION_LEVEL = 6
+SUMMARY_COLUMNS = ['kmers', 'taxon_kmers', 'ambiguous_kmers', 'unclassified_kmers']
+# column kinds: unsigned 32 bits integers, or newline separated text
+UINT32 = b'u'
+TEXT = b't'
+
+
+def _uint32(values):
+    data = array.array('I', values)
+    if sys.byteorder=='big':
+        data.byteswap()
+    return data.tobytes()
+
+def _taxon(field):
+    """(taxid, name) of the taxon field of kraken2 output, which is a taxid,
+    or 'name (taxid N)' with --use-names"""
+    if field.endswith(')'):
+        start = field.rfind('(taxid ')
+        if start>=0:
+            return int(field[start+7:-1]), field[:start].rstrip()
+    return int(field), None
+
+def _summary(taxid, lca):
+    """(kmers, taxon_kmers, ambiguous_kmers, unclassified_kmers) of an LCA mapping"""
+    kmers = taxon_kmers = ambiguous = unclassified = 0
+    target = str(taxid)
+    for token in lca.split():
+        taxon, _, count = token.partition(':')
+        if not count or taxon=='|':
+            continue
+        count = int(count)
+        kmers += count
+        if taxon=='0':
+            unclassified += count
+        elif taxon=='A':
+            ambiguous += count
+        elif taxon==target:
+            taxon_kmers += count
+    return kmers, taxon_kmers, ambiguous, unclassified
+
+
+class ColumnWriter:
+    """Write kraken2 output lines as blocks of compressed columns"""
+
+    def __init__(self, output, lca='summary', block_reads=BLOCK_READS):
+        if lca not in LCA_MODES:
+            raise RuntimeError(f'Unknown LCA mode {lca}, it should be one of {", ".join(LCA_MODES)}')
+        self.output = output
+        self.lca = lca
+        self.block_reads = block_reads
+        self.reads = 0
+        self.output.write(MAGIC)
+        self._reset()
+
+    def _reset(self):
+        self.read_ids, self.taxids, self.lengths1, self.lengths2 = [], [], [], []
+        self.names = {}
+        self.summaries = []
+        self.lcas = []
+
+    def add(self, line):
+        fields = line.rstrip('\n').split('\t')
+        if len(fields)<4:
+            if line.strip():
+                raise RuntimeError(f'Not a kraken2 output line: {line!r}')
+            return
+        taxid, name = _taxon(fields[2])
+        if name is not None:
+            self.names[taxid] = name
+        length1, _, length2 = fields[3].partition('|')
+        self.read_ids.append(fields[1])
+        self.taxids.append(taxid)
+        self.lengths1.append(int(length1))
+        self.lengths2.append(int(length2 or 0))
+        lca = fields[4] if len(fields)>4 else ''
+        if self.lca=='summary':
+            self.summaries.append(_summary(taxid, lca))
+        elif self.lca=='full':
+            self.lcas.append(lca)
+        if len(self.read_ids)>=self.block_reads:
+            self.flush()
+
+    def _column(self, name, kind, data):
+        data = zlib.compress(data, COMPRESSION_LEVEL)
+        name = name.encode('utf-8')
+        self.output.write(struct.pack('<B', len(name))+name+kind+struct.pack('<Q', len(data)))
+        self.output.write(data)
+
+    def flush(self):
+        if not self.read_ids:
+            return
+        columns = [('read_id', TEXT, '\n'.join(self.read_ids).encode('utf-8')),
+            ('taxid', UINT32, _uint32(self.taxids)),
+            ('length1', UINT32, _uint32(self.lengths1)),
+            ('length2', UINT32, _uint32(self.lengths2)),
+            ('names', TEXT, '\n'.join(f'{taxid}\t{name}' for taxid,name in self.names.items()).encode('utf-8'))]
+        if self.lca=='summary':
+            for i,column in enumerate(SUMMARY_COLUMNS):
+                columns.append((column, UINT32, _uint32(summary[i] for summary in self.summaries)))
+        elif self.lca=='full':
+            columns.append(('lca', TEXT, '\n'.join(self.lcas).encode('utf-8')))
+        self.output.write(struct.pack('<IH', len(self.read_ids), len(columns)))
+        for name,kind,data in columns:
+            self._column(name, kind, data)
+        self.reads += len(self.read_ids)
+        self._reset()
+
+    def close(self):
+        self.flush()
+        self.output.flush()
+
+
+def convert(input, output, lca='summary', block_reads=BLOCK_READS):
+    """Convert kraken2 output lines (text) to the columnar format (binary),
+    return the number of reads"""
+    writer = ColumnWriter(output, lca=lca, block_reads=block_reads)
+    for line in input:
+        writer.add(line)
+    writer.close()
+    return writer.reads
+
+
+def read_blocks(filename, columns=None):
+    """Yield each block of a columnar file as a dict column -> values (numpy
+    uint32 arrays, or lists of strings for read_id and lca, and a dict taxid
+    -> name for names), with only the requested columns (all by default)"""
+    import numpy as np
+    with open(filename, 'rb') as f:
+        if f.read(len(MAGIC))!=MAGIC:
+            raise RuntimeError(f'{filename} is not a kraken2 columnar file')
+        while True:
+            header = f.read(6)
+            if not header:
+                return
+            reads, column_count = struct.unpack('<IH', header)
+            block = {}
+            for _ in range(column_count):
+                name = f.read(struct.unpack('<B', f.read(1))[0]).decode('utf-8')
+                kind = f.read(1)
+                size, = struct.unpack('<Q', f.read(8))
+                if columns is not None and name not in columns:
+                    f.seek(size, 1)
+                    continue
+                data = zlib.decompress(f.read(size))
+                if kind==UINT32:
+                    block[name] = np.frombuffer(data, dtype='<u4')
+                elif name=='names':
+                    block[name] = {int(taxid): taxon for taxid,taxon in
+                        (line.split('\t', 1) for line in data.decode('utf-8').split('\n') if line)}
+                else:
+                    block[name] = data.decode('utf-8').split('\n') if reads else []
+            yield block
+
+def read_columns(filename, columns=None):
+    """Same as read_blocks for the whole file at once (names being merged)"""
+    import numpy as np
+    merged = {}
+    for block in read_blocks(filename, columns):
+        for name,values in block.items():
+            if name=='names':
+                merged.setdefault(name, {}).update(values)
+            else:
+                merged.setdefault(name, []).append(values)
+    for name,values in merged.items():
+        if name=='names':
+            continue
+        if values and isinstance(values[0], list):
+            merged[name] = [value for block in values for value in block]
+        else:
+            merged[name] = np.concatenate(values)
+    return merged
+
+def to_text(filename, output):
+    """Write kraken2 output lines back (the LCA mapping being a summary unless
+    the file was written with --lca full)"""
+    for block in read_blocks(filename):
+        names = block.get('names', {})
+        for i,(read_id,taxid) in enumerate(zip(block['read_id'], block['taxid'].tolist())):
+            taxon = f'{names[taxid]} (taxid {taxid})' if taxid in names else str(taxid)
+            length = str(block['length1'][i]) + (f'|{block["length2"][i]}' if block['length2'][i] else '')
+            if 'lca' in block:
+                lca = block['lca'][i]
+            elif 'kmers' in block:
+                lca = ' '.join(f'{key}:{block[column][i]}' for key,column in
+                    [(taxid, 'taxon_kmers'), ('A', 'ambiguous_kmers'), ('0', 'unclassified_kmers')]
+                    if block[column][i])
+            else:
+                lca = ''
+            output.write(f'{"C" if taxid else "U"}\t{read_id}\t{taxon}\t{length}\t{lca}\n')
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(
+                    prog = 'kraken2 columns',
+                    description = 'Convert kraken2 per-read output (from stdin) to a compressed columnar file, or back to text with --text.')
+    parser.add_argument('-o', '--output', type=str, required=True,
+        help='The columnar file to write (or to read with --text)')
+    parser.add_argument('--lca', type=str, choices=LCA_MODES, default='summary',
+        help='What is kept of k-mers LCA mapping, default to summary')
+    parser.add_argument('--text', action='store_true',
+        help='Write the content of the columnar file as kraken2 output text to stdout')
+    args = parser.parse_args()
+
+    if args.text:
+        to_text(args.output, sys.stdout)
+    else:
+        with open(args.output, 'wb') as output:
+            reads = convert(sys.stdin, output, lca=args.lca)
+        print(f'{reads} reads', file=sys.stderr)
@@ -1,14 +1,85 @@
 import subprocess as sp
 from scitq.lib import Server
 import argparse
-from scitq.fetch import list_content, sync
+from scitq.fetch import sync
+import hashlib
 import os
+import sys
+from contextlib import nullcontext
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.discovery import SampleDiscovery
+from common.submission import TaskSubmitter
+from common.resume import ResumeIndex
+from common.scheduling import largest_first
+from common.packing import pack, DEFAULT_PACK_SIZE
+from common.autoscale import ThroughputModel, AutoScaler, fleet_size, DEFAULT_MAX_WORKERS, DEFAULT_TARGET_HOURS
+from common.join import join
+from common.resources import resource_uri, tool_resource
+from common.matrix import MatrixStore, MatrixCollector, read_kraken2_report, read_bracken
+from common.result_cache import ResultCache, CachedSubmitter, DEFAULT_TTL_DAYS
+from kraken2.bracken_local import (cache_kmer_distrib, reestimate_s3, output_names, LEVELS,
+    DEFAULT_READ_LENGTH, DEFAULT_LEVEL, DEFAULT_THRESHOLD)
+
+# shared database mode: where the database is staged on the worker (the host
+# /dev/shm is given to task containers), and the default concurrency
+SHARED_DB_DIR = '/dev/shm'
+SHARED_DB_OPTIONS = f'-v {SHARED_DB_DIR}:{SHARED_DB_DIR}'
+SHARED_CONCURRENCY = 6
+# per-read output: kraken2 text, compressed columns (see kraken_columns.py) or none
+READ_OUTPUTS = ['text', 'columnar', 'report-only']
+KRAKEN_COLUMNS_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'kraken_columns.py')
+
+def kraken2_command(name, input, database='', bracken=False, only_bracken=False,
+        output='/output', shared=False, resource='/resource', read_output='text',
+        converter='kraken_columns.py'):
+    """Return the shell command analysing a sample, input being kraken2 input
+    arguments (or kraken2 report for only_bracken), results going into output.
+    If shared, the database is the one in $DB (see stage_db_command), memory mapped.
+    read_output is one of READ_OUTPUTS, columnar output being written by the
+    converter script found in resource"""
+    if only_bracken:
+        return f"bracken -d {resource}/ -i {input} -o {output}/{name}.bracken -w {output}/{name}-bracken.report"
+    db = '--memory-mapping --db $DB' if shared else f'--db {resource}/{database}'
+    command = f"kraken2 --use-names --threads $CPU {db} --report {output}/{name}.report {input}"
+    if read_output=='columnar':
+        # no pipefail in a plain sh: a kraken2 failure is recorded in a file
+        failed = f'{output}/.{name}.failed'
+        command = (f"{{ {command} || touch {failed}; }} | python3 {resource}/{converter} -o {output}/{name}.kraken.k2c"
+            f" && test ! -e {failed}")
+    elif read_output=='report-only':
+        command += " --output /dev/null"
+    else:
+        command += f" > {output}/{name}.kraken"
+    if bracken:
+        command += f" && bracken -d {resource}/{database} -i {output}/{name}.report -o {output}/{name}.bracken -w {output}/{name}-bracken.report"
+    return command
+
+def stage_db_command(database='', key='', resource='/resource', shared_dir=SHARED_DB_DIR):
+    """Return the shell command setting DB to the database copied once per
+    worker in shared_dir (the first task copies it while the others wait),
+    key identifying the database. If shared_dir is too small, DB is the
+    database in resource, which is memory mapped all the same (through the
+    page cache)"""
+    source = f'{resource}/{database}'.rstrip('/')
+    staged = f'{shared_dir}/kraken2_{key}'
+    free = f'$(df -Pk {shared_dir} | tail -1 | tr -s " " | cut -d" " -f4)'
+    size = f'$(du -ck {source}/*.k2d | tail -1 | cut -f1)'
+    return (f'DB={source}; mkdir -p {staged} && exec 9>{staged}/.lock && flock 9 && '
+        f'{{ [ -e {staged}/.staged ] || {{ [ {free} -gt {size} ] && cp {source}/*.k2d {staged}/ && touch {staged}/.staged; }} '
+        f'|| rm -f {staged}/*.k2d; }}; flock -u 9; '
+        f'if [ -e {staged}/.staged ]; then DB={staged}; fi')
 
 def kraken2(scitq_server, s3_input, s3_output, s3_kraken_database,
         bracken=False, download=False, fastq=False,
         batch='my_kraken2', region='WAW1', workers=5, database='',
         flavor='i1-180', provider='ovh', only_bracken=False,
-        concurrency=1):
+        concurrency=1, refresh_listing=False, stream=False, resume=False,
+        check_inputs=False, autoscale=False, max_workers=DEFAULT_MAX_WORKERS,
+        target_hours=DEFAULT_TARGET_HOURS, listing_order=False, pack_samples=0,
+        pack_size=DEFAULT_PACK_SIZE, shared_db=False, aggregate=False, read_output='text',
+        local_bracken=False, read_lengths=[DEFAULT_READ_LENGTH], levels=[DEFAULT_LEVEL],
+        threshold=DEFAULT_THRESHOLD, processes=1, result_cache=False, cache_ttl=DEFAULT_TTL_DAYS):
     """Launch a kraken2 scan on FASTA files in s3_input folder using database present
     in s3_kraken_database, and putting result in s3_output folder.
 
@@ -20,11 +91,47 @@ def kraken2(scitq_server, s3_input, s3_output, s3_kraken_database,
     - region: an OVH region for the instances. Default to Warsow (WAW1)
     - workers: the number of workers (default to 5)
     - concurrency: the number of process per worker (default to 1)
+    - refresh_listing: ignore the local listing index and list s3_input again
+    - stream: deploy workers first and submit tasks while s3_input is still listed
+    - resume: skip samples which outputs are already in s3_output
+    - check_inputs: with resume, recompute samples which inputs changed since last run
+    - autoscale: size the number of workers from input size (workers is then only
+        the initial number in stream mode) and adjust it while tasks are running
+    - max_workers, target_hours: autoscaling tries to finish in target_hours with
+        at most max_workers workers
+    - listing_order: create tasks in listing order rather than biggest samples first
+    - pack_samples: if above 1, analyse up to pack_samples samples (and up to
+        pack_size bytes of input) in the same task, which saves a container start
+        and a database attach per sample (results layout is unchanged)
+    - shared_db: stage the database once per worker in shared memory and memory
+        map it in every task, so that concurrency can be raised without
+        loading a copy of the database per task
+    - aggregate: add reports (and bracken outputs) to taxon x sample matrix
+        stores in the local batch/matrix folder as soon as their task is done
+        (see common/matrix.py), the stores being updated if they exist
+    - read_output: the per-read output of kraken2, one of READ_OUTPUTS, text
+        (sample.kraken, the default), columnar (sample.kraken.k2c, compressed
+        columns, see kraken_columns.py) or report-only (no per-read output)
+    - local_bracken: with only_bracken, re-estimate reports locally (see
+        bracken_local.py) in processes processes instead of launching tasks,
+        for each read length of read_lengths and level of levels (outputs
+        being suffixed with level and read length if there are several),
+        taxa with less than threshold reads being ignored
+    - result_cache: do not launch tasks which results exist from a previous
+        run (same inputs, database, options), copy them instead (see
+        common/result_cache.py), results of less than cache_ttl days only
 
     """
     if not (s3_kraken_database.endswith('.tgz') or s3_kraken_database.endswith('.tar.gz')):
         raise RuntimeError(f'Please use a tar gziped archive as s3_kraken_database')
-    s3_db_path = f"{s3_kraken_database}|untar"
+    if read_output not in READ_OUTPUTS:
+        raise RuntimeError(f'Unknown read output {read_output}, it should be one of {", ".join(READ_OUTPUTS)}')
+    s3_db_path = resource_uri(s3_kraken_database)
+    # bracken alone does not need the kraken2 database
+    shared_db = shared_db and not only_bracken
+    if shared_db:
+        db_key = hashlib.sha1(f'{s3_kraken_database}|{database}'.encode('utf-8')).hexdigest()[:12]
+        stage_db = stage_db_command(database, db_key)
 
 
     s=Server(scitq_server)
@@ -38,56 +145,192 @@ def kraken2(scitq_server, s3_input, s3_output, s3_kraken_database,
     else:
         sample_extension='.fa'
 
-    samples = {}
-    for item in [item.name for item in list_content(s3_input) 
-                    if item.name.endswith(sample_extension)]:
-        if fastq:
-            sample = item.split('/')[-2]
-        else:
-            sample,_ = os.path.splitext(os.path.split(item)[-1])
-        if sample not in samples:
-            samples[sample]=[item]
-        else:
-            samples[sample].append(item)
-            
-    if len(samples)==0:
-        raise RuntimeError(f'No {"gzipped FASTQ (.fastq.gz)" if fastq else "KRAKEN2 report (.report)" if only_bracken else "FASTA (.fa)"} samples found in {s3_input}...')
+    samples = SampleDiscovery(s3_input, sample_extension, by_folder=fastq,
+                    refresh=refresh_listing, md5=check_inputs or result_cache)
+    if not stream:
+        # list everything first, so that nothing is deployed for an empty source
+        samples.samples()
+        if len(samples.inventory)==0:
+            raise RuntimeError(f'No {"gzipped FASTQ (.fastq.gz)" if fastq else "KRAKEN2 report (.report)" if only_bracken else "FASTA (.fa)"} samples found in {s3_input}...')
 
     if not s3_output.endswith('/'):
         s3_output+='/'
 
-    tasks = []
-    for name,sequences in samples.items():
-        print(f'Launching for {name} {sequences}')
-        if fastq:
-            input='--paired --gzip-compressed /input/*.fastq.gz'
-        else:
-            input='/input/*.fa'
-        if only_bracken:
-            command=f"sh -c 'cd /output/ && \
-    bracken -d /resource/ -i /input/{name}.report -o /output/{name}.bracken -w /output/{name}-bracken.report'"
-        elif bracken:
-            command=f"sh -c 'cd /output/ && \
-    kraken2 --use-names --threads $CPU --db /resource/{database} --report /output/{name}.report \
-        {input} > /output/{name}.kraken && \
-    bracken -d /resource/{database} -i /output/{name}.report -o /output/{name}.bracken -w /output/{name}-bracken.report'"
+    task_resource = s3_db_path
+    converter = None
+    if read_output=='columnar' and not only_bracken:
+        # the converter is sent to workers as a resource
+        converter_resource = tool_resource(KRAKEN_COLUMNS_SCRIPT, f'{s3_output}.tools')
+        converter = converter_resource.rsplit('/', 1)[-1]
+        task_resource += f' {converter_resource}'
+
+    local_bracken = local_bracken and only_bracken
+    if local_bracken:
+        suffixed = len(read_lengths)*len(levels)>1
+        expected = [f'{{sample}}/{output_names("{sample}", level, read_length, suffixed)[0]}'
+                        for read_length in read_lengths for level in levels]
+    elif only_bracken:
+        expected = ['{sample}/{sample}.bracken']
+    else:
+        expected = ['{sample}/{sample}.report']
+        if read_output=='text':
+            expected.append('{sample}/{sample}.kraken')
+        elif read_output=='columnar':
+            expected.append('{sample}/{sample}.kraken.k2c')
+        if bracken:
+            expected.append('{sample}/{sample}.bracken')
+    resume_index = ResumeIndex(s3_output, expected, resume=resume, check_inputs=check_inputs)
+
+    if local_bracken:
+        # no worker: the k-mer distributions are fetched once and reports re-estimated here
+        distributions = {read_length: cache_kmer_distrib(s3_kraken_database, read_length, database)
+                            for read_length in read_lengths}
+        if stream:
+            samples.samples()
+        pending = {}
+        for name,items in samples.inventory.items():
+            if not resume_index.skip(name, items):
+                resume_index.record(name, items)
+                pending[name] = items[0].name
+        if not pending and resume_index.skipped==0:
+            raise RuntimeError(f'No KRAKEN2 report (.report) samples found in {s3_input}...')
+        done = reestimate_s3(pending, s3_output, distributions, levels, threshold, processes=processes)
+        resume_index.save()
+        print(f'Re-estimated {len(done)} reports ({resume_index.skipped} already done)')
+        if aggregate:
+            matrix_dir = os.path.join(batch, 'matrix')
+            collector = MatrixCollector(s3_output, [(MatrixStore(os.path.join(matrix_dir, 'bracken')),
+                read_bracken, expected[0])])
+            for name in done:
+                collector.fetch(name)
+            collector.collect(resume_index.skipped_samples)
+            print(f'Abundance matrices are in {matrix_dir}')
+        if download:
+            sync(s3_output, batch)
+        return
+
+    def deploy_workers():
+        if flavor.lower()!='none' and workers>0:
+            s.worker_deploy(region=region, flavor=flavor, number=workers, batch=batch,
+                concurrency=concurrency, prefetch=concurrency, provider=provider)
+
+    if stream:
+        deploy_workers()
+
+    model = ThroughputModel('kraken2_shared' if shared_db else 'kraken2')
+    cache = ResultCache(ttl=cache_ttl) if result_cache else None
+    # tasks which results are in the cache are not created
+    submitter = CachedSubmitter(TaskSubmitter(s), cache)
+    if stream:
+        sample_groups = samples
+    elif listing_order:
+        sample_groups = samples.inventory.items()
+    else:
+        # longest tasks first, so that they do not end up running alone at the end
+        sample_groups = largest_first(samples.inventory)
+    pending_groups = ((name,items) for name,items in sample_groups
+                        if not resume_index.skip(name, items))
+    if pack_samples>1:
+        # several samples per task, each with its own output folder
+        units = pack(pending_groups, pack_samples, max_size=pack_size)
+    else:
+        units = ([group] for group in pending_groups)
+    for unit in units:
+        if pack_samples>1:
+            names = [name for name,_ in unit]
+            print(f'Launching pack of {len(unit)} samples: {" ".join(names)}')
+            commands = []
+            for name,items in unit:
+                files = ' '.join(f'/input/{os.path.basename(item.name)}' for item in items)
+                commands.append(f'mkdir -p /output/{name} && ' +
+                    kraken2_command(name, f'--paired --gzip-compressed {files}' if fastq else files,
+                        database=database, bracken=bracken, only_bracken=only_bracken,
+                        output=f'/output/{name}', shared=shared_db,
+                        read_output=read_output, converter=converter))
+            if shared_db:
+                commands.insert(0, stage_db)
+            command = f"sh -c '{' && '.join(commands)}'"
+            output = s3_output
         else:
-            command=f"sh -c 'cd /output/ && kraken2 --use-names --threads $CPU --db /resource/{database} --report /output/{name}.report \
-    {input} > /output/{name}.kraken'"
-        tasks.append(s.task_create(command=command,
-                input=' '.join(sequences),
-                output=s3_output+name,
-                resource=s3_db_path,
-                container="gmtscience/kraken2bracken",
+            name,items = unit[0]
+            print(f'Launching for {name} {[item.name for item in items]}')
+            if only_bracken:
+                input=f'/input/{name}.report'
+            elif fastq:
+                input='--paired --gzip-compressed /input/*.fastq.gz'
+            else:
+                input='/input/*.fa'
+            stage = f'{stage_db} && ' if shared_db else ''
+            command=f"sh -c '{stage}cd /output/ && {kraken2_command(name, input, database=database, bracken=bracken, only_bracken=only_bracken, shared=shared_db, read_output=read_output, converter=converter)}'"
+            output = s3_output+name
+        submitter.submit(unit, [item for _,items in unit for item in items],
+                paths=[f'{name}/' for name,_ in unit] if pack_samples>1 else [''],
+                command=command,
                 batch=batch,
-                ))
+                input=' '.join(item.name for _,items in unit for item in items),
+                output=output,
+                resource=task_resource,
+                container="gmtscience/kraken2bracken",
+                container_options=SHARED_DB_OPTIONS if shared_db else '')
+    tasks, task_units, restored_units = submitter.wait()
+    task_samples = [[name for name,_ in unit] for unit in task_units]
+    sizes = [sum(item.size or 0 for _,items in unit for item in items) for unit in task_units]
+    restored_samples = [name for unit in restored_units for name,_ in unit]
+    # restored results are done
+    for unit in restored_units:
+        for name,items in unit:
+            resume_index.record(name, items)
+    samples_by_task = {task['task_id']: names for task,names in zip(tasks, task_samples)}
+    if len(tasks)==0 and resume_index.skipped==0 and not restored_samples:
+        raise RuntimeError(f'No {"gzipped FASTQ (.fastq.gz)" if fastq else "KRAKEN2 report (.report)" if only_bracken else "FASTA (.fa)"} samples found in {s3_input}...')
+
+    autoscaling = autoscale and flavor.lower()!='none' and workers>0
+    if not stream and tasks:
+        if autoscaling:
+            workers = fleet_size(model, sizes, concurrency, target_hours=target_hours,
+                max_workers=max_workers)
+            print(f'Autoscaling: deploying {workers} worker(s) for {sum(sizes)/1024**3:.1f} GB of input')
+        deploy_workers()
+
+    if aggregate:
+        matrix_dir = os.path.join(batch, 'matrix')
+        aggregations = []
+        if not only_bracken:
+            aggregations.append((MatrixStore(os.path.join(matrix_dir, 'kraken2')),
+                read_kraken2_report, '{sample}/{sample}.report'))
+        if bracken or only_bracken:
+            aggregations.append((MatrixStore(os.path.join(matrix_dir, 'bracken')),
+                read_bracken, '{sample}/{sample}.bracken'))
+        collector = MatrixCollector(s3_output, aggregations)
+        def on_success(task):
+            for name in samples_by_task[task['task_id']]:
+                collector.fetch(name)
+    else:
+        on_success = None
+    if cache:
+        # results are recorded as soon as their task succeeded
+        on_success = cache.on_success(on_success)
+    # inputs fingerprints are recorded once their task succeeded
+    resume_index.watch(tasks, task_units)
+    on_success = resume_index.on_success(on_success)
 
-    if flavor.lower()!='none' and workers>0:
-        s.worker_deploy(region=region, flavor=flavor, number=workers, batch=batch,
-            concurrency=concurrency, prefetch=concurrency, provider=provider)
+    try:
+        if tasks and (flavor.lower()!='none' or download or aggregate or cache or check_inputs):
+            scaler = AutoScaler(s, batch, tasks, sizes, model, concurrency,
+                dict(region=region, flavor=flavor, provider=provider, prefetch=concurrency),
+                target_hours=target_hours, max_workers=max_workers) if autoscaling else nullcontext()
+            with scaler:
+                join(s, tasks, retry=2, batch=batch, on_success=on_success, sizes=sizes)
+    finally:
+        resume_index.save()
+    if cache:
+        cache.close()
 
-    if flavor.lower()!='none' or download:
-        s.join(tasks, retry=2)
+    if aggregate:
+        # resumed and restored samples, and those done since the last collection
+        collector.collect(resume_index.skipped_samples+restored_samples+
+            [name for names in task_samples for name in names])
+        print(f'Abundance matrices are in {matrix_dir}')
 
     if download:
         sync(s3_output, batch)
@@ -117,7 +360,7 @@ if __name__=='__main__':
     parser.add_argument('--workers', type=int, 
         help=f'Number of instances to use, default to 5 (each worker will treat ~2 1MB-long FASTA per hour)', default=5)
     parser.add_argument('--concurrency', type=int, 
-        help=f"The number of process per worker, default to 1", default=1)
+        help=f"The number of process per worker, default to 1 ({SHARED_CONCURRENCY} with --shared-db)", default=None)
     parser.add_argument('--database', type=str, default='',
         help=f'If kraken database tar contains a subdirectory specify it here')
     parser.add_argument('--flavor', type=str, default='i1-180',
@@ -128,14 +371,63 @@ if __name__=='__main__':
         help="Choose the provider, default to ovh, can be azure also")
     parser.add_argument('--only-bracken', action="store_true",
         help=f'This option is for running only bracken when you have already run kraken2 - the input should contain .report files in this case')
+    parser.add_argument('--local-bracken', action="store_true",
+        help=f'With --only-bracken, re-estimate reports locally (only the kmer_distrib file of the database is downloaded) instead of launching tasks')
+    parser.add_argument('--read-length', type=int, nargs='+', default=[DEFAULT_READ_LENGTH],
+        help=f'With --local-bracken, read lengths (several may be given), default to {DEFAULT_READ_LENGTH}')
+    parser.add_argument('--level', type=str, nargs='+', choices=LEVELS, default=[DEFAULT_LEVEL],
+        help=f'With --local-bracken, taxonomic levels (several may be given), default to {DEFAULT_LEVEL}')
+    parser.add_argument('--threshold', type=int, default=DEFAULT_THRESHOLD,
+        help=f'With --local-bracken, minimal reads of a taxon to be kept, default to {DEFAULT_THRESHOLD}')
+    parser.add_argument('--processes', type=int, default=os.cpu_count(),
+        help=f'With --local-bracken, how many processes re-estimate reports, default to CPU count')
+    parser.add_argument('--refresh-listing', action="store_true",
+        help=f'Ignore the local index of s3_input listing and list it again completely')
+    parser.add_argument('--stream', action="store_true",
+        help=f'Deploy workers right away and create tasks while s3_input is being listed')
+    parser.add_argument('--autoscale', action="store_true",
+        help=f'Choose the number of workers from the input size, and adjust it while tasks are running')
+    parser.add_argument('--max-workers', type=int, default=DEFAULT_MAX_WORKERS,
+        help=f'With --autoscale, the maximal number of workers, default to {DEFAULT_MAX_WORKERS}')
+    parser.add_argument('--target-hours', type=float, default=DEFAULT_TARGET_HOURS,
+        help=f'With --autoscale, the expected duration of the run, default to {DEFAULT_TARGET_HOURS}')
+    parser.add_argument('--listing-order', action="store_true",
+        help=f'Create tasks in listing order instead of biggest samples first')
+    parser.add_argument('--pack-samples', type=int, default=0,
+        help=f'Analyse up to this number of small samples in each task (default to 0, one sample per task)')
+    parser.add_argument('--pack-size', type=float, default=DEFAULT_PACK_SIZE/1024**3,
+        help=f'With --pack-samples, the maximal input size in GB of a task, default to {DEFAULT_PACK_SIZE/1024**3:g}')
+    parser.add_argument('--shared-db', action="store_true",
+        help=f'Copy the database once per worker in {SHARED_DB_DIR} and memory map it in all tasks, so that a worker runs several tasks with a single copy of the database in memory')
+    parser.add_argument('--aggregate', action="store_true",
+        help=f'Add the results of each sample (as soon as it is done) to taxon x sample matrices in the local <batch>/matrix folder')
+    parser.add_argument('--read-output', type=str, choices=READ_OUTPUTS, default='text',
+        help=f'Per-read output of kraken2: text (.kraken, the default), columnar (.kraken.k2c, compressed, read with kraken2/kraken_columns.py) or report-only (none)')
+    parser.add_argument('--result-cache', action="store_true",
+        help=f'Copy the results of tasks already done in a previous run (same inputs, database and options, in any output folder) instead of launching them again')
+    parser.add_argument('--cache-ttl', type=float, default=DEFAULT_TTL_DAYS,
+        help=f'With --result-cache, only reuse results of less than that many days, default to {DEFAULT_TTL_DAYS}')
+    parser.add_argument('--resume', action="store_true",
+        help=f'Skip samples which results are already present in s3_output')
+    parser.add_argument('--check-inputs', action="store_true",
+        help=f'With --resume, also recompute samples which inputs changed since they were launched')
     args = parser.parse_args()
 
     if not args.scitq:
         raise RuntimeError('You must define which SCITQ server we use, either defining SCITQ_SERVER environment variable or using --scitq')
+    if args.concurrency is None:
+        args.concurrency = SHARED_CONCURRENCY if args.shared_db else 1
 
     kraken2(args.scitq, args.s3_input, args.s3_output, args.s3_kraken, batch=args.batch,
         region=args.region, workers=args.workers, bracken=args.bracken, download=args.download,
         fastq=args.fastq, database=args.database, flavor=args.flavor, only_bracken=args.only_bracken,
-        provider=args.provider, concurrency=args.concurrency)
+        provider=args.provider, concurrency=args.concurrency, refresh_listing=args.refresh_listing,
+        stream=args.stream, resume=args.resume, check_inputs=args.check_inputs,
+        autoscale=args.autoscale, max_workers=args.max_workers, target_hours=args.target_hours,
+        listing_order=args.listing_order, pack_samples=args.pack_samples,
+        pack_size=int(args.pack_size*1024**3), shared_db=args.shared_db, aggregate=args.aggregate,
+        read_output=args.read_output, local_bracken=args.local_bracken, read_lengths=args.read_length,
+        levels=args.level, threshold=args.threshold, processes=args.processes,
+        result_cache=args.result_cache, cache_ttl=args.cache_ttl)
     
     
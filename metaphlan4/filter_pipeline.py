@@ -0,0 +1,115 @@
+"""Task command of the filtered MetaPhlAn pipeline.
+
+fastp (trimming) -> bowtie2 | samtools (human reads removal) -> normalization
+to a fixed depth -> metaphlan. In streaming mode (the default) the stages are
+connected with pipes and named pipes and run together, so that reads flow
+from fastp to metaphlan with no intermediate file. With intermediate files,
+the stages run one after the other on uncompressed FASTQs in /input, as before.
+
+Normalization is done by common/subsample.py (given to the task as a resource),
+which samples read pairs of the interleaved samtools output in a single pass
+and reports the sample depth in <sample>.depth.tsv, or, with the seqtk
+sampler, by `seqtk sample` on each mate (seqtk reservoir sampling only keeps
+depth reads in memory and its output is given to metaphlan through a pipe).
+
+Both modes run the same commands with the same options (bowtie2 keeps the
+input order with --reorder, so that the sampling does not depend on thread
+scheduling), so that a profile is the same for a given seed and sampler
+whatever the mode. Without depth (a sample known to be below depth), reads
+are not sampled (the reservoir sampler still counts them, and with the seqtk
+sampler the human-free mates are written to files even in streaming mode). A
+stage at either end of a named pipe which fails kills the task, so that the
+other end does not wait forever. The start, end and exit status of each stage
+are written in <sample>.stages.tsv next to the profile, and durations are
+printed at the end of the task output."""
+import os
+
+FASTP_OPTIONS = ('--adapter_sequence AGATCGGAAGAGCACACGTCTGAACTCCAGTCA '
+    '--adapter_sequence_r2 AGATCGGAAGAGCGTCGTGTAGGGAAAGAGTGT '
+    '--cut_front --cut_tail --n_base_limit 0 --length_required 60')
+HUMAN_INDEX = '/resource/chm13v2.0/chm13v2.0'
+SAMPLERS = ['reservoir', 'seqtk']
+SUBSAMPLE_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common', 'subsample.py')
+
+# stage <name> <command...>: run a command and record its timing and status
+STAGE_FUNCTION = """stage() {{ local name=$1; shift; local start=$(date +%s.%N); "$@"; local status=$?; \
+echo -e "$name\\t$start\\t$(date +%s.%N)\\t$status" >> {stages}; return $status; }}"""
+# guard <command...>: in streaming mode, a process which fails before it opens
+# its named pipes leaves the other end blocked in open() forever, so that the
+# failure of a stage at either end of a named pipe kills the task (its
+# process group) instead of hanging
+GUARD_FUNCTION = 'guard() { "$@" || { local status=$?; kill -TERM 0; return $status; }; }'
+# fail if a stage did not end, or did not succeed (and do not leave a profile
+# made of partial input, which --resume would take as done)
+STAGE_CHECK = """awk -F"\\t" "{{printf \\"%s\\t%.1fs\\t%s\\n\\", \\$1, \\$3-\\$2, \\$4}}" {stages}
+test $(wc -l < {stages}) -eq {count} && test -z "$(cut -f4 {stages} | grep -vx 0)" || {{ rm -f {profile}; exit 1; }}"""
+
+
+def filter_command(sample, depth, seed, metaphlan_option, streaming=True, sampler='reservoir',
+        subsample_script=None):
+    """Return the task command for a sample, which paired FASTQs are in /input
+    (with the reservoir sampler, subsample_script is the name of
+    common/subsample.py in /resource), depth being None if reads should not
+    be sampled"""
+    fp = [f'/input/{sample}_fp.{i}.fastq' for i in (1,2)]
+    noh = [f'/input/{sample}_noh.{i}.fastq' for i in (1,2)]
+    norm = [f'/input/{sample}_norm.{i}.fastq' for i in (1,2)]
+    stages = f'/output/{sample}.stages.tsv'
+    profile = f'/output/{sample}.metaphlan4_profile.txt'
+    fastp = (f'stage fastp fastp {FASTP_OPTIONS} --in1 /input/*.1.fastq.gz --in2 /input/*.2.fastq.gz '
+        f'--out1 {fp[0]} --out2 {fp[1]}')
+    metaphlan = (f'stage metaphlan metaphlan --input_type fastq --no_map {metaphlan_option} '
+        f'--bowtie2db /resource/metaphlan/bowtie2 --nproc $CPU -o {profile}')
+    bowtie2 = f'bowtie2 -p $CPU --mm --reorder -x {HUMAN_INDEX} -1 {fp[0]} -2 {fp[1]}'
+    samtools = 'samtools fastq -@ 2 -f 12 -F 256 -0 /dev/null -s /dev/null -N'
+
+    if sampler=='reservoir':
+        names = ['fastp', 'bowtie2', 'samtools', 'subsample', 'metaphlan']
+        sampling = f'-s {seed} -n {depth} ' if depth else ''
+        subsample = (f'stage subsample python3 /resource/{subsample_script} {sampling}'
+            f'--name {sample} --report /output/{sample}.depth.tsv')
+        if streaming:
+            steps = [GUARD_FUNCTION,
+                f'mkfifo {" ".join(fp)}',
+                f'guard {fastp} &',
+                f'guard stage bowtie2 {bowtie2} | stage samtools {samtools} | {subsample} | {metaphlan}',
+                'wait']
+        else:
+            steps = [fastp,
+                f'stage bowtie2 {bowtie2} | stage samtools {samtools} > /input/{sample}_noh.fastq',
+                f'{subsample} < /input/{sample}_noh.fastq > /input/{sample}_norm.fastq',
+                f'{metaphlan} < /input/{sample}_norm.fastq']
+    elif sampler=='seqtk':
+        names = ['fastp', 'bowtie2', 'seqtk.1', 'seqtk.2', 'metaphlan']
+        bowtie2 = f'stage bowtie2 bash -o pipefail -c "{bowtie2} | {samtools} -1 {noh[0]} -2 {noh[1]}"'
+        seqtk = [f'stage seqtk.{i} seqtk sample -s{seed} {noh[i-1]} {depth}' if depth
+            else f'stage seqtk.{i} cat {noh[i-1]}' for i in (1,2)]
+        if streaming and depth:
+            # seqtk reservoir sampling reads its whole input before writing, so
+            # that both mates are read at the same time from samtools
+            steps = [GUARD_FUNCTION,
+                f'mkfifo {" ".join(fp+noh)}',
+                f'guard {fastp} &',
+                f'guard {bowtie2} &',
+                f'cat <(guard {seqtk[0]}) <(guard {seqtk[1]}) | {metaphlan}',
+                'wait']
+        elif streaming:
+            # cat would read mate 1 to the end before mate 2 while samtools
+            # writes both: human-free mates are written to files
+            steps = [GUARD_FUNCTION,
+                f'mkfifo {" ".join(fp)}',
+                f'guard {fastp} &',
+                f'guard {bowtie2}',
+                'wait',
+                f'cat <({seqtk[0]}) <({seqtk[1]}) | {metaphlan}']
+        else:
+            steps = [fastp,
+                bowtie2,
+                f'{seqtk[0]} > {norm[0]} & {seqtk[1]} > {norm[1]}; wait',
+                f'cat {" ".join(norm)} | {metaphlan}']
+    else:
+        raise RuntimeError(f'Unknown sampler {sampler}, it should be one of {", ".join(SAMPLERS)}')
+    script = '\n'.join([STAGE_FUNCTION.format(stages=stages), f': > {stages}']
+        + steps
+        + [STAGE_CHECK.format(stages=stages, count=len(names), profile=profile)])
+    return f"bash -c '{script}'"
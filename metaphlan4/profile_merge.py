@@ -0,0 +1,316 @@
+"""Local merge of MetaPhlAn profiles, replacing the phase 2 task.
+
+Profiles are added one at a time (as soon as their task succeeded) into a
+sparse, column-appended table: each sample is stored as the row indexes of its
+non-null clades and their abundances, the dense table being only built line
+by line when written. The table written by ProfileMerger.write is the same as
+the one of merge_metaphlan_tables.py (columns being sorted by sample name),
+and write_gtdb produces the GTDB version of it (what sgb_to_gtdb_profile.py
+and combine_csv did in phase 2).
+
+The SGB to GTDB mapping is extracted once per database version into a numpy
+file in the local cache, which is quick to load in each process of the pool
+where profiles are read and converted."""
+from scitq.fetch import get
+import concurrent.futures
+import threading
+import tempfile
+import argparse
+import numpy as np
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common import CACHE_DIR
+
+PROFILE_SUFFIX = '.metaphlan4_profile.txt'
+MAX_PARALLEL_DOWNLOAD = 8
+SGB2GTDB_DIR = os.path.join(CACHE_DIR, 'sgb2gtdb')
+SGB2GTDB_SUFFIX = '_SGB2GTDB.tsv'
+
+
+class SparseColumns:
+    """A table built column by column, keeping only non-null values"""
+
+    def __init__(self):
+        self.index = {}
+        self.keys = []
+        self.columns = []
+        self.rows = []
+        self.values = []
+
+    def add_column(self, name, values):
+        """Add a column from a dict key -> value"""
+        rows = np.empty(len(values), dtype=np.int64)
+        for i,key in enumerate(values):
+            row = self.index.get(key)
+            if row is None:
+                row = self.index[key] = len(self.keys)
+                self.keys.append(key)
+            rows[i] = row
+        self.columns.append(name)
+        self.rows.append(rows)
+        self.values.append(np.fromiter(values.values(), dtype=np.float64, count=len(values)))
+
+    def __len__(self):
+        return len(self.columns)
+
+    def sorted_columns(self):
+        return sorted(self.columns)
+
+    def lines(self):
+        """Yield (key, list of str values) sorted by key, columns being sorted
+        by name (as in sorted_columns), null values being '0'"""
+        if not self.columns:
+            return
+        position = {name:i for i,name in enumerate(self.sorted_columns())}
+        rows = np.concatenate(self.rows)
+        columns = np.concatenate([np.full(len(column_rows), position[name])
+                                    for name,column_rows in zip(self.columns, self.rows)])
+        values = np.concatenate(self.values)
+        # rank of each key in sorted order
+        rank = np.empty(len(self.keys), dtype=np.int64)
+        rank[sorted(range(len(self.keys)), key=self.keys.__getitem__)] = np.arange(len(self.keys))
+        order = np.lexsort((columns, rank[rows]))
+        rows, columns, values = rows[order], columns[order], values[order]
+        boundaries = np.flatnonzero(np.diff(rows))+1
+        for start,end in zip(np.concatenate(([0], boundaries)), np.concatenate((boundaries, [len(rows)]))):
+            line = ['0']*len(self.columns)
+            for column,value in zip(columns[start:end], values[start:end]):
+                line[column] = str(float(value))
+            yield self.keys[rows[start]], line
+
+
+def read_profile(filename):
+    """Read a MetaPhlAn profile, return (database version, header names, dict
+    key -> abundance) where key is (clade, taxid) or (clade,) for old profiles"""
+    version = None
+    headers = []
+    abundances = {}
+    with open(filename, 'r') as f:
+        for line in f:
+            if line.startswith('#'):
+                headers.append(line.strip())
+                if line.startswith('#mpa_') and version is None:
+                    version = line.strip().split(' ')[0]
+                continue
+            fields = line.rstrip('\n').split('\t')
+            if len(headers)>=4:
+                abundances[(fields[0], fields[1])] = float(fields[2])
+            else:
+                abundances[(fields[0],)] = float(fields[1])
+    if len(headers)>=4:
+        names = headers[-1].split('#')[1].strip().split('\t')[:2]
+    else:
+        names = ['clade_name']
+    return version, names, abundances
+
+
+def gtdb_abundances(abundances, sgb2gtdb):
+    """Convert a profile (from read_profile) to GTDB: each SGB abundance is
+    added to every level of its GTDB lineage (unmapped SGBs are ignored)"""
+    gtdb = {}
+    for key,abundance in abundances.items():
+        clade = key[0].split('|')[-1]
+        if not clade.startswith('t__'):
+            continue
+        lineage = sgb2gtdb.get(clade[3:])
+        if lineage is None:
+            continue
+        levels = lineage.split(';')
+        for i in range(len(levels)):
+            name = ';'.join(levels[:i+1])
+            gtdb[(name,)] = gtdb.get((name,), 0.0)+abundance
+    return gtdb
+
+
+def cache_sgb2gtdb(source):
+    """Return the cached numpy version of a SGB to GTDB mapping, source being
+    MetaPhlAn mapping file (mpa_..._SGB2GTDB.tsv, found in MetaPhlAn utils
+    folder), either local or an URI, or only its database version (like
+    mpa_vJan21_CHOCOPhlAnSGB_202103) once it is cached"""
+    version = os.path.basename(source.rstrip('/'))
+    if version.endswith(SGB2GTDB_SUFFIX):
+        version = version[:-len(SGB2GTDB_SUFFIX)]
+    else:
+        version = os.path.splitext(version)[0]
+    cache_file = os.path.join(SGB2GTDB_DIR, version+'.npz')
+    if os.path.exists(cache_file):
+        return cache_file
+    if not os.path.exists(source) and '://' not in source:
+        raise RuntimeError(f'{source} is neither a SGB to GTDB mapping file nor a cached database version')
+    with tempfile.TemporaryDirectory() as temp_dir:
+        if '://' in source:
+            local = os.path.join(temp_dir, os.path.basename(source))
+            get(source, local)
+            source = local
+        sgb2gtdb = read_sgb2gtdb(source)
+    os.makedirs(SGB2GTDB_DIR, exist_ok=True)
+    temp_file = cache_file+'.tmp.npz'
+    np.savez(temp_file, sgbs=np.array(list(sgb2gtdb.keys())),
+        lineages=np.array(list(sgb2gtdb.values())))
+    os.replace(temp_file, cache_file)
+    return cache_file
+
+def load_sgb2gtdb(cache_file):
+    """Load a mapping cached by cache_sgb2gtdb as a dict"""
+    with np.load(cache_file) as data:
+        return dict(zip(data['sgbs'].tolist(), data['lineages'].tolist()))
+
+
+# the mapping of the current process (set once per process of the pool)
+_sgb2gtdb = None
+
+def _init_process(cache_file):
+    global _sgb2gtdb
+    _sgb2gtdb = load_sgb2gtdb(cache_file) if cache_file else None
+
+def convert_profile(filename):
+    """Read a profile and convert it to GTDB with the mapping of this process,
+    return (version, names, abundances, GTDB abundances or None)"""
+    version, names, abundances = read_profile(filename)
+    gtdb = gtdb_abundances(abundances, _sgb2gtdb) if _sgb2gtdb is not None else None
+    return version, names, abundances, gtdb
+
+
+class ProfileMerger:
+    """Merge MetaPhlAn profiles incrementally.
+
+    - sgb2gtdb: an optional mapping as returned by cache_sgb2gtdb, if provided
+        the GTDB table is built at the same time
+    - processes: profiles are read and converted in a pool of that many processes
+        (in the calling thread if 1), add may be called from several threads
+    """
+
+    def __init__(self, sgb2gtdb=None, processes=1):
+        self.sgb2gtdb = sgb2gtdb
+        self.table = SparseColumns()
+        self.gtdb_table = SparseColumns()
+        self.version = None
+        self.names = None
+        self.lock = threading.Lock()
+        if processes>1:
+            self.pool = concurrent.futures.ProcessPoolExecutor(max_workers=processes,
+                initializer=_init_process, initargs=(sgb2gtdb,))
+        else:
+            self.pool = None
+            _init_process(sgb2gtdb)
+
+    def close(self):
+        if self.pool:
+            self.pool.shutdown()
+
+    def add(self, filename, name=None):
+        """Add a profile file, name default to file name without extension (as
+        merge_metaphlan_tables.py does)"""
+        if name is None:
+            name = os.path.splitext(os.path.basename(filename))[0]
+        if self.pool:
+            version, names, abundances, gtdb = self.pool.submit(convert_profile, filename).result()
+        else:
+            version, names, abundances, gtdb = convert_profile(filename)
+        with self.lock:
+            if self.version is not None and version is not None and version!=self.version:
+                raise RuntimeError(f'{filename} was made with a different version of MetaPhlAn database ({version} and not {self.version})')
+            self.version = self.version or version
+            self.names = self.names or names
+            self.table.add_column(name, abundances)
+            if gtdb is not None:
+                self.gtdb_table.add_column(name, gtdb)
+
+    def write(self, filename):
+        with open(filename, 'w') as f:
+            if self.version:
+                f.write(self.version+'\n')
+            f.write('\t'.join((self.names or ['clade_name'])+self.table.sorted_columns())+'\n')
+            for key,line in self.table.lines():
+                f.write('\t'.join(list(key)+line)+'\n')
+
+    def write_gtdb(self, filename):
+        with open(filename, 'w') as f:
+            f.write('\t'.join(['clade_name']+self.gtdb_table.sorted_columns())+'\n')
+            for key,line in self.gtdb_table.lines():
+                f.write('\t'.join(list(key)+line)+'\n')
+
+
+def read_sgb2gtdb(filename):
+    """Read MetaPhlAn SGB to GTDB mapping (mpa_..._SGB2GTDB.tsv, found in
+    MetaPhlAn utils folder)"""
+    sgb2gtdb = {}
+    with open(filename, 'r') as f:
+        for line in f:
+            if line.strip() and not line.startswith('#'):
+                sgb, lineage = line.rstrip('\n').split('\t')[:2]
+                sgb2gtdb[sgb] = lineage
+    return sgb2gtdb
+
+
+class ProfileCollector:
+    """Download profiles into a ProfileMerger as soon as their task succeeded,
+    while common.join is waiting for the others:
+
+        collector = ProfileCollector(merger, output_s3)
+        join(s, tasks, retry=2, on_success=collector.on_success)
+        collector.collect(samples)
+
+    - merger: a ProfileMerger
+    - output_s3: where profiles are ({output_s3}/{sample}/{sample}.metaphlan4_profile.txt)
+    """
+
+    def __init__(self, merger, output_s3):
+        self.merger = merger
+        self.output_s3 = output_s3.rstrip('/')
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=MAX_PARALLEL_DOWNLOAD)
+        self.futures = {}
+
+    def _fetch(self, sample):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            local = os.path.join(temp_dir, sample+PROFILE_SUFFIX)
+            get(f'{self.output_s3}/{sample}/{sample}{PROFILE_SUFFIX}', local)
+            self.merger.add(local)
+
+    def fetch(self, sample):
+        """Start downloading a sample profile in the background (once)"""
+        if sample not in self.futures:
+            self.futures[sample] = self.executor.submit(self._fetch, sample)
+
+    def on_success(self, task):
+        """common.join callback (tasks are named after their sample)"""
+        self.fetch(task['name'] if type(task)==dict else task.name)
+
+    def collect(self, samples):
+        """Fetch the profiles of these samples that were not already fetched,
+        and wait for all the downloads"""
+        for sample in samples:
+            self.fetch(sample)
+        for sample,future in self.futures.items():
+            try:
+                future.result()
+            except Exception as e:
+                print(f'No profile for {sample}: {e}')
+        self.executor.shutdown()
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(
+                    prog = 'MetaPhlAn profile merge',
+                    description = 'Merge MetaPhlAn profiles (and convert them to GTDB) like merge_metaphlan_tables.py, sgb_to_gtdb_profile.py and combine_csv do.')
+    parser.add_argument('profiles', type=str, nargs='+',
+        help='MetaPhlAn profiles (local files)')
+    parser.add_argument('-o', '--output', type=str, default='.',
+        help='Folder where merged_abundance_table.tsv (and merged_abundance_table_gtdb.tsv) are written')
+    parser.add_argument('--sgb2gtdb', type=str, default=None,
+        help='SGB to GTDB mapping (mpa_..._SGB2GTDB.tsv, local or URI, or database version once cached) to also produce the GTDB table')
+    parser.add_argument('--processes', type=int, default=os.cpu_count(),
+        help='How many profiles are read in parallel, default to CPU count')
+    args = parser.parse_args()
+
+    merger = ProfileMerger(cache_sgb2gtdb(args.sgb2gtdb) if args.sgb2gtdb else None,
+        processes=args.processes)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.processes) as executor:
+        for _ in executor.map(merger.add, args.profiles):
+            pass
+    merger.close()
+    os.makedirs(args.output, exist_ok=True)
+    merger.write(os.path.join(args.output, 'merged_abundance_table.tsv'))
+    if args.sgb2gtdb:
+        merger.write_gtdb(os.path.join(args.output, 'merged_abundance_table_gtdb.tsv'))
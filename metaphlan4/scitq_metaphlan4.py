@@ -1,8 +1,21 @@
 from scitq.lib import Server
-from scitq.fetch import sync, list_content
+from scitq.fetch import sync
 import subprocess
 import argparse
 import os
+import sys
+from contextlib import nullcontext
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.discovery import SampleDiscovery
+from common.submission import TaskSubmitter
+from common.resume import ResumeIndex
+from common.scheduling import largest_first
+from common.autoscale import ThroughputModel, AutoScaler, fleet_size, DEFAULT_MAX_WORKERS, DEFAULT_TARGET_HOURS
+from common.join import join
+from common.resources import resource_uri
+from common.result_cache import ResultCache, CachedSubmitter, DEFAULT_TTL_DAYS
+from profile_merge import ProfileMerger, ProfileCollector, cache_sgb2gtdb
 
 
 # Do not change that unless you know what you do
@@ -11,13 +24,26 @@ DEFAULT_VERSION = '4.0.6'
 DEFAULT_WORKERS = 5
 DEFAULT_REGION = 'GRA11'
 DEFAULT_PROVIDER = 'ovh'
+CONCURRENCY = 4
+PREFETCH = 1
 
 MAX_RETRY_PHASE1 = 2
 MAX_RETRY_PHASE2 = 5
 
+def metaphlan_command(sample, major_version, output='/output'):
+    """Return the shell command profiling a sample, which FASTQs are in /input,
+    results going into output"""
+    offline = '' if major_version=='3' else ' --offline'
+    return f"""zcat /input/*.fastq.gz |metaphlan --input_type fastq \
+            --no_map{offline} --bowtie2db /resource/metaphlan/bowtie2 \
+            --nproc $CPU -o {output}/{sample}.metaphlan4_profile.txt"""
+
 def metaphlan4(scitq_server, batch, source_s3, output_s3, final_output_s3, metaphlan_s3,
         region=DEFAULT_REGION, workers=DEFAULT_WORKERS, metaphlan_version=DEFAULT_VERSION,
-        provider=DEFAULT_PROVIDER):
+        provider=DEFAULT_PROVIDER, refresh_listing=False, stream=False,
+        resume=False, check_inputs=False, autoscale=False, max_workers=DEFAULT_MAX_WORKERS,
+        target_hours=DEFAULT_TARGET_HOURS, listing_order=False, local_merge=False, sgb2gtdb=None,
+        result_cache=False, cache_ttl=DEFAULT_TTL_DAYS):
     """Launch biomscope using scitq in two phase, final compilation is done locally.
     Requires awscli, awscli-plugin-endpoint, combine_csv, sed and cut. Paramaters are
     explained through commande line --help"""
@@ -32,53 +58,116 @@ def metaphlan4(scitq_server, batch, source_s3, output_s3, final_output_s3, metap
         raise RuntimeError(f'metaphlan_s3 should be in the form s3://bucket/path.../whatever.tgz (or .tar.gz) and not {metaphlan_s3}')
 
 
-    fastqs = [fastq.name for fastq in 
-                list_content(source_s3) if fastq.name.endswith('fastq.gz')]
-    
     # fastqs are supposed to be grouped in folders each folder representing a sample
-    samples = {}
-    for fastq in fastqs:
-        sample = fastq.split('/')[-2]
-        if sample not in samples:
-            samples[sample]=[fastq]
-        else:
-            samples[sample].append(fastq)
+    samples = SampleDiscovery(source_s3, 'fastq.gz', refresh=refresh_listing,
+                    md5=check_inputs or result_cache)
+    if not stream:
+        samples.samples()
+        if len(samples.inventory)==0:
+            raise RuntimeError(f'Source ({source_s3}) does not seems to contain any .fastq.gz files')
 
+    metaphlan_resource = resource_uri(metaphlan_s3)
     major_version = metaphlan_version.split('.')[0]
     docker = DOCKER.format(version=metaphlan_version, major_version=major_version)
 
 
 
-    tasks = []
-    for sample,fastqs in samples.items():
-        if major_version=='3':
-            command=f"""sh -c 'zcat /input/*.fastq.gz |metaphlan --input_type fastq \
-            --no_map --bowtie2db /resource/metaphlan/bowtie2 \
-            --nproc $CPU -o /output/{sample}.metaphlan4_profile.txt' """
-        else:
-            command=f"""sh -c 'zcat /input/*.fastq.gz |metaphlan --input_type fastq \
-            --no_map --offline --bowtie2db /resource/metaphlan/bowtie2 \
-            --nproc $CPU -o /output/{sample}.metaphlan4_profile.txt' """
-        tasks.append(
-            s.task_create(
-                command=command,
-                name=sample,
+    def deploy_workers():
+        if workers:
+            s.worker_deploy(number=workers,
                 batch=batch,
-                input=' '.join(fastqs),
-                output=f'{output_s3}/{sample}',
-                resource=f'{metaphlan_s3}|untar',
-                container=docker
-            )
-        )
-    if workers:
-        s.worker_deploy(number=workers,
+                region=region,
+                provider=provider,
+                flavor='c2-120' if provider=='ovh' else 'Standard_D32ads_v5',
+                concurrency=CONCURRENCY,
+                prefetch=PREFETCH)
+
+    if stream:
+        # workers boot while the source is listed and tasks are created
+        deploy_workers()
+
+    resume_index = ResumeIndex(output_s3, ['{sample}/{sample}.metaphlan4_profile.txt'], resume=resume,
+        check_inputs=check_inputs)
+    model = ThroughputModel('metaphlan4')
+    cache = ResultCache(ttl=cache_ttl) if result_cache else None
+    # tasks which results are in the cache are not created
+    submitter = CachedSubmitter(TaskSubmitter(s), cache)
+    if stream:
+        sample_groups = samples
+    elif listing_order:
+        sample_groups = samples.inventory.items()
+    else:
+        # longest tasks first, so that they do not end up running alone at the end
+        sample_groups = largest_first(samples.inventory)
+    for sample,items in sample_groups:
+        if resume_index.skip(sample, items):
+            continue
+        fastqs = [item.name for item in items]
+        command=f"sh -c '{metaphlan_command(sample, major_version)}' "
+        submitter.submit([(sample, items)], items,
+            command=command,
+            name=sample,
             batch=batch,
-            region=region,
-            provider=provider,
-            flavor='c2-120' if provider=='ovh' else 'Standard_D32ads_v5',
-            concurrency=4,
-            prefetch=1)
-    s.join(tasks, retry=MAX_RETRY_PHASE1)
+            input=' '.join(fastqs),
+            output=f'{output_s3}/{sample}',
+            resource=metaphlan_resource,
+            container=docker
+        )
+    tasks, task_units, restored_units = submitter.wait()
+    task_samples = [sample for unit in task_units for sample,_ in unit]
+    sizes = [sum(item.size or 0 for _,items in unit for item in items) for unit in task_units]
+    restored_samples = [sample for unit in restored_units for sample,_ in unit]
+    # restored results are done
+    for unit in restored_units:
+        for sample,items in unit:
+            resume_index.record(sample, items)
+    if len(tasks)==0 and resume_index.skipped==0 and not restored_samples:
+        raise RuntimeError(f'Source ({source_s3}) does not seems to contain any .fastq.gz files')
+
+    autoscaling = autoscale and workers
+    if local_merge:
+        # profiles are merged locally as soon as their task is done
+        merger = ProfileMerger(cache_sgb2gtdb(sgb2gtdb) if sgb2gtdb else None,
+            processes=os.cpu_count())
+        collector = ProfileCollector(merger, output_s3)
+    on_success = collector.on_success if local_merge else None
+    if cache:
+        # results are recorded as soon as their task succeeded
+        on_success = cache.on_success(on_success)
+    if tasks:
+        if not stream:
+            if autoscaling:
+                workers = fleet_size(model, sizes, CONCURRENCY, target_hours=target_hours,
+                    max_workers=max_workers)
+                print(f'Autoscaling: deploying {workers} worker(s) for {sum(sizes)/1024**3:.1f} GB of input')
+            deploy_workers()
+        scaler = AutoScaler(s, batch, tasks, sizes, model, CONCURRENCY,
+            dict(region=region, provider=provider, prefetch=PREFETCH,
+                flavor='c2-120' if provider=='ovh' else 'Standard_D32ads_v5'),
+            target_hours=target_hours, max_workers=max_workers) if autoscaling else nullcontext()
+        # inputs fingerprints are recorded once their task succeeded
+        resume_index.watch(tasks, task_units)
+        try:
+            with scaler:
+                join(s, tasks, retry=MAX_RETRY_PHASE1, batch=batch,
+                    on_success=resume_index.on_success(on_success), sizes=sizes)
+        finally:
+            resume_index.save()
+    else:
+        resume_index.save()
+    if cache:
+        cache.close()
+
+    if local_merge:
+        # resumed and restored samples, and those done since the last collection
+        collector.collect(resume_index.skipped_samples+restored_samples+task_samples)
+        merger.close()
+        os.makedirs(batch, exist_ok=True)
+        merger.write(os.path.join(batch, 'merged_abundance_table.tsv'))
+        if sgb2gtdb:
+            merger.write_gtdb(os.path.join(batch, 'merged_abundance_table_gtdb.tsv'))
+        sync(batch, final_output_s3)
+        return
 
     resource = None
     if metaphlan_version in ['4.0.1','4.0.3','4.0.3.1']:
@@ -92,14 +181,11 @@ done
 combine_csv -c -a -s '\t' -i '*/*profile.txt.gtdb' -o /output/merged_abundance_table_gtdb.tsv
 " """
     elif metaphlan_version in ['4.0.6']:
-        resource = f'{metaphlan_s3}|untar'
+        resource = metaphlan_resource
         command = """sh -c "
 cd /input
 merge_metaphlan_tables.py */*profile.txt > /output/merged_abundance_table.tsv
-for sample in *
-do
-    sgb_to_gtdb_profile.py -d /resource/metaphlan/bowtie2/*.pkl -i ${sample}/${sample}.metaphlan4_profile.txt -o ${sample}/${sample}.metaphlan4_profile.txt.gtdb
-done
+ls | parallel -j $CPU sgb_to_gtdb_profile.py -d /resource/metaphlan/bowtie2/*.pkl -i {}/{}.metaphlan4_profile.txt -o {}/{}.metaphlan4_profile.txt.gtdb
 combine_csv -c -a -s '\t' -i '*/*profile.txt.gtdb' -o /output/merged_abundance_table_gtdb.tsv
 " """
     else:
@@ -127,7 +213,7 @@ merge_metaphlan_tables.py */*profile.txt > /output/merged_abundance_table.tsv
             concurrency=1,
             prefetch=1)
 
-    s.join([task], retry=MAX_RETRY_PHASE2)
+    join(s, [task], retry=MAX_RETRY_PHASE2, batch=batch+'_metaphlan4_p2')
 
     sync(final_output_s3,batch)
 
@@ -158,6 +244,30 @@ if __name__=='__main__':
         help=f'how many workers should we have, default to {DEFAULT_WORKERS}. (setting to 0 will prevent recruitment)')
     parser.add_argument('--metaphlan-version', type=str, default='4.0.6',
         help=f'what version of metaphlan should be used (3.1.0, 4.0.3, 4.0.5 or 4.0.6)')
+    parser.add_argument('--refresh-listing', action='store_true', 
+        help=f'Ignore the local index of source_s3 listing and list it again completely.')
+    parser.add_argument('--stream', action='store_true', 
+        help=f'Deploy workers right away and create tasks while source_s3 is being listed.')
+    parser.add_argument('--autoscale', action='store_true', 
+        help=f'Choose the number of workers from the input size, and adjust it while tasks are running.')
+    parser.add_argument('--max-workers', type=int, default=DEFAULT_MAX_WORKERS,
+        help=f'With --autoscale, the maximal number of workers, default to {DEFAULT_MAX_WORKERS}.')
+    parser.add_argument('--target-hours', type=float, default=DEFAULT_TARGET_HOURS,
+        help=f'With --autoscale, the expected duration of the run, default to {DEFAULT_TARGET_HOURS}.')
+    parser.add_argument('--listing-order', action='store_true', 
+        help=f'Create tasks in listing order instead of biggest samples first.')
+    parser.add_argument('--result-cache', action='store_true', 
+        help=f'Copy the results of tasks already done in a previous run (same inputs, database and options, in any output folder) instead of launching them again.')
+    parser.add_argument('--cache-ttl', type=float, default=DEFAULT_TTL_DAYS,
+        help=f'With --result-cache, only reuse results of less than that many days, default to {DEFAULT_TTL_DAYS}.')
+    parser.add_argument('--resume', action='store_true', 
+        help=f'Skip samples which results are already present in output_s3.')
+    parser.add_argument('--check-inputs', action='store_true', 
+        help=f'With --resume, also recompute samples which inputs changed since they were launched.')
+    parser.add_argument('--local-merge', action='store_true', 
+        help=f'Merge the profiles locally while tasks are running instead of using a final scitq task.')
+    parser.add_argument('--sgb2gtdb', type=str, default=None,
+        help=f'With --local-merge, MetaPhlAn SGB to GTDB mapping (mpa_..._SGB2GTDB.tsv, local or URI, or its database version once cached) to also produce the GTDB table.')
     args = parser.parse_args()
 
     if not args.scitq:
@@ -176,5 +286,17 @@ if __name__=='__main__':
         region=args.region,
         provider=args.provider,
         workers=args.workers,
-        metaphlan_version=args.metaphlan_version
+        metaphlan_version=args.metaphlan_version,
+        refresh_listing=args.refresh_listing,
+        stream=args.stream,
+        resume=args.resume,
+        check_inputs=args.check_inputs,
+        autoscale=args.autoscale,
+        max_workers=args.max_workers,
+        target_hours=args.target_hours,
+        listing_order=args.listing_order,
+        local_merge=args.local_merge,
+        sgb2gtdb=args.sgb2gtdb,
+        result_cache=args.result_cache,
+        cache_ttl=args.cache_ttl
     )
\ No newline at end of file
@@ -1,8 +1,23 @@
 from scitq.lib import Server
-from scitq.fetch import sync, list_content
+from scitq.fetch import sync
 import subprocess
 import argparse
 import os
+import sys
+from contextlib import nullcontext
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.discovery import SampleDiscovery
+from common.submission import TaskSubmitter
+from common.resume import ResumeIndex
+from common.scheduling import largest_first, sample_size
+from common.autoscale import ThroughputModel, AutoScaler, fleet_size, DEFAULT_MAX_WORKERS, DEFAULT_TARGET_HOURS
+from common.join import join
+from common.resources import resource_uri, tool_resource
+from common.result_cache import ResultCache, CachedSubmitter, DEFAULT_TTL_DAYS
+from common.depth import DepthScanner, ESTIMATORS, save_report
+from profile_merge import ProfileMerger, ProfileCollector, cache_sgb2gtdb
+from filter_pipeline import filter_command, SAMPLERS, SUBSAMPLE_SCRIPT
 
 
 # Do not change that unless you know what you do
@@ -11,8 +26,18 @@ DEFAULT_VERSION = '4.0.6'
 DEFAULT_WORKERS = 5
 DEFAULT_REGION = 'GRA11'
 DEFAULT_PROVIDER = 'ovh'
+CONCURRENCY = 4
+PREFETCH = 1
 DEFAULT_DEPTH=20000000
 DEFAULT_SEED=42
+# rough size of a 150bp read in a gzipped FASTQ
+GZ_FASTQ_BYTES_PER_READ=80
+# with --prescan, samples with more read pairs than that go to a bigger flavor
+DEFAULT_LARGE_PAIRS=100000000
+DEFAULT_LARGE_WORKERS=1
+LARGE_CONCURRENCY=2
+# and below that fraction of depth, reads are not sampled (estimates are rough)
+NO_SAMPLING_RATIO=0.8
 DEFAULT_CHM13V2='https://genome-idx.s3.amazonaws.com/bt/chm13v2.0.zip'
 
 MAX_RETRY_PHASE1 = 2
@@ -20,7 +45,12 @@ MAX_RETRY_PHASE2 = 5
 
 def metaphlan4(scitq_server, batch, source_s3, output_s3, final_output_s3, metaphlan_s3,
         human_catalog, region=DEFAULT_REGION, workers=DEFAULT_WORKERS, metaphlan_version=DEFAULT_VERSION,
-        provider=DEFAULT_PROVIDER, depth=DEFAULT_DEPTH, seed=DEFAULT_SEED):
+        provider=DEFAULT_PROVIDER, depth=DEFAULT_DEPTH, seed=DEFAULT_SEED,
+        refresh_listing=False, stream=False,
+        resume=False, check_inputs=False, autoscale=False, max_workers=DEFAULT_MAX_WORKERS,
+        target_hours=DEFAULT_TARGET_HOURS, listing_order=False, local_merge=False, sgb2gtdb=None,
+        intermediate_files=False, sampler='reservoir', prescan=None, large_pairs=DEFAULT_LARGE_PAIRS,
+        large_workers=DEFAULT_LARGE_WORKERS, result_cache=False, cache_ttl=DEFAULT_TTL_DAYS):
     """Launch biomscope using scitq in two phase, final compilation is done locally.
     Requires awscli, awscli-plugin-endpoint, combine_csv, sed and cut. Paramaters are
     explained through commande line --help"""
@@ -35,17 +65,13 @@ def metaphlan4(scitq_server, batch, source_s3, output_s3, final_output_s3, metap
         raise RuntimeError(f'metaphlan_s3 should be in the form s3://bucket/path.../whatever.tgz (or .tar.gz) and not {metaphlan_s3}')
 
 
-    fastqs = [fastq.name for fastq in 
-                list_content(source_s3) if fastq.name.endswith('fastq.gz')]
-    
     # fastqs are supposed to be grouped in folders each folder representing a sample
-    samples = {}
-    for fastq in fastqs:
-        sample = fastq.split('/')[-2]
-        if sample not in samples:
-            samples[sample]=[fastq]
-        else:
-            samples[sample].append(fastq)
+    samples = SampleDiscovery(source_s3, 'fastq.gz', refresh=refresh_listing,
+                    md5=check_inputs or result_cache)
+    if not stream:
+        samples.samples()
+        if len(samples.inventory)==0:
+            raise RuntimeError(f'Source ({source_s3}) does not seems to contain any .fastq.gz files')
 
     major_version = metaphlan_version.split('.')[0]
     version = '4.0.6.1' if metaphlan_version=='4.0.6' else metaphlan_version
@@ -57,45 +83,180 @@ def metaphlan4(scitq_server, batch, source_s3, output_s3, final_output_s3, metap
         human_catalog_action = 'untar'
     else:
         raise RuntimeError(f'This extension is unsupported for human catalog: {human_catalog}')
+    metaphlan_resource = resource_uri(metaphlan_s3)
+    human_catalog_resource = resource_uri(human_catalog, human_catalog_action)
+    task_resource = f'{metaphlan_resource} {human_catalog_resource}'
+    subsample_script = None
+    if sampler=='reservoir':
+        # the subsampling tool is sent to workers as a resource
+        subsample_resource = tool_resource(SUBSAMPLE_SCRIPT, f'{output_s3}/.tools')
+        subsample_script = subsample_resource.rsplit('/', 1)[-1]
+        task_resource += f' {subsample_resource}'
 
     if major_version=='3':
         metaphlan_option=''
     else:
         metaphlan_option='--offline'
 
-    tasks = []
-    for sample,fastqs in samples.items():
-        command=f"""sh -c 'fastp \
-            --adapter_sequence AGATCGGAAGAGCACACGTCTGAACTCCAGTCA --adapter_sequence_r2 AGATCGGAAGAGCGTCGTGTAGGGAAAGAGTGT \
-            --cut_front --cut_tail --n_base_limit 0 --length_required 60 --in1 /input/*.1.fastq.gz --in2 /input/*.2.fastq.gz \
-            --out1 /input/{sample}_fp.1.fastq --out2 /input/{sample}_fp.2.fastq 
-            bowtie2 -p $CPU --mm -x /resource/chm13v2.0/chm13v2.0 -1 /input/{sample}_fp.1.fastq  \
-                -2 /input/{sample}_fp.2.fastq | samtools fastq -@ 2 -f 12 -F 256 -1 /input/{sample}_noh.1.fastq \
-                -2 /input/{sample}_noh.2.fastq -0 /dev/null -s /dev/null -N
-            parallel seqtk sample -s{seed} /input/{sample}_noh.{{}}.fastq {depth} \\> /input/{sample}_norm.{{}}.fastq ::: 1 2
-            cat /input/{sample}_norm.*.fastq |metaphlan --input_type fastq \
-        --no_map {metaphlan_option} --bowtie2db /resource/metaphlan/bowtie2 \
-        --nproc $CPU -o /output/{sample}.metaphlan4_profile.txt' """
-        tasks.append(
-            s.task_create(
-                command=command,
-                name=sample,
+    # the main fleet, which autoscaling sizes (large workers do not depend on it)
+    main_workers = workers
+    def deploy_workers():
+        if main_workers:
+            s.worker_deploy(number=main_workers,
                 batch=batch,
-                input=' '.join(fastqs),
-                output=f'{output_s3}/{sample}',
-                resource=f'{metaphlan_s3}|untar {human_catalog}|{human_catalog_action}',
-                container=docker
-            )
+                region=region,
+                provider=provider,
+                flavor='c2-120' if provider=='ovh' else 'Standard_D32ads_v5',
+                concurrency=CONCURRENCY,
+                prefetch=PREFETCH)
+
+    large_batch = batch+'_large'
+    large_deployed = False
+    def deploy_large_workers():
+        # samples with lots of reads get more CPUs each (and more disk)
+        if workers and large_workers:
+            s.worker_deploy(number=large_workers,
+                batch=large_batch,
+                region=region,
+                provider=provider,
+                flavor='i1-180' if provider=='ovh' else 'Standard_D64ads_v5',
+                concurrency=LARGE_CONCURRENCY,
+                prefetch=PREFETCH)
+
+    if stream:
+        # workers boot while the source is listed and tasks are created
+        deploy_workers()
+
+    resume_index = ResumeIndex(output_s3, ['{sample}/{sample}.metaphlan4_profile.txt'], resume=resume,
+        check_inputs=check_inputs)
+    model = ThroughputModel('metaphlan4_filter')
+    cache = ResultCache(ttl=cache_ttl) if result_cache else None
+    # tasks which results are in the cache are not created
+    submitter = CachedSubmitter(TaskSubmitter(s), cache)
+    sample_batches = {}
+    scanner = DepthScanner(prescan) if prescan else None
+    estimates = {}
+    prescan_rows = []
+    def sample_cost(items):
+        # fastp and bowtie2 process the whole input, metaphlan at most depth pairs
+        size = sample_size(items)
+        return size + min(size, 2*depth*GZ_FASTQ_BYTES_PER_READ)
+
+    if stream:
+        sample_groups = samples
+    elif listing_order:
+        sample_groups = samples.inventory.items()
+    else:
+        # longest tasks first, so that they do not end up running alone at the end
+        sample_groups = largest_first(samples.inventory, cost=sample_cost)
+    if scanner and not stream:
+        print(f'Pre-scanning {len(samples.inventory)} sample(s) read depth')
+        for sample,_,reads in scanner.scan(samples.inventory.items()):
+            estimates[sample] = reads
+    for sample,items in sample_groups:
+        if resume_index.skip(sample, items):
+            continue
+        fastqs = [item.name for item in items]
+        sample_depth = depth
+        sample_batch = batch
+        if scanner:
+            # FASTQs are paired
+            pairs = (estimates[sample] if sample in estimates else scanner.reads(items))//2
+            status = 'ok'
+            if pairs<depth:
+                status = 'under_depth'
+                if pairs<depth*NO_SAMPLING_RATIO:
+                    sample_depth = None
+            elif pairs>large_pairs:
+                status = 'large'
+                sample_batch = large_batch
+                if not large_deployed and stream:
+                    deploy_large_workers()
+                large_deployed = True
+            prescan_rows.append({'sample': sample, 'size': sample_size(items),
+                'estimated_pairs': pairs, 'status': status})
+        command = filter_command(sample, sample_depth, seed, metaphlan_option, streaming=not intermediate_files,
+            sampler=sampler, subsample_script=subsample_script)
+        sample_batches[sample] = sample_batch
+        submitter.submit([(sample, items)], items,
+            command=command,
+            name=sample,
+            batch=sample_batch,
+            input=' '.join(fastqs),
+            output=f'{output_s3}/{sample}',
+            resource=task_resource,
+            container=docker
         )
-    if workers:
-        s.worker_deploy(number=workers,
-            batch=batch,
-            region=region,
-            provider=provider,
-            flavor='c2-120' if provider=='ovh' else 'Standard_D32ads_v5',
-            concurrency=4,
-            prefetch=1)
-    s.join(tasks, retry=MAX_RETRY_PHASE1)
+    tasks, task_units, restored_units = submitter.wait()
+    task_samples = [sample for unit in task_units for sample,_ in unit]
+    task_batches = [sample_batches[sample] for sample in task_samples]
+    sizes = [sum(item.size or 0 for _,items in unit for item in items) for unit in task_units]
+    restored_samples = [sample for unit in restored_units for sample,_ in unit]
+    # restored results are done
+    for unit in restored_units:
+        for sample,items in unit:
+            resume_index.record(sample, items)
+    if scanner:
+        scanner.save()
+        under_depth = [row['sample'] for row in prescan_rows if row['status']=='under_depth']
+        large = [row['sample'] for row in prescan_rows if row['status']=='large']
+        print(f'Pre-scan: {len(under_depth)} sample(s) under depth {", ".join(under_depth[:10])}'
+            f'{"..." if len(under_depth)>10 else ""}, {len(large)} large sample(s) in {large_batch} '
+            f'(details in {save_report(batch, prescan_rows)})')
+    if len(tasks)==0 and resume_index.skipped==0 and not restored_samples:
+        raise RuntimeError(f'Source ({source_s3}) does not seems to contain any .fastq.gz files')
+
+    autoscaling = autoscale and workers
+    if local_merge:
+        # profiles are merged locally as soon as their task is done
+        merger = ProfileMerger(cache_sgb2gtdb(sgb2gtdb) if sgb2gtdb else None,
+            processes=os.cpu_count())
+        collector = ProfileCollector(merger, output_s3)
+    on_success = collector.on_success if local_merge else None
+    if cache:
+        # results are recorded as soon as their task succeeded
+        on_success = cache.on_success(on_success)
+    if tasks:
+        # autoscaling only manages the main batch
+        main = [i for i,task_batch in enumerate(task_batches) if task_batch==batch]
+        main_tasks = [tasks[i] for i in main]
+        main_sizes = [sizes[i] for i in main]
+        if not stream:
+            if autoscaling:
+                main_workers = fleet_size(model, main_sizes, CONCURRENCY, target_hours=target_hours,
+                    max_workers=max_workers)
+                print(f'Autoscaling: deploying {main_workers} worker(s) for {sum(main_sizes)/1024**3:.1f} GB of input')
+            if main_tasks:
+                deploy_workers()
+            if large_batch in task_batches:
+                deploy_large_workers()
+        scaler = AutoScaler(s, batch, main_tasks, main_sizes, model, CONCURRENCY,
+            dict(region=region, provider=provider, prefetch=PREFETCH,
+                flavor='c2-120' if provider=='ovh' else 'Standard_D32ads_v5'),
+            target_hours=target_hours, max_workers=max_workers) if autoscaling and main_tasks else nullcontext()
+        # inputs fingerprints are recorded once their task succeeded
+        resume_index.watch(tasks, task_units)
+        try:
+            with scaler:
+                join(s, tasks, retry=MAX_RETRY_PHASE1, batch=batch,
+                    on_success=resume_index.on_success(on_success), sizes=sizes)
+        finally:
+            resume_index.save()
+    else:
+        resume_index.save()
+    if cache:
+        cache.close()
+
+    if local_merge:
+        # resumed and restored samples, and those done since the last collection
+        collector.collect(resume_index.skipped_samples+restored_samples+task_samples)
+        merger.close()
+        os.makedirs(batch, exist_ok=True)
+        merger.write(os.path.join(batch, 'merged_abundance_table.tsv'))
+        if sgb2gtdb:
+            merger.write_gtdb(os.path.join(batch, 'merged_abundance_table_gtdb.tsv'))
+        sync(batch, final_output_s3)
+        return
 
     resource = None
     if metaphlan_version in ['4.0.1','4.0.3','4.0.3.1']:
@@ -109,14 +270,11 @@ done
 combine_csv -c -a -s '\t' -i '*/*profile.txt.gtdb' -o /output/merged_abundance_table_gtdb.tsv
 " """
     elif metaphlan_version in ['4.0.6']:
-        resource = f'{metaphlan_s3}|untar'
+        resource = metaphlan_resource
         command = """sh -c "
 cd /input
 merge_metaphlan_tables.py */*profile.txt > /output/merged_abundance_table.tsv
-for sample in *
-do
-    sgb_to_gtdb_profile.py -d /resource/metaphlan/bowtie2/*.pkl -i ${sample}/${sample}.metaphlan4_profile.txt -o ${sample}/${sample}.metaphlan4_profile.txt.gtdb
-done
+ls | parallel -j $CPU sgb_to_gtdb_profile.py -d /resource/metaphlan/bowtie2/*.pkl -i {}/{}.metaphlan4_profile.txt -o {}/{}.metaphlan4_profile.txt.gtdb
 combine_csv -c -a -s '\t' -i '*/*profile.txt.gtdb' -o /output/merged_abundance_table_gtdb.tsv
 " """
     else:
@@ -144,7 +302,7 @@ merge_metaphlan_tables.py */*profile.txt > /output/merged_abundance_table.tsv
             concurrency=1,
             prefetch=1)
 
-    s.join([task], retry=MAX_RETRY_PHASE2)
+    join(s, [task], retry=MAX_RETRY_PHASE2, batch=batch+'_metaphlan4_p2')
 
     sync(final_output_s3,batch)
 
@@ -175,10 +333,44 @@ if __name__=='__main__':
         help=f'how many workers should we have, default to {DEFAULT_WORKERS}. (setting to 0 will prevent recruitment)')
     parser.add_argument('--metaphlan-version', type=str, default='4.0.6',
         help=f'what version of metaphlan should be used (3.1.0, 4.0.3, 4.0.5 or 4.0.6)')
+    parser.add_argument('--refresh-listing', action='store_true', 
+        help=f'Ignore the local index of source_s3 listing and list it again completely.')
+    parser.add_argument('--stream', action='store_true', 
+        help=f'Deploy workers right away and create tasks while source_s3 is being listed.')
+    parser.add_argument('--autoscale', action='store_true', 
+        help=f'Choose the number of workers from the input size, and adjust it while tasks are running.')
+    parser.add_argument('--max-workers', type=int, default=DEFAULT_MAX_WORKERS,
+        help=f'With --autoscale, the maximal number of workers, default to {DEFAULT_MAX_WORKERS}.')
+    parser.add_argument('--target-hours', type=float, default=DEFAULT_TARGET_HOURS,
+        help=f'With --autoscale, the expected duration of the run, default to {DEFAULT_TARGET_HOURS}.')
+    parser.add_argument('--listing-order', action='store_true', 
+        help=f'Create tasks in listing order instead of biggest samples first.')
+    parser.add_argument('--result-cache', action='store_true', 
+        help=f'Copy the results of tasks already done in a previous run (same inputs, database and options, in any output folder) instead of launching them again.')
+    parser.add_argument('--cache-ttl', type=float, default=DEFAULT_TTL_DAYS,
+        help=f'With --result-cache, only reuse results of less than that many days, default to {DEFAULT_TTL_DAYS}.')
+    parser.add_argument('--resume', action='store_true', 
+        help=f'Skip samples which results are already present in output_s3.')
+    parser.add_argument('--check-inputs', action='store_true', 
+        help=f'With --resume, also recompute samples which inputs changed since they were launched.')
+    parser.add_argument('--local-merge', action='store_true', 
+        help=f'Merge the profiles locally while tasks are running instead of using a final scitq task.')
+    parser.add_argument('--sgb2gtdb', type=str, default=None,
+        help=f'With --local-merge, MetaPhlAn SGB to GTDB mapping (mpa_..._SGB2GTDB.tsv, local or URI, or its database version once cached) to also produce the GTDB table.')
     parser.add_argument('--depth', type=int, default=DEFAULT_DEPTH,
         help=f'what should be the normalization depth (default to {DEFAULT_DEPTH} for each pair member)')
     parser.add_argument('--seed', type=int, default=DEFAULT_SEED,
         help=f'what should be the seed for normalization randomness (default to {DEFAULT_SEED})')
+    parser.add_argument('--sampler', type=str, choices=SAMPLERS, default='reservoir',
+        help=f'How reads are normalized to depth: reservoir samples read pairs in a single pass (and records the sample depth), seqtk samples each mate with seqtk as previous versions, default to reservoir')
+    parser.add_argument('--prescan', type=str, choices=ESTIMATORS, default=None,
+        help=f'Estimate each sample read depth before submission, from FASTQs size or from the head of each FASTQ, to flag samples under depth (which reads are then not sampled) and send very large samples to bigger workers')
+    parser.add_argument('--large-pairs', type=int, default=DEFAULT_LARGE_PAIRS,
+        help=f'With --prescan, samples with more read pairs than that are large, default to {DEFAULT_LARGE_PAIRS}')
+    parser.add_argument('--large-workers', type=int, default=DEFAULT_LARGE_WORKERS,
+        help=f'With --prescan, how many bigger workers are deployed for large samples, default to {DEFAULT_LARGE_WORKERS}')
+    parser.add_argument('--intermediate-files', action='store_true', 
+        help=f'Write each pre-processing stage output in uncompressed FASTQs instead of streaming reads from one stage to the next.')
     parser.add_argument('--human-catalog', type=str, default=DEFAULT_CHM13V2,
         help=f'A tar gz file human catalog for chm13v2 (default to {DEFAULT_CHM13V2})')
     args = parser.parse_args()
@@ -201,5 +393,22 @@ if __name__=='__main__':
         workers=args.workers,
         metaphlan_version=args.metaphlan_version,
         depth=args.depth,
-        seed=args.seed
+        seed=args.seed,
+        refresh_listing=args.refresh_listing,
+        stream=args.stream,
+        resume=args.resume,
+        check_inputs=args.check_inputs,
+        autoscale=args.autoscale,
+        max_workers=args.max_workers,
+        target_hours=args.target_hours,
+        listing_order=args.listing_order,
+        local_merge=args.local_merge,
+        sgb2gtdb=args.sgb2gtdb,
+        intermediate_files=args.intermediate_files,
+        sampler=args.sampler,
+        prescan=args.prescan,
+        large_pairs=args.large_pairs,
+        large_workers=args.large_workers,
+        result_cache=args.result_cache,
+        cache_ttl=args.cache_ttl
     )
\ No newline at end of file
@@ -1,8 +1,22 @@
 from scitq.lib import Server
-from scitq.fetch import list_content, sync
+from scitq.fetch import sync
 import subprocess
 import argparse
 import os
+import sys
+from contextlib import nullcontext
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.discovery import SampleDiscovery
+from common.submission import TaskSubmitter
+from common.resume import ResumeIndex
+from common.scheduling import largest_first
+from common.packing import pack, DEFAULT_PACK_SIZE
+from common.autoscale import ThroughputModel, AutoScaler, fleet_size, DEFAULT_MAX_WORKERS, DEFAULT_TARGET_HOURS
+from common.join import join
+from common.resources import resource_uri
+from common.matrix import MatrixStore, MatrixCollector, read_motus
+from common.result_cache import ResultCache, CachedSubmitter, DEFAULT_TTL_DAYS
 
 
 # Do not change that unless you know what you do
@@ -10,13 +24,24 @@ DOCKER = 'gmtscience/motus'
 DEFAULT_WORKERS = 5
 DEFAULT_REGION = 'GRA11'
 DEFAULT_PROVIDER = 'ovh'
+CONCURRENCY = 8
+PREFETCH = 2
 
 MAX_RETRY_PHASE1 = 2
 MAX_RETRY_PHASE2 = 5
 
+def motus_command(sample, fastqs, output='/output'):
+    """Return the shell command profiling a sample, fastqs being its pair of
+    FASTQ file names in /input, results going into output"""
+    return f"motus profile -db /resource/db_mOTU -f /input/{fastqs[0]} -r /input/{fastqs[1]} -n {sample} -o {output}/{sample}.motus -t $CPU"
+
 def motus(scitq_server, batch, source_s3, output_s3, motus_s3,
         region=DEFAULT_REGION, workers=DEFAULT_WORKERS, download=False,
-        provider=DEFAULT_PROVIDER):
+        provider=DEFAULT_PROVIDER, refresh_listing=False, stream=False,
+        resume=False, check_inputs=False, autoscale=False, max_workers=DEFAULT_MAX_WORKERS,
+        target_hours=DEFAULT_TARGET_HOURS, listing_order=False, pack_samples=0,
+        pack_size=DEFAULT_PACK_SIZE, aggregate=False, result_cache=False,
+        cache_ttl=DEFAULT_TTL_DAYS):
     """Launch biomscope using scitq in two phase, final compilation is done locally.
     Requires awscli, awscli-plugin-endpoint, combine_csv, sed and cut. Paramaters are
     explained through commande line --help"""
@@ -29,54 +54,126 @@ def motus(scitq_server, batch, source_s3, output_s3, motus_s3,
     
     if not (motus_s3.endswith('.tar.gz') or motus_s3.endswith('.tgz')):
         raise RuntimeError(f'motus_s3 should be in the form s3://bucket/path.../whatever.tgz (or .tar.gz) and not {motus_s3}')
+    motus_resource = resource_uri(motus_s3)
 
 
-    fastqs = [fastq.name for fastq in 
-                list_content(source_s3) if fastq.name.endswith('fastq.gz')]
-    
-
-    if len(fastqs)==0:
-        raise RuntimeError(f'Source ({source_s3}) does not seems to contain any .fastq.gz files')
-
     # fastqs are supposed to be grouped in folders each folder representing a sample
-    samples = {}
-    for fastq in fastqs:
-        sample = fastq.split('/')[-2]
-        if sample not in samples:
-            samples[sample]=[fastq]
-        else:
-            samples[sample].append(fastq)
-
-
+    samples = SampleDiscovery(source_s3, 'fastq.gz', refresh=refresh_listing,
+                    md5=check_inputs or result_cache)
+    if not stream:
+        samples.samples()
+        if len(samples.inventory)==0:
+            raise RuntimeError(f'Source ({source_s3}) does not seems to contain any .fastq.gz files')
 
+    def deploy_workers():
+        if workers:
+            s.worker_deploy(number=workers,
+                batch=batch,
+                region=region,
+                provider=provider,
+                flavor='c2-120' if provider=='ovh' else 'Standard_D32ads_v5',
+                concurrency=CONCURRENCY,
+                prefetch=PREFETCH)
 
+    if stream:
+        # workers boot while the source is listed and tasks are created
+        deploy_workers()
 
-    tasks = []
-    for sample,inputs in samples.items():
-        fastqs=[os.path.split(input)[1] for input in inputs]
-        if len(fastqs)!=2:
-            raise RuntimeError(f'Sample should only contains pair of samples: {sample} contains {fastqs}')
-        tasks.append(
-            s.task_create(
-                command=f"""sh -c 'motus profile -db /resource/db_mOTU -f /input/{fastqs[0]} -r /input/{fastqs[1]} -n {sample} -o /output/{sample}.motus -t $CPU' """,
-                name=sample,
-                batch=batch,
-                input=' '.join(inputs),
-                output=f'{output_s3}/{sample}',
-                resource=f'{motus_s3}|untar',
-                container=DOCKER
-            )
+    resume_index = ResumeIndex(output_s3, ['{sample}/{sample}.motus'], resume=resume,
+        check_inputs=check_inputs)
+    model = ThroughputModel('motus3')
+    cache = ResultCache(ttl=cache_ttl) if result_cache else None
+    # tasks which results are in the cache are not created
+    submitter = CachedSubmitter(TaskSubmitter(s), cache)
+    if stream:
+        sample_groups = samples
+    elif listing_order:
+        sample_groups = samples.inventory.items()
+    else:
+        # longest tasks first, so that they do not end up running alone at the end
+        sample_groups = largest_first(samples.inventory)
+    pending_groups = ((sample,items) for sample,items in sample_groups
+                        if not resume_index.skip(sample, items))
+    if pack_samples>1:
+        # several samples per task, each with its own output folder
+        units = pack(pending_groups, pack_samples, max_size=pack_size)
+    else:
+        units = ([group] for group in pending_groups)
+    for unit in units:
+        commands = []
+        for sample,items in unit:
+            fastqs=[os.path.split(item.name)[1] for item in items]
+            if len(fastqs)!=2:
+                raise RuntimeError(f'Sample should only contains pair of samples: {sample} contains {fastqs}')
+            if pack_samples>1:
+                commands.append(f"mkdir -p /output/{sample} && {motus_command(sample, fastqs, output=f'/output/{sample}')}")
+            else:
+                commands.append(motus_command(sample, fastqs))
+        submitter.submit(unit, [item for _,items in unit for item in items],
+            paths=[f'{sample}/' for sample,_ in unit] if pack_samples>1 else [''],
+            command=f"""sh -c '{' && '.join(commands)}' """,
+            name=sample if len(unit)==1 else f'pack_{unit[0][0]}',
+            batch=batch,
+            input=' '.join(item.name for _,items in unit for item in items),
+            output=output_s3 if pack_samples>1 else f'{output_s3}/{sample}',
+            resource=motus_resource,
+            container=DOCKER
         )
+    tasks, task_units, restored_units = submitter.wait()
+    task_samples = [[sample for sample,_ in unit] for unit in task_units]
+    sizes = [sum(item.size or 0 for _,items in unit for item in items) for unit in task_units]
+    restored_samples = [sample for unit in restored_units for sample,_ in unit]
+    # restored results are done
+    for unit in restored_units:
+        for sample,items in unit:
+            resume_index.record(sample, items)
+    samples_by_task = {task.task_id: samples for task,samples in zip(tasks, task_samples)}
+    if len(tasks)==0 and resume_index.skipped==0 and not restored_samples:
+        raise RuntimeError(f'Source ({source_s3}) does not seems to contain any .fastq.gz files')
 
+    if aggregate:
+        matrix_dir = os.path.join(batch, 'matrix')
+        collector = MatrixCollector(output_s3, [(MatrixStore(os.path.join(matrix_dir, 'motus3')),
+            read_motus, '{sample}/{sample}.motus')])
+        def on_success(task):
+            for sample in samples_by_task[task.task_id]:
+                collector.fetch(sample)
+    else:
+        on_success = None
+    if cache:
+        # results are recorded as soon as their task succeeded
+        on_success = cache.on_success(on_success)
+    # inputs fingerprints are recorded once their task succeeded
+    resume_index.watch(tasks, task_units)
+    on_success = resume_index.on_success(on_success)
 
-    if workers:
-        s.worker_deploy(number=workers,
-            batch=batch,
-            region=region,
-            flavor='c2-120' if provider=='ovh' else 'Standard_D32ads_v5',
-            concurrency=8,
-            prefetch=2)
-    s.join(tasks, retry=MAX_RETRY_PHASE1)
+    autoscaling = autoscale and workers
+    if tasks:
+        if not stream:
+            if autoscaling:
+                workers = fleet_size(model, sizes, CONCURRENCY, target_hours=target_hours,
+                    max_workers=max_workers)
+                print(f'Autoscaling: deploying {workers} worker(s) for {sum(sizes)/1024**3:.1f} GB of input')
+            deploy_workers()
+        scaler = AutoScaler(s, batch, tasks, sizes, model, CONCURRENCY,
+            dict(region=region, provider=provider, prefetch=PREFETCH,
+                flavor='c2-120' if provider=='ovh' else 'Standard_D32ads_v5'),
+            target_hours=target_hours, max_workers=max_workers) if autoscaling else nullcontext()
+        try:
+            with scaler:
+                join(s, tasks, retry=MAX_RETRY_PHASE1, batch=batch, on_success=on_success,
+                    sizes=sizes)
+        finally:
+            resume_index.save()
+    else:
+        resume_index.save()
+    if cache:
+        cache.close()
+
+    if aggregate:
+        # resumed and restored samples, and those done since the last collection
+        collector.collect(resume_index.skipped_samples+restored_samples+[sample for samples in task_samples for sample in samples])
+        print(f'Abundance matrix is in {matrix_dir}')
 
     if download:
         sync(output_s3, batch)
@@ -106,6 +203,32 @@ if __name__=='__main__':
         help=f'how many workers should we have, default to {DEFAULT_WORKERS}.')
     parser.add_argument('--download', action='store_true', 
         help=f'Download locally at the end.')
+    parser.add_argument('--refresh-listing', action='store_true', 
+        help=f'Ignore the local index of source_s3 listing and list it again completely.')
+    parser.add_argument('--stream', action='store_true', 
+        help=f'Deploy workers right away and create tasks while source_s3 is being listed.')
+    parser.add_argument('--autoscale', action='store_true', 
+        help=f'Choose the number of workers from the input size, and adjust it while tasks are running.')
+    parser.add_argument('--max-workers', type=int, default=DEFAULT_MAX_WORKERS,
+        help=f'With --autoscale, the maximal number of workers, default to {DEFAULT_MAX_WORKERS}.')
+    parser.add_argument('--target-hours', type=float, default=DEFAULT_TARGET_HOURS,
+        help=f'With --autoscale, the expected duration of the run, default to {DEFAULT_TARGET_HOURS}.')
+    parser.add_argument('--listing-order', action='store_true', 
+        help=f'Create tasks in listing order instead of biggest samples first.')
+    parser.add_argument('--pack-samples', type=int, default=0,
+        help=f'Analyse up to this number of small samples in each task (default to 0, one sample per task).')
+    parser.add_argument('--pack-size', type=float, default=DEFAULT_PACK_SIZE/1024**3,
+        help=f'With --pack-samples, the maximal input size in GB of a task, default to {DEFAULT_PACK_SIZE/1024**3:g}.')
+    parser.add_argument('--aggregate', action='store_true', 
+        help=f'Add the profile of each sample (as soon as it is done) to a taxon x sample matrix in the local <batch>/matrix folder.')
+    parser.add_argument('--result-cache', action='store_true', 
+        help=f'Copy the results of tasks already done in a previous run (same inputs, database and options, in any output folder) instead of launching them again.')
+    parser.add_argument('--cache-ttl', type=float, default=DEFAULT_TTL_DAYS,
+        help=f'With --result-cache, only reuse results of less than that many days, default to {DEFAULT_TTL_DAYS}.')
+    parser.add_argument('--resume', action='store_true', 
+        help=f'Skip samples which results are already present in output_s3.')
+    parser.add_argument('--check-inputs', action='store_true', 
+        help=f'With --resume, also recompute samples which inputs changed since they were launched.')
     
     args = parser.parse_args()
 
@@ -124,5 +247,18 @@ if __name__=='__main__':
         region=args.region,
         provider=args.provider,
         workers=args.workers,
-        download=args.download
+        download=args.download,
+        refresh_listing=args.refresh_listing,
+        stream=args.stream,
+        resume=args.resume,
+        check_inputs=args.check_inputs,
+        autoscale=args.autoscale,
+        max_workers=args.max_workers,
+        target_hours=args.target_hours,
+        listing_order=args.listing_order,
+        pack_samples=args.pack_samples,
+        pack_size=int(args.pack_size*1024**3),
+        aggregate=args.aggregate,
+        result_cache=args.result_cache,
+        cache_ttl=args.cache_ttl
     )
\ No newline at end of file
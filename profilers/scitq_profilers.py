@@ -0,0 +1,307 @@
+from scitq.lib import Server
+from scitq.fetch import sync
+import argparse
+import os
+import sys
+from contextlib import nullcontext
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+# scitq_metaphlan4 imports its helpers from its own folder
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'metaphlan4'))
+from common.discovery import SampleDiscovery
+from common.submission import TaskSubmitter
+from common.resume import ResumeIndex
+from common.scheduling import largest_first
+from common.autoscale import ThroughputModel, AutoScaler, fleet_size, DEFAULT_MAX_WORKERS, DEFAULT_TARGET_HOURS
+from common.join import join
+from common.resources import resource_uri
+from common.result_cache import ResultCache, CachedSubmitter, DEFAULT_TTL_DAYS
+from kraken2.scitq_kraken2 import kraken2_command
+from motus3.scitq_motus3 import motus_command
+from scitq_metaphlan4 import metaphlan_command
+
+
+# Do not change that unless you know what you do
+PROFILERS = ['kraken2', 'motus3', 'metaphlan4']
+DEFAULT_WORKERS = 5
+DEFAULT_REGION = 'GRA11'
+DEFAULT_PROVIDER = 'ovh'
+PREFETCH = 1
+MAX_RETRY = 2
+
+# expected outputs of each profiler, relative to its own output folder
+EXPECTED = {
+    'kraken2': ['{sample}/{sample}.report', '{sample}/{sample}.kraken'],
+    'motus3': ['{sample}/{sample}.motus'],
+    'metaphlan4': ['{sample}/{sample}.metaphlan4_profile.txt'],
+}
+
+
+def profilers_command(sample, fastqs, profilers, database='', bracken=False, parallel=False):
+    """Return the task command running the profilers on a sample (which pair
+    of FASTQs is in /input), each writing in /output/<profiler>/<sample>"""
+    commands = []
+    for profiler in profilers:
+        output = f'/output/{profiler}/{sample}'
+        if profiler=='kraken2':
+            command = kraken2_command(sample, '--paired --gzip-compressed /input/*.fastq.gz',
+                database=database, bracken=bracken, output=output)
+        elif profiler=='motus3':
+            command = motus_command(sample, fastqs, output=output)
+        else:
+            command = metaphlan_command(sample, '4', output=output)
+        commands.append(f'mkdir -p {output} && {command}')
+    if parallel:
+        # each profiler is waited for on its own so that a failure is not lost
+        launched = ' '.join(f'({command}) & p{i}=$!;' for i,command in enumerate(commands))
+        waited = ' && '.join(f'wait $p{i}' for i in range(len(commands)))
+        return f"sh -c '{launched} {waited}'"
+    return f"sh -c '{' && '.join(commands)}'"
+
+
+def profilers(scitq_server, batch, source_s3, output_s3, selected, container,
+        kraken_s3=None, motus_s3=None, metaphlan_s3=None, database='', bracken=False,
+        parallel=False, region=DEFAULT_REGION, workers=DEFAULT_WORKERS, flavor=None,
+        concurrency=None, provider=DEFAULT_PROVIDER, download=False, refresh_listing=False,
+        stream=False, resume=False, check_inputs=False, autoscale=False,
+        max_workers=DEFAULT_MAX_WORKERS, target_hours=DEFAULT_TARGET_HOURS, listing_order=False,
+        result_cache=False, cache_ttl=DEFAULT_TTL_DAYS):
+    """Run several profilers on the same paired FASTQs with a single task per
+    sample: inputs are downloaded once and all databases are attached to the
+    same workers. Results of each profiler go to output_s3/<profiler>/, with
+    the same layout as the profiler own launcher. Parameters are explained
+    through command line --help"""
+
+    s=Server(scitq_server, style='object')
+
+    # remove trailing slash
+    source_s3 = source_s3.rstrip('/')
+    output_s3 = output_s3.rstrip('/')
+    selected = [profiler for profiler in PROFILERS if profiler in selected]
+    if not selected:
+        raise RuntimeError(f'At least one profiler should be chosen among {", ".join(PROFILERS)}')
+
+    # all databases are extracted side by side in /resource: kraken2 files at
+    # its root (or in database), db_mOTU and metaphlan folders
+    resources = []
+    for profiler,archive in [('kraken2', kraken_s3), ('motus3', motus_s3), ('metaphlan4', metaphlan_s3)]:
+        if profiler not in selected:
+            continue
+        if not archive or not (archive.endswith('.tgz') or archive.endswith('.tar.gz')):
+            raise RuntimeError(f'{profiler} requires its database as a tar gziped archive (s3://bucket/path.../whatever.tgz), not {archive}')
+        resources.append(resource_uri(archive))
+
+    if flavor is None:
+        # kraken2 databases need lots of memory
+        if 'kraken2' in selected:
+            flavor = 'i1-180' if provider=='ovh' else 'Standard_E64-32ads_v5'
+        else:
+            flavor = 'c2-120' if provider=='ovh' else 'Standard_D32ads_v5'
+    if concurrency is None:
+        concurrency = 1 if 'kraken2' in selected else 4
+
+    # fastqs are supposed to be grouped in folders each folder representing a sample
+    samples = SampleDiscovery(source_s3, 'fastq.gz', refresh=refresh_listing,
+                    md5=check_inputs or result_cache)
+    if not stream:
+        samples.samples()
+        if len(samples.inventory)==0:
+            raise RuntimeError(f'Source ({source_s3}) does not seems to contain any .fastq.gz files')
+
+    def deploy_workers():
+        if workers:
+            s.worker_deploy(number=workers,
+                batch=batch,
+                region=region,
+                provider=provider,
+                flavor=flavor,
+                concurrency=concurrency,
+                prefetch=PREFETCH)
+
+    if stream:
+        # workers boot while the source is listed and tasks are created
+        deploy_workers()
+
+    # each profiler output is resumed on its own
+    resume_indexes = {}
+    for profiler in selected:
+        expected = EXPECTED[profiler]
+        if profiler=='kraken2' and bracken:
+            expected = expected+['{sample}/{sample}.bracken']
+        resume_indexes[profiler] = ResumeIndex(f'{output_s3}/{profiler}', expected, resume=resume,
+            check_inputs=check_inputs)
+    model = ThroughputModel('profilers')
+    cache = ResultCache(ttl=cache_ttl) if result_cache else None
+    # tasks which results are in the cache are not created
+    submitter = CachedSubmitter(TaskSubmitter(s), cache)
+    if stream:
+        sample_groups = samples
+    elif listing_order:
+        sample_groups = samples.inventory.items()
+    else:
+        # longest tasks first, so that they do not end up running alone at the end
+        sample_groups = largest_first(samples.inventory)
+    skipped = 0
+    for sample,items in sample_groups:
+        todo = [profiler for profiler in selected if not resume_indexes[profiler].skip(sample, items)]
+        if not todo:
+            skipped += 1
+            continue
+        fastqs=[os.path.split(item.name)[1] for item in items]
+        if len(fastqs)!=2:
+            raise RuntimeError(f'Sample should only contains pair of samples: {sample} contains {fastqs}')
+        submitter.submit((sample, items, todo), items,
+            paths=[f'{profiler}/{sample}/' for profiler in todo],
+            command=profilers_command(sample, fastqs, todo, database=database, bracken=bracken,
+                parallel=parallel),
+            name=sample,
+            batch=batch,
+            input=' '.join(item.name for item in items),
+            output=f'{output_s3}/',
+            resource=' '.join(resources),
+            container=container
+        )
+    tasks, task_units, restored_units = submitter.wait()
+    sizes = [sum(item.size or 0 for item in items) for _,items,_ in task_units]
+    # restored results are done
+    for sample,items,todo in restored_units:
+        for profiler in todo:
+            resume_indexes[profiler].record(sample, items)
+    # inputs fingerprints are recorded once their task succeeded, for the
+    # profilers it ran
+    on_success = None
+    for profiler,resume_index in resume_indexes.items():
+        resume_index.watch(tasks, [[(sample, items)] if profiler in todo else []
+                                    for sample,items,todo in task_units])
+        on_success = resume_index.on_success(on_success)
+    if cache:
+        # results are recorded as soon as their task succeeded
+        on_success = cache.on_success(on_success)
+    if len(tasks)==0 and skipped==0 and not restored_units:
+        raise RuntimeError(f'Source ({source_s3}) does not seems to contain any .fastq.gz files')
+
+    autoscaling = autoscale and workers
+    if tasks:
+        if not stream:
+            if autoscaling:
+                workers = fleet_size(model, sizes, concurrency, target_hours=target_hours,
+                    max_workers=max_workers)
+                print(f'Autoscaling: deploying {workers} worker(s) for {sum(sizes)/1024**3:.1f} GB of input')
+            deploy_workers()
+        scaler = AutoScaler(s, batch, tasks, sizes, model, concurrency,
+            dict(region=region, provider=provider, prefetch=PREFETCH, flavor=flavor),
+            target_hours=target_hours, max_workers=max_workers) if autoscaling else nullcontext()
+        try:
+            with scaler:
+                join(s, tasks, retry=MAX_RETRY, batch=batch, on_success=on_success, sizes=sizes)
+        finally:
+            for resume_index in resume_indexes.values():
+                resume_index.save()
+    else:
+        for resume_index in resume_indexes.values():
+            resume_index.save()
+    if cache:
+        cache.close()
+
+    if download:
+        sync(output_s3, batch)
+
+
+if __name__=='__main__':
+    SCITQ_SERVER = os.environ.get('SCITQ_SERVER')
+    parser = argparse.ArgumentParser(
+                    prog = 'SCITQ profilers',
+                    description = 'Launch several profilers (kraken2, mOTUs, MetaPhlAn) on some paired FASTQs from WGS samples, downloading each sample only once.')
+    parser.add_argument('batch', type=str,
+        help='A short name for this project')
+    parser.add_argument('source_s3', type=str,
+        help="S3 path where the FASTQs are in the form s3://bucket/path... FASTQs should be grouped per sample in a folder named after the sample")
+    parser.add_argument('output_s3', type=str,
+        help='S3 folder where results will be stored, in a sub-folder per profiler (kraken2, motus3, metaphlan4)')
+    parser.add_argument('container', type=str,
+        help='A docker image with all the chosen profilers (see Dockerfile in this folder)')
+    parser.add_argument('--profilers', type=str, nargs='+', choices=PROFILERS, default=PROFILERS,
+        help=f'Profilers to run, default to all of them ({" ".join(PROFILERS)})')
+    parser.add_argument('--kraken', type=str, default=None,
+        help='S3 path to the kraken2 database archive (as for scitq_kraken2.py)')
+    parser.add_argument('--database', type=str, default='',
+        help=f'If kraken database tar contains a subdirectory specify it here')
+    parser.add_argument('--bracken', action='store_true',
+        help=f'Add bracken analysis to kraken2 to enhance species estimation.')
+    parser.add_argument('--motus', type=str, default=None,
+        help='S3 path to the mOTUs database archive (as for scitq_motus3.py)')
+    parser.add_argument('--metaphlan', type=str, default=None,
+        help='S3 path to the MetaPhlAn 4 database archive (as for scitq_metaphlan4.py)')
+    parser.add_argument('--parallel', action='store_true',
+        help=f'Run the profilers of a sample at the same time instead of one after the other (if the flavor has enough memory for all of them).')
+    parser.add_argument('--scitq', type=str,
+        help=f'SCITQ server FQDN, default to {SCITQ_SERVER}', default=SCITQ_SERVER)
+    parser.add_argument('--region', type=str,
+        help=f'Provider region - default to {DEFAULT_REGION}', default=DEFAULT_REGION)
+    parser.add_argument('--provider', type=str, choices=['ovh','azure'], default=DEFAULT_PROVIDER,
+        help=f"Cloud provider for instances, default to {DEFAULT_PROVIDER} ")
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS,
+        help=f'how many workers should we have, default to {DEFAULT_WORKERS}.')
+    parser.add_argument('--flavor', type=str, default=None,
+        help=f'Flavor of workers, default to i1-180 with kraken2 (for its memory), c2-120 otherwise (or their Azure equivalent).')
+    parser.add_argument('--concurrency', type=int, default=None,
+        help=f'Tasks per worker, default to 1 with kraken2, 4 otherwise.')
+    parser.add_argument('--download', action='store_true',
+        help=f'Download locally at the end.')
+    parser.add_argument('--refresh-listing', action='store_true',
+        help=f'Ignore the local index of source_s3 listing and list it again completely.')
+    parser.add_argument('--stream', action='store_true',
+        help=f'Deploy workers right away and create tasks while source_s3 is being listed.')
+    parser.add_argument('--autoscale', action='store_true',
+        help=f'Choose the number of workers from the input size, and adjust it while tasks are running.')
+    parser.add_argument('--max-workers', type=int, default=DEFAULT_MAX_WORKERS,
+        help=f'With --autoscale, the maximal number of workers, default to {DEFAULT_MAX_WORKERS}.')
+    parser.add_argument('--target-hours', type=float, default=DEFAULT_TARGET_HOURS,
+        help=f'With --autoscale, the expected duration of the run, default to {DEFAULT_TARGET_HOURS}.')
+    parser.add_argument('--listing-order', action='store_true',
+        help=f'Create tasks in listing order instead of biggest samples first.')
+    parser.add_argument('--result-cache', action='store_true',
+        help=f'Copy the results of tasks already done in a previous run (same inputs, databases and options, in any output folder) instead of launching them again.')
+    parser.add_argument('--cache-ttl', type=float, default=DEFAULT_TTL_DAYS,
+        help=f'With --result-cache, only reuse results of less than that many days, default to {DEFAULT_TTL_DAYS}.')
+    parser.add_argument('--resume', action='store_true',
+        help=f'Only run the profilers which results are not already present in output_s3 (a sample is skipped when all are there).')
+    parser.add_argument('--check-inputs', action='store_true',
+        help=f'With --resume, also recompute samples which inputs changed since they were launched.')
+    args = parser.parse_args()
+
+    if not args.scitq:
+        raise RuntimeError('You must define which SCITQ server we use, either defining SCITQ_SERVER environment variable or using --scitq')
+
+    profilers(
+        batch=args.batch,
+        scitq_server=args.scitq,
+
+        source_s3=args.source_s3,
+        output_s3=args.output_s3,
+        selected=args.profilers,
+        container=args.container,
+        kraken_s3=args.kraken,
+        motus_s3=args.motus,
+        metaphlan_s3=args.metaphlan,
+        database=args.database,
+        bracken=args.bracken,
+        parallel=args.parallel,
+
+        region=args.region,
+        provider=args.provider,
+        workers=args.workers,
+        flavor=args.flavor,
+        concurrency=args.concurrency,
+        download=args.download,
+        refresh_listing=args.refresh_listing,
+        stream=args.stream,
+        resume=args.resume,
+        check_inputs=args.check_inputs,
+        autoscale=args.autoscale,
+        max_workers=args.max_workers,
+        target_hours=args.target_hours,
+        listing_order=args.listing_order,
+        result_cache=args.result_cache,
+        cache_ttl=args.cache_ttl
+    )